@@ -0,0 +1,140 @@
+# admission.py
+
+import logging
+import time
+from enum import IntEnum
+
+from config import (
+    ADMISSION_LATENCY_TARGET, ADMISSION_MAX_INFLIGHT, ADMISSION_PROBE_INTERVAL, ADMISSION_RECOVERY_SECONDS,
+    ADMISSION_THRESHOLDS,
+)
+from llm_scheduler import Priority, scheduler
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Вес нового замера в скользящем среднем задержки
+_LATENCY_ALPHA = 0.3
+
+OVERLOADED_MESSAGE = (
+    "⏳ Сейчас очень высокая нагрузка, и ответ не успеет подготовиться вовремя. "
+    "Пожалуйста, повторите через пару минут."
+)
+
+
+class Level(IntEnum):
+    """Уровни деградации; каждый следующий включает все предыдущие"""
+    NORMAL = 0
+    NO_RECOMMENDATIONS = 1  # анализ еды без секции [РЕКОМЕНДАЦИИ] и с коротким ответом
+    SHORT_HISTORY = 2       # в запрос попадают только последние записи дня
+    CHEAP_MODEL = 3         # дешевая модель вместо основной, без эскалации
+    DEFER_SUMMARIES = 4     # рекомендации по итогам дня откладываются до восстановления
+    SHED = 5                # новые интерактивные запросы отклоняются сразу
+
+
+class Overloaded(Exception):
+    """Запрос к LLM отклонен: сервис перегружен"""
+
+
+class AdmissionController:
+    """
+    Контроль допуска запросов к LLM.
+    Давление — максимум из двух отношений: скользящей средней задержки провайдера
+    к целевой и числа запросов в очереди планировщика и в работе к допустимому.
+    Уровень деградации — число порогов thresholds, которые давление превысило.
+    Повышается уровень сразу, а снижается по одному шагу не чаще раза в
+    recovery_seconds, чтобы не переключаться туда-обратно на каждом замере.
+    На уровне SHED раз в probe_interval пропускается пробный запрос: без него
+    задержку было бы нечем измерить и восстановление не наступило бы.
+    """
+
+    def __init__(self, latency_target: float = ADMISSION_LATENCY_TARGET,
+                 max_inflight: int = ADMISSION_MAX_INFLIGHT,
+                 thresholds: tuple[float, ...] = ADMISSION_THRESHOLDS,
+                 recovery_seconds: float = ADMISSION_RECOVERY_SECONDS,
+                 probe_interval: float = ADMISSION_PROBE_INTERVAL):
+        self.latency_target = latency_target
+        self.max_inflight = max_inflight
+        self.thresholds = thresholds
+        self.recovery_seconds = recovery_seconds
+        self.probe_interval = probe_interval
+        self.level = Level.NORMAL
+        self._latency = 0.0
+        self._last_sample = 0.0
+        self._inflight = 0
+        self._changed_at = time.monotonic()
+        self._last_probe = 0.0
+        self._deferred: list = []
+
+    def pressure(self, now: float) -> float:
+        # Давно не было замеров — старая задержка уже ничего не говорит о провайдере
+        latency = self._latency if now - self._last_sample < self.recovery_seconds else 0.0
+        load = (self._inflight + scheduler.queue_depth) / self.max_inflight
+        return max(latency / self.latency_target, load)
+
+    def update(self) -> Level:
+        now = time.monotonic()
+        pressure = self.pressure(now)
+        target = Level(min(sum(pressure >= t for t in self.thresholds), Level.SHED))
+        if target > self.level:
+            self._set_level(target, now, pressure)
+        elif target < self.level and now - self._changed_at >= self.recovery_seconds:
+            self._set_level(Level(self.level - 1), now, pressure)
+        metrics.set_gauge('admission.pressure', round(pressure, 2))
+        return self.level
+
+    def _set_level(self, level: Level, now: float, pressure: float) -> None:
+        log = logger.warning if level > self.level else logger.info
+        log("Уровень деградации %s -> %s (давление %.2f)", self.level.name, level.name, pressure)
+        self.level = level
+        self._changed_at = now
+        metrics.set_gauge('admission.level', int(level))
+        metrics.incr('admission.transitions', level=level.name)
+        if level < Level.DEFER_SUMMARIES and self._deferred:
+            deferred, self._deferred = self._deferred, []
+            logger.info("Запускается отложенных задач: %d", len(deferred))
+            for job in deferred:
+                job()
+        metrics.set_gauge('admission.deferred', len(self._deferred))
+
+    def admit(self, priority: Priority, flow: str) -> Level:
+        """Уровень деградации для нового запроса; Overloaded, если запрос нужно отклонить"""
+        level = self.update()
+        if level >= Level.SHED and priority == Priority.INTERACTIVE:
+            now = time.monotonic()
+            if now - self._last_probe < self.probe_interval:
+                metrics.incr('admission.shed', flow=flow)
+                raise Overloaded(flow)
+            self._last_probe = now
+            metrics.incr('admission.probes', flow=flow)
+        if level > Level.NORMAL:
+            metrics.incr('admission.degraded', flow=flow, level=level.name)
+        return level
+
+    def started(self) -> None:
+        self._inflight += 1
+
+    def finished(self, latency: float) -> None:
+        """Замер задержки вызова; таймауты и ошибки тоже учитываются — они и есть признак перегрузки"""
+        self._inflight -= 1
+        self._latency = latency if not self._last_sample else \
+            _LATENCY_ALPHA * latency + (1 - _LATENCY_ALPHA) * self._latency
+        self._last_sample = time.monotonic()
+        metrics.set_gauge('admission.latency', round(self._latency, 2))
+        self.update()
+
+    @property
+    def defers_background(self) -> bool:
+        return self.update() >= Level.DEFER_SUMMARIES
+
+    def defer(self, job) -> None:
+        """Откладывает запуск job() до снижения уровня ниже DEFER_SUMMARIES"""
+        self._deferred.append(job)
+        metrics.set_gauge('admission.deferred', len(self._deferred))
+
+    async def tick(self) -> None:
+        """Периодическая задача: пересчитывает уровень, даже когда запросов нет"""
+        self.update()
+
+
+admission = AdmissionController()
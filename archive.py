@@ -0,0 +1,257 @@
+# archive.py
+
+import asyncio
+import datetime
+import importlib.util
+import json
+import logging
+import sys
+import time
+import zlib
+from dataclasses import dataclass
+
+from sqlalchemy import func
+
+from config import ARCHIVE_AFTER_DAYS, ARCHIVE_BATCH_SIZE, ARCHIVE_ZSTD_LEVEL
+from database import Session
+from models import DailyLog, DailyLogArchive
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# zstd сжимает тексты анализа лучше и быстрее zlib, но требует пакет zstandard;
+# без него архив пишется в zlib, а прочитать можно блоки обоих форматов
+ZSTD_AVAILABLE = importlib.util.find_spec('zstandard') is not None
+
+# Поля итогов дня, которые не читаются после закрытия дня: разбивка по приемам
+# пищи уже есть в тексте summary и восстанавливается по самим записям
+_DROPPED_DAY_END_FIELDS = ('meals_breakdown',)
+
+
+@dataclass(slots=True)
+class ArchivedLog:
+    """Запись из архива; поля совпадают с DailyLog, поэтому код отображения работает с обеими"""
+    id: int
+    telegram_id: int
+    date: datetime.date
+    time: datetime.datetime
+    data: dict
+
+
+def _compress(raw: bytes) -> tuple[str, bytes]:
+    if ZSTD_AVAILABLE:
+        import zstandard
+        return 'zstd', zstandard.ZstdCompressor(level=ARCHIVE_ZSTD_LEVEL).compress(raw)
+    return 'zlib', zlib.compress(raw, 9)
+
+
+def _decompress(codec: str, payload: bytes) -> bytes:
+    if codec == 'zstd':
+        import zstandard
+        return zstandard.ZstdDecompressor().decompress(payload)
+    return zlib.decompress(payload)
+
+
+def _compact(data: dict) -> dict:
+    if data.get('type') != 'day_end':
+        return data
+    return {key: value for key, value in data.items() if key not in _DROPPED_DAY_END_FIELDS}
+
+
+def unpack(block) -> list[ArchivedLog]:
+    """Распаковывает архивный блок дня в записи, упорядоченные по времени"""
+    entries = json.loads(_decompress(block.codec, block.payload))
+    return [
+        ArchivedLog(log_id, block.telegram_id, block.date, datetime.datetime.fromisoformat(time_str), data)
+        for log_id, time_str, data in entries
+    ]
+
+
+def _pack(entries: list[list]) -> tuple[str, bytes, int]:
+    raw = json.dumps(entries, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    codec, payload = _compress(raw)
+    return codec, payload, len(raw)
+
+
+def _archive_day(session, telegram_id: int, date: datetime.date) -> tuple[int, int, int]:
+    """Переносит записи пользователя за день в архивный блок; возвращает (записей, байт JSON, байт в архиве)"""
+    rows = session.query(DailyLog).filter(
+        DailyLog.telegram_id == telegram_id,
+        DailyLog.date == date
+    ).order_by(DailyLog.time).all()
+    if not rows:
+        return 0, 0, 0
+
+    entries = [[row.id, row.time.isoformat(), _compact(row.data)] for row in rows]
+    raw_before = sum(len(json.dumps(row.data, ensure_ascii=False)) for row in rows)
+
+    block = session.query(DailyLogArchive).filter_by(telegram_id=telegram_id, date=date).first()
+    if block is not None:
+        # День уже в архиве (запись появилась задним числом) — дописываем в тот же блок
+        entries = [[log.id, log.time.isoformat(), log.data] for log in unpack(block)] + entries
+        entries.sort(key=lambda entry: entry[1])
+    else:
+        block = DailyLogArchive(telegram_id=telegram_id, date=date)
+        session.add(block)
+
+    block.codec, block.payload, block.raw_size = _pack(entries)
+    block.entries = len(entries)
+    block.last_log_id = max(entry[0] for entry in entries)
+
+    session.query(DailyLog).filter(DailyLog.id.in_([row.id for row in rows])).delete(synchronize_session=False)
+    return len(rows), raw_before, len(block.payload)
+
+
+def archive_old_logs(cutoff: datetime.date | None = None, batch_size: int = ARCHIVE_BATCH_SIZE) -> dict:
+    """
+    Переносит в архив одну пачку дней старше cutoff (по умолчанию ARCHIVE_AFTER_DAYS)
+    и возвращает статистику пачки. Каждая пачка — отдельная транзакция.
+    """
+    cutoff = cutoff or datetime.date.today() - datetime.timedelta(days=ARCHIVE_AFTER_DAYS)
+    stats = {'days': 0, 'rows': 0, 'raw_bytes': 0, 'stored_bytes': 0}
+    session = Session()
+    try:
+        pairs = session.query(DailyLog.telegram_id, DailyLog.date).filter(
+            DailyLog.date < cutoff
+        ).distinct().order_by(DailyLog.date).limit(batch_size).all()
+        for telegram_id, date in pairs:
+            rows, raw_bytes, stored_bytes = _archive_day(session, telegram_id, date)
+            stats['days'] += 1
+            stats['rows'] += rows
+            stats['raw_bytes'] += raw_bytes
+            stats['stored_bytes'] += stored_bytes
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+    metrics.incr('archive.days', stats['days'])
+    metrics.incr('archive.rows', stats['rows'])
+    metrics.incr('archive.raw_bytes', stats['raw_bytes'])
+    metrics.incr('archive.stored_bytes', stats['stored_bytes'])
+    return stats
+
+
+async def archive_sweep() -> None:
+    """Периодическая задача: переносит старые дни в архив пачками, не блокируя цикл событий"""
+    total = {'days': 0, 'rows': 0, 'raw_bytes': 0, 'stored_bytes': 0}
+    while True:
+        stats = await asyncio.to_thread(archive_old_logs)
+        for key, value in stats.items():
+            total[key] += value
+        if stats['days'] < ARCHIVE_BATCH_SIZE:
+            break
+    if total['days']:
+        logger.info(
+            "В архив перенесено %d записей за %d дней: %d КБ JSON -> %d КБ",
+            total['rows'], total['days'], total['raw_bytes'] // 1024, total['stored_bytes'] // 1024
+        )
+    report_storage()
+
+
+def report_storage() -> dict:
+    """Размер горячей таблицы и архива; значения публикуются в метриках"""
+    session = Session()
+    hot_rows = session.query(func.count(DailyLog.id)).scalar()
+    archived_days, archived_rows, raw_bytes, stored_bytes = session.query(
+        func.count(DailyLogArchive.id),
+        func.coalesce(func.sum(DailyLogArchive.entries), 0),
+        func.coalesce(func.sum(DailyLogArchive.raw_size), 0),
+        func.coalesce(func.sum(func.length(DailyLogArchive.payload)), 0),
+    ).one()
+    session.close()
+
+    stats = {
+        'hot_rows': hot_rows,
+        'archived_days': archived_days,
+        'archived_rows': archived_rows,
+        'archive_raw_bytes': raw_bytes,
+        'archive_stored_bytes': stored_bytes,
+        'compression_ratio': round(raw_bytes / stored_bytes, 2) if stored_bytes else 0.0,
+    }
+    for key, value in stats.items():
+        metrics.set_gauge(f'archive.{key}', value)
+    return stats
+
+
+def load_logs(session, telegram_id: int, start: datetime.date, end: datetime.date | None = None,
+              types: tuple[str, ...] | None = None) -> list:
+    """
+    Записи пользователя за период из горячей таблицы и архива, по дате и времени.
+    Возвращает DailyLog и ArchivedLog вперемешку; types фильтрует по data['type'].
+    """
+    end = end or start
+    started = time.perf_counter()
+    query = session.query(DailyLog).filter(
+        DailyLog.telegram_id == telegram_id,
+        DailyLog.date >= start,
+        DailyLog.date <= end
+    )
+    if types:
+        query = query.filter(DailyLog.data['type'].as_string().in_(types))
+    logs = list(query.all())
+
+    blocks = session.query(DailyLogArchive).filter(
+        DailyLogArchive.telegram_id == telegram_id,
+        DailyLogArchive.date >= start,
+        DailyLogArchive.date <= end
+    ).all()
+    for block in blocks:
+        logs.extend(log for log in unpack(block) if not types or log.data.get('type') in types)
+    if blocks:
+        metrics.observe('archive.read_time', time.perf_counter() - started)
+
+    logs.sort(key=lambda log: (log.date, log.time))
+    return logs
+
+
+def last_log_id(session, telegram_id: int, date: datetime.date) -> int:
+    """id последней записи пользователя за день в горячей таблице и архиве; 0, если записей нет"""
+    hot = session.query(func.max(DailyLog.id)).filter(
+        DailyLog.telegram_id == telegram_id,
+        DailyLog.date == date
+    ).scalar()
+    archived = session.query(DailyLogArchive.last_log_id).filter_by(telegram_id=telegram_id, date=date).scalar()
+    return max(hot or 0, archived or 0)
+
+
+def recent_logs(session, telegram_id: int, limit: int) -> list:
+    """Последние limit записей пользователя, новые первыми; архив читается, только если горячих не хватило"""
+    logs = session.query(DailyLog).filter(
+        DailyLog.telegram_id == telegram_id
+    ).order_by(DailyLog.date.desc(), DailyLog.time.desc()).limit(limit).all()
+    if len(logs) >= limit:
+        return logs
+
+    blocks = session.query(DailyLogArchive).filter(
+        DailyLogArchive.telegram_id == telegram_id
+    ).order_by(DailyLogArchive.date.desc())
+    for block in blocks:
+        logs.extend(reversed(unpack(block)))
+        if len(logs) >= limit:
+            break
+    return logs[:limit]
+
+
+def archived_dates(session, telegram_id: int, start: datetime.date, end: datetime.date) -> set[datetime.date]:
+    rows = session.query(DailyLogArchive.date).filter(
+        DailyLogArchive.telegram_id == telegram_id,
+        DailyLogArchive.date >= start,
+        DailyLogArchive.date <= end
+    ).all()
+    return {row[0] for row in rows}
+
+
+if __name__ == "__main__":
+    # Ручной запуск: python -m archive [--vacuum]
+    logging.basicConfig(level=logging.INFO)
+    while archive_old_logs()['days']:
+        pass
+    if '--vacuum' in sys.argv:
+        from database import engine
+        # VACUUM возвращает освободившееся место файлу БД и не работает внутри транзакции
+        with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+            connection.exec_driver_sql('VACUUM')
+    print(report_storage())
@@ -0,0 +1,113 @@
+# benchmarks/archive.py
+#
+# Заполняет временную SQLite-базу синтетической историей, переносит старые дни
+# в архив и сравнивает размер горячей таблицы, размер файла БД и время выборок
+# до и после.
+# Запуск: python -m benchmarks.archive [пользователей] [дней]
+
+import datetime
+import os
+import sys
+import tempfile
+import time
+
+from sqlalchemy import create_engine
+
+import database
+from migrations import migrate
+from models import DailyLog
+
+USERS = 200
+DAYS = 180
+ENTRIES_PER_DAY = 6
+QUERIES = 500
+
+SAMPLE_ANALYSIS = (
+    "[АНАЛИЗ]\nОвсяная каша на молоке с бананом и грецкими орехами. "
+    "Порция около 300 г, банан среднего размера, горсть орехов.\n[/АНАЛИЗ]\n"
+    "[НУТРИЕНТЫ]\nКалории: 520 ккал\nБелки: 16 г\nЖиры: 19 г\nУглеводы: 72 г\n[/НУТРИЕНТЫ]\n"
+    "[РЕКОМЕНДАЦИИ]\n1. Добавьте источник белка, например творог или яйцо.\n"
+    "2. Следите за размером порции орехов.\n3. Пейте достаточно воды.\n[/РЕКОМЕНДАЦИИ]"
+)
+
+
+def fill(engine, users: int, days: int) -> None:
+    today = datetime.date.today()
+    rows = []
+    for user in range(1, users + 1):
+        for day in range(days):
+            date = today - datetime.timedelta(days=day)
+            for i in range(ENTRIES_PER_DAY):
+                rows.append({
+                    'telegram_id': user,
+                    'date': date,
+                    'time': datetime.datetime.combine(date, datetime.time(8 + i * 2)),
+                    'data': {'type': 'meal', 'meal_type': 'Завтрак', 'text': f'каша #{i}',
+                             'analysis': SAMPLE_ANALYSIS,
+                             'nutrients': {'calories': 520, 'protein': 16, 'fat': 19, 'carbs': 72}},
+                })
+    with engine.begin() as connection:
+        connection.execute(DailyLog.__table__.insert(), rows)
+
+
+def recent_day_query_time(users: int) -> float:
+    """Среднее время выборки сегодняшних записей пользователя (горячий путь бота)"""
+    today = datetime.date.today()
+    session = database.Session()
+    started = time.perf_counter()
+    for i in range(QUERIES):
+        session.query(DailyLog).filter_by(telegram_id=i % users + 1, date=today).all()
+    elapsed = (time.perf_counter() - started) / QUERIES
+    session.close()
+    return elapsed
+
+
+def old_day_query_time(users: int, days: int) -> float:
+    """Среднее время чтения старого дня через load_logs (горячая таблица + архив)"""
+    from archive import load_logs
+    date = datetime.date.today() - datetime.timedelta(days=days - 1)
+    session = database.Session()
+    started = time.perf_counter()
+    for i in range(QUERIES):
+        load_logs(session, i % users + 1, date)
+    elapsed = (time.perf_counter() - started) / QUERIES
+    session.close()
+    return elapsed
+
+
+def main() -> None:
+    users = int(sys.argv[1]) if len(sys.argv) > 1 else USERS
+    days = int(sys.argv[2]) if len(sys.argv) > 2 else DAYS
+    path = os.path.join(tempfile.mkdtemp(), 'archive_bench.db')
+    engine = create_engine(f'sqlite:///{path}')
+    database.Session.configure(bind=engine)
+    migrate(engine)
+    fill(engine, users, days)
+
+    from archive import archive_old_logs, report_storage
+    before = report_storage()
+    size_before = os.path.getsize(path)
+    recent_before, old_before = recent_day_query_time(users), old_day_query_time(users, days)
+
+    started = time.perf_counter()
+    while archive_old_logs()['days']:
+        pass
+    archive_seconds = time.perf_counter() - started
+    with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+        connection.exec_driver_sql('VACUUM')
+
+    after = report_storage()
+    size_after = os.path.getsize(path)
+    recent_after, old_after = recent_day_query_time(users), old_day_query_time(users, days)
+
+    print(f"Строк в горячей таблице: {before['hot_rows']} -> {after['hot_rows']}")
+    print(f"Архив: {after['archived_rows']} записей в {after['archived_days']} блоках, "
+          f"сжатие x{after['compression_ratio']}")
+    print(f"Файл БД: {size_before / 2**20:.1f} МБ -> {size_after / 2**20:.1f} МБ")
+    print(f"Перенос в архив: {archive_seconds:.1f} с")
+    print(f"Записи за сегодня: {recent_before * 1e3:.2f} мс -> {recent_after * 1e3:.2f} мс")
+    print(f"Старый день: {old_before * 1e3:.2f} мс -> {old_after * 1e3:.2f} мс")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+# benchmarks/day_log_memory.py
+#
+# Сравнивает память на одного пользователя: прежний список словарей с полными
+# текстами анализа в context.user_data['logs'] против DayLog.
+# Запуск: python -m benchmarks.day_log_memory
+
+import tracemalloc
+
+from day_log import DayLog
+
+ENTRIES_PER_DAY = 12
+USERS = 1000
+
+SAMPLE_ANALYSIS = (
+    "[АНАЛИЗ]\nОвсяная каша на молоке с бананом и грецкими орехами. "
+    "Порция около 300 г, банан среднего размера, горсть орехов.\n[/АНАЛИЗ]\n"
+    "[НУТРИЕНТЫ]\nКалории: 520 ккал\nБелки: 16 г\nЖиры: 19 г\nУглеводы: 72 г\n[/НУТРИЕНТЫ]\n"
+    "[РЕКОМЕНДАЦИИ]\n1. Добавьте источник белка, например творог или яйцо.\n"
+    "2. Следите за размером порции орехов.\n3. Пейте достаточно воды.\n[/РЕКОМЕНДАЦИИ]"
+)
+
+
+def legacy_logs(user: int) -> list:
+    # Каждый ответ LLM — отдельная строка, как и в реальной работе бота
+    return [
+        {'type': 'meal', 'meal_type': 'Завтрак', 'analysis': SAMPLE_ANALYSIS + f" #{user}-{i}"}
+        for i in range(ENTRIES_PER_DAY)
+    ]
+
+
+def compact_logs(user: int) -> DayLog:
+    day_log = DayLog()
+    for i in range(ENTRIES_PER_DAY):
+        day_log.add(user * 100 + i, 'Завтрак', {'calories': 520, 'protein': 16, 'fat': 19, 'carbs': 72})
+    return day_log
+
+
+def measure(factory) -> float:
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    data = [factory(user) for user in range(USERS)]
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del data
+    return (after - before) / USERS
+
+
+if __name__ == '__main__':
+    legacy = measure(legacy_logs)
+    compact = measure(compact_logs)
+    print(f"Записей в дне: {ENTRIES_PER_DAY}, пользователей: {USERS}")
+    print(f"list[dict] с текстами: {legacy:,.0f} байт на пользователя")
+    print(f"DayLog:                {compact:,.0f} байт на пользователя")
+    print(f"Экономия:              {legacy / compact:.1f}x")
@@ -0,0 +1,49 @@
+# benchmarks/import_time.py
+#
+# Замеряет время холодного импорта модулей бота в отдельных процессах
+# (python -X importtime) и показывает самые тяжелые зависимости.
+# Запуск: python -m benchmarks.import_time [модуль ...]
+
+import re
+import subprocess
+import sys
+
+DEFAULT_MODULES = ['config', 'models', 'openai_utils', 'handlers.tracking', 'handlers.history', 'bot']
+RUNS = 5
+TOP = 10
+
+_LINE = re.compile(r'import time:\s+(\d+) \|\s+(\d+) \|(\s*)(\S+)')
+
+
+def import_profile(module: str) -> dict[str, int]:
+    """Возвращает кумулятивное время импорта (мкс) для каждого загруженного модуля"""
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        capture_output=True, text=True
+    )
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1])
+    profile = {}
+    for line in result.stderr.splitlines():
+        match = _LINE.match(line)
+        if match:
+            profile[match.group(4)] = int(match.group(2))
+    return profile
+
+
+def main(modules: list[str]) -> None:
+    for module in modules:
+        try:
+            runs = [import_profile(module) for _ in range(RUNS)]
+        except RuntimeError as e:
+            print(f"{module}: не импортируется ({e})")
+            continue
+        totals = sorted(run[module] for run in runs)
+        print(f"\n{module}: медиана {totals[len(totals) // 2] / 1000:.1f} мс (из {RUNS} запусков)")
+        heaviest = sorted(runs[-1].items(), key=lambda item: item[1], reverse=True)
+        for name, cumulative in [item for item in heaviest if item[0] != module][:TOP]:
+            print(f"  {cumulative / 1000:8.1f} мс  {name}")
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:] or DEFAULT_MODULES)
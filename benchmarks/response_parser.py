@@ -0,0 +1,84 @@
+# benchmarks/response_parser.py
+#
+# Сравнивает разбор ответа LLM прежними функциями (четыре re.search в
+# format_analysis_for_user + extract_nutrients + регулярки итогов дня)
+# с однопроходным parse_response.
+# Запуск: python -m benchmarks.response_parser
+
+import re
+import timeit
+
+from response_parser import parse_response
+
+NUMBER = 20000
+
+SAMPLE_MEAL = (
+    "[АНАЛИЗ]\nОвсяная каша на молоке с бананом и грецкими орехами. "
+    "Порция около 300 г, банан среднего размера, горсть орехов.\n[/АНАЛИЗ]\n"
+    "[НУТРИЕНТЫ]\nКалории: 520 ккал\nБелки: 16 г\nЖиры: 19 г\nУглеводы: 72 г\n[/НУТРИЕНТЫ]\n"
+    "[РЕКОМЕНДАЦИИ]\n1. Добавьте источник белка, например творог или яйцо.\n"
+    "2. Следите за размером порции орехов.\n3. Пейте достаточно воды.\n[/РЕКОМЕНДАЦИИ]"
+)
+
+
+# Прежняя реализация из handlers/tracking.py
+def legacy_sections(analysis: str) -> list:
+    return [
+        re.search(r'\[АНАЛИЗ\](.*?)\[/АНАЛИЗ\]', analysis, re.DOTALL),
+        re.search(r'\[НУТРИЕНТЫ\](.*?)\[/НУТРИЕНТЫ\]', analysis, re.DOTALL),
+        re.search(r'\[КАЛОРИИ\](.*?)\[/КАЛОРИИ\]', analysis, re.DOTALL),
+        re.search(r'\[РЕКОМЕНДАЦИИ\](.*?)\[/РЕКОМЕНДАЦИИ\]', analysis, re.DOTALL),
+    ]
+
+
+def legacy_nutrients(analysis: str) -> dict:
+    start = analysis.find('[НУТРИЕНТЫ]')
+    end = analysis.find('[/НУТРИЕНТЫ]')
+    nutrients = {'calories': 0, 'protein': 0, 'fat': 0, 'carbs': 0}
+    if start == -1 or end == -1:
+        return nutrients
+    for line in analysis[start:end].split('\n'):
+        line = line.strip()
+        if 'Калории:' in line:
+            nutrients['calories'] = int(line.split(':')[1].replace('ккал', '').strip())
+        elif 'Белки:' in line:
+            nutrients['protein'] = int(line.split(':')[1].replace('г', '').strip())
+        elif 'Жиры:' in line:
+            nutrients['fat'] = int(line.split(':')[1].replace('г', '').strip())
+        elif 'Углеводы:' in line:
+            nutrients['carbs'] = int(line.split(':')[1].replace('г', '').strip())
+    return nutrients
+
+
+def legacy(analysis: str):
+    # Ответ на прием пищи: форматирование, нутриенты и описание для итогов дня
+    legacy_sections(analysis)
+    legacy_nutrients(analysis)
+    re.search(r'\[АНАЛИЗ\](.*?)\[', analysis)
+
+
+def single_pass(analysis: str):
+    parsed = parse_response.__wrapped__(analysis)
+    parsed.nutrients
+    parsed.section('АНАЛИЗ')
+
+
+def cached(analysis: str):
+    parsed = parse_response(analysis)
+    parsed.nutrients
+    parsed.section('АНАЛИЗ')
+
+
+def main() -> None:
+    assert parse_response(SAMPLE_MEAL).nutrients == legacy_nutrients(SAMPLE_MEAL)
+    results = {}
+    for name, func in (('прежний разбор', legacy), ('один проход', single_pass), ('один проход + кэш', cached)):
+        seconds = min(timeit.repeat(lambda: func(SAMPLE_MEAL), number=NUMBER, repeat=5))
+        results[name] = seconds / NUMBER * 1e6
+    baseline = results['прежний разбор']
+    for name, micros in results.items():
+        print(f"{name:<20} {micros:8.2f} мкс/ответ  x{baseline / micros:.1f}")
+
+
+if __name__ == '__main__':
+    main()
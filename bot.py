@@ -3,11 +3,11 @@
 import logging
 import asyncio
 from telegram import Update, BotCommand
+from telegram.error import RetryAfter
 from telegram.ext import Application, CommandHandler, ContextTypes
+from admission import OVERLOADED_MESSAGE, Overloaded, admission
 import config
-from handlers.survey import register_survey_handlers
-from handlers.tracking import register_tracking_handlers
-from handlers.history import register_history_handlers
+import nutrition_db
 
 # 1) Включаем глобальное DEBUG-логирование
 logging.basicConfig(
@@ -19,9 +19,13 @@ logger = logging.getLogger(__name__)
 # 2) Глобальный обработчик ошибок
 async def global_error_handler(update: object, context: ContextTypes.DEFAULT_TYPE):
     logger.error("Exception while handling update:", exc_info=context.error)
+    if isinstance(context.error, RetryAfter):
+        # Очередь отправки исчерпала повторы: еще одно сообщение только продлит ограничение
+        return
     if update and hasattr(update, 'effective_message'):
         await update.effective_message.reply_text(
-            "Произошла ошибка при обработке запроса. Пожалуйста, попробуйте позже."
+            OVERLOADED_MESSAGE if isinstance(context.error, Overloaded)
+            else "Произошла ошибка при обработке запроса. Пожалуйста, попробуйте позже."
         )
 
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -32,6 +36,7 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
         "🔹 /start\_day - Начать новый день\n"
         "🔹 /history - Просмотр истории питания\n"
         "🔹 /analyze\_period - Анализ за период\n"
+        "🔹 /search - Поиск по истории\n"
         "🔹 /help - Показать это сообщение\n\n"
         "📝 *Во время активного дня доступно:*\n\n"
         "• Добавление приемов пищи\n"
@@ -50,13 +55,45 @@ async def setup_commands(application: Application) -> None:
         BotCommand("start_day", "Начать новый день"),
         BotCommand("history", "Просмотр истории питания"),
         BotCommand("analyze_period", "Анализ за период"),
+        BotCommand("search", "Поиск по истории"),
         BotCommand("help", "Показать помощь")
     ]
     await application.bot.set_my_commands(commands)
 
-def run_bot():
-    """Запускает бота"""
-    app = Application.builder().token(config.TELEGRAM_TOKEN).build()
+def create_app(requests=None) -> Application:
+    """
+    Фабрика приложения: применяет миграции схемы БД, создает Application
+    и регистрирует обработчики. Модули обработчиков импортируются здесь,
+    а не при импорте bot.py. requests — пара (request, get_updates_request)
+    вместо настоящих HTTP-клиентов Telegram (так работает traffic_replay).
+    """
+    from migrations import migrate
+    from jobs import runner
+    from handlers.survey import register_survey_handlers
+    from handlers.tracking import register_tracking_handlers, resume_deferred_summaries
+    from handlers.history import register_history_handlers
+    from handlers.search import register_search_handlers
+    from handlers.admin import register_admin_handlers
+    from http_clients import telegram_requests
+    from send_queue import SendQueue
+    from archive import archive_sweep
+    from user_state import register_user_state
+    from transcription import transcriber
+    from usage_ledger import ledger
+    from profiling import install_signal_handler
+
+    migrate()
+
+    # Пулы соединений и таймауты Telegram настраиваются в config (см. http_clients)
+    request, get_updates_request = requests or telegram_requests()
+    app = (
+        Application.builder()
+        .token(config.TELEGRAM_TOKEN)
+        .request(request)
+        .get_updates_request(get_updates_request)
+        .rate_limiter(SendQueue())
+        .build()
+    )
     
     # Регистрируем глобальный error handler
     app.add_error_handler(global_error_handler)
@@ -68,12 +105,56 @@ def run_bot():
     register_survey_handlers(app)
     register_tracking_handlers(app)
     register_history_handlers(app)
+    register_search_handlers(app)
+    register_admin_handlers(app)
+
+    # Перенос старых дней в сжатый архив
+    runner.every('archive_sweep', config.ARCHIVE_INTERVAL, archive_sweep, first_delay=300)
+
+    # Пересчет уровня деградации, даже когда запросов к LLM нет
+    runner.every('admission_tick', config.ADMISSION_RECOVERY_SECONDS / 2, admission.tick)
+
+    # Журнал расхода LLM: запись буфера пачками и очистка старых записей по вызовам
+    runner.every('usage_flush_periodic', config.LEDGER_FLUSH_INTERVAL, ledger.flush)
+    runner.every('usage_prune', 24 * 3600, ledger.prune, first_delay=600)
+
+    # Учет активности и выгрузка состояния неактивных пользователей
+    register_user_state(app)
+
+    # Запись входящего трафика для воспроизведения нагрузки (по умолчанию выключена)
+    if config.TRAFFIC_RECORD_PATH:
+        from traffic_recorder import register_recorder
+        register_recorder(app)
     
-    # Устанавливаем команды бота при запуске
+    # Устанавливаем команды бота и запускаем фоновые задачи при запуске
     async def post_init(application: Application) -> None:
         await setup_commands(application)
+        await runner.start()
+        # Модель распознавания речи загружается в фоне: запуск бота ее не ждет
+        runner.submit('voice_warm_up', transcriber.start)
+        # Рекомендации по итогам дня, отложенные до перезапуска, ставятся в очередь заново
+        runner.submit('day_end_resume', resume_deferred_summaries, application)
+        # kill -USR1 <pid> включает профилирование (см. также /profile)
+        install_signal_handler(application)
+
+    async def post_shutdown(application: Application) -> None:
+        await ledger.flush()
+        await runner.stop()
+        transcriber.close()
+        if config.TRAFFIC_RECORD_PATH:
+            from traffic_recorder import recorder
+            recorder.close()
     
     app.post_init = post_init
+    app.post_shutdown = post_shutdown
+    return app
+
+def run_bot():
+    """Запускает бота"""
+    app = create_app()
+
+    # Справочник продуктов загружаем заранее, чтобы первая запись не ждала сборки индекса
+    nutrition_db.load()
     
     logger.info("Bot started")
     app.run_polling(allowed_updates=Update.ALL_TYPES)
@@ -0,0 +1,249 @@
+# bulk_io.py
+#
+# Выгрузка и загрузка users/daily_logs в колоночном формате (Parquet или Arrow IPC)
+# для аналитики и переноса данных между базами.
+# Запуск:
+#   python -m bulk_io export <каталог> [--format parquet|arrow] [--chunk-size N]
+#   python -m bulk_io import <каталог> [--format parquet|arrow] [--chunk-size N] [--append]
+
+import argparse
+import json
+import logging
+import os
+import time
+
+from sqlalchemy import Column, Date, DateTime, Integer, MetaData, Table, Text, func, select
+
+from config import BULK_CHUNK_SIZE
+from database import engine
+import models
+
+logger = logging.getLogger(__name__)
+
+FORMATS = {'parquet': '.parquet', 'arrow': '.arrow'}
+
+# Те же таблицы, но JSON-колонки читаются и пишутся как текст: без лишнего
+# разбора и повторной сериализации каждой строки
+_metadata = MetaData()
+_tables = {
+    'users': Table(
+        'users', _metadata,
+        Column('id', Integer, primary_key=True),
+        Column('telegram_id', Integer),
+        Column('user_info', Text),
+    ),
+    'daily_logs': Table(
+        'daily_logs', _metadata,
+        Column('id', Integer, primary_key=True),
+        Column('telegram_id', Integer),
+        Column('date', Date),
+        Column('time', DateTime),
+        Column('data', Text),
+    ),
+}
+# Индексы, которые снимаются на время загрузки и строятся заново после нее
+_ORM_TABLES = {'users': models.User.__table__, 'daily_logs': models.DailyLog.__table__}
+
+
+def _pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.ipc
+        import pyarrow.parquet
+    except ImportError:
+        raise SystemExit("Для выгрузки и загрузки нужен пакет pyarrow: pip install pyarrow")
+    return pyarrow
+
+
+def _schema(pa, name: str):
+    if name == 'users':
+        return pa.schema([
+            ('id', pa.int64()), ('telegram_id', pa.int64()), ('user_info', pa.large_string()),
+        ])
+    return pa.schema([
+        ('id', pa.int64()), ('telegram_id', pa.int64()), ('date', pa.date32()),
+        ('time', pa.timestamp('us')), ('data', pa.large_string()),
+    ])
+
+
+class _Writer:
+    """Пишет пачки строк в один файл Parquet или Arrow IPC"""
+
+    def __init__(self, pa, path: str, schema, file_format: str):
+        self.pa = pa
+        self.schema = schema
+        self.rows = 0
+        if file_format == 'parquet':
+            self._writer = pa.parquet.ParquetWriter(path, schema, compression='zstd')
+        else:
+            self._sink = pa.OSFile(path, 'wb')
+            self._writer = pa.ipc.new_file(self._sink, schema)
+
+    def write(self, columns: dict[str, list]) -> None:
+        batch = self.pa.RecordBatch.from_pydict(columns, schema=self.schema)
+        self._writer.write_batch(batch)
+        self.rows += batch.num_rows
+
+    def close(self) -> None:
+        self._writer.close()
+        if hasattr(self, '_sink'):
+            self._sink.close()
+
+
+def _columns(rows, names: tuple[str, ...]) -> dict[str, list]:
+    return {name: [row[i] for row in rows] for i, name in enumerate(names)}
+
+
+def _export_archive(writer: _Writer, connection, chunk_size: int) -> None:
+    """Записи из архива выгружаются вместе с горячими, в той же схеме"""
+    from archive import unpack
+
+    result = connection.execution_options(stream_results=True, yield_per=chunk_size).execute(
+        select(models.DailyLogArchive.__table__).order_by(models.DailyLogArchive.id)
+    )
+    rows = []
+    # Строки результата дают те же атрибуты (codec, payload, telegram_id, date), что и модель
+    for block in result:
+        for log in unpack(block):
+            rows.append((log.id, log.telegram_id, log.date, log.time, json.dumps(log.data, ensure_ascii=False)))
+        if len(rows) >= chunk_size:
+            writer.write(_columns(rows, ('id', 'telegram_id', 'date', 'time', 'data')))
+            rows = []
+    if rows:
+        writer.write(_columns(rows, ('id', 'telegram_id', 'date', 'time', 'data')))
+
+
+def export_tables(directory: str, file_format: str = 'parquet', chunk_size: int = BULK_CHUNK_SIZE) -> dict:
+    """Выгружает таблицы потоково, пачками по chunk_size строк: память не растет с размером базы"""
+    pa = _pyarrow()
+    os.makedirs(directory, exist_ok=True)
+    counts = {}
+    with engine.connect() as connection:
+        for name, table in _tables.items():
+            path = os.path.join(directory, name + FORMATS[file_format])
+            writer = _Writer(pa, path, _schema(pa, name), file_format)
+            started = time.perf_counter()
+            try:
+                result = connection.execution_options(stream_results=True, yield_per=chunk_size).execute(
+                    select(table).order_by(table.c.id)
+                )
+                for rows in result.partitions(chunk_size):
+                    writer.write(_columns(rows, tuple(table.c.keys())))
+                if name == 'daily_logs':
+                    _export_archive(writer, connection, chunk_size)
+            finally:
+                writer.close()
+            counts[name] = writer.rows
+            logger.info("%s: %d строк за %.1f с -> %s", name, writer.rows, time.perf_counter() - started, path)
+    return counts
+
+
+def _read_batches(pa, path: str, file_format: str, chunk_size: int):
+    if file_format == 'parquet':
+        yield from pa.parquet.ParquetFile(path).iter_batches(batch_size=chunk_size)
+        return
+    with pa.memory_map(path) as source:
+        reader = pa.ipc.open_file(source)
+        for i in range(reader.num_record_batches):
+            yield reader.get_batch(i)
+
+
+def import_tables(directory: str, file_format: str = 'parquet', chunk_size: int = BULK_CHUNK_SIZE,
+                  append: bool = False) -> dict:
+    """
+    Загружает таблицы пачками через executemany. Вторичные индексы снимаются на время
+    загрузки и строятся заново в конце — одна сортировка вместо обновления на каждой строке.
+    По умолчанию id сохраняются и таблицы должны быть пустыми; с append id назначает база,
+    а пользователи, которые в базе уже есть (по telegram_id), пропускаются — их профиль не меняется.
+    Записи таких пользователей, уже лежащие в базе (тот же telegram_id, дата и время), тоже
+    пропускаются, поэтому повторная загрузка той же выгрузки не дублирует историю.
+    """
+    pa = _pyarrow()
+    counts = {}
+    existing_users: set[int] = set()
+    with engine.connect() as connection:
+        if engine.dialect.name == 'sqlite':
+            # Без fsync на каждую страницу: загрузка идет одной транзакцией и при сбое повторяется целиком
+            connection.exec_driver_sql('PRAGMA synchronous=OFF')
+            connection.commit()
+
+        for name, table in _tables.items():
+            path = os.path.join(directory, name + FORMATS[file_format])
+            if not os.path.exists(path):
+                logger.warning("Файл %s не найден, таблица %s пропущена", path, name)
+                continue
+            if not append and connection.execute(select(func.count()).select_from(table)).scalar():
+                raise SystemExit(f"Таблица {name} не пуста: используйте --append или пустую базу")
+
+            existing_logs = set()
+            if name == 'daily_logs' and existing_users:
+                # Читается до снятия индексов: выборка идет по индексу (telegram_id, date)
+                ids = sorted(existing_users)
+                for i in range(0, len(ids), 500):
+                    existing_logs.update(tuple(row) for row in connection.execute(
+                        select(table.c.telegram_id, table.c.date, table.c.time).where(
+                            table.c.telegram_id.in_(ids[i:i + 500])
+                        )
+                    ))
+
+            indexes = list(_ORM_TABLES[name].indexes)
+            for index in indexes:
+                index.drop(connection, checkfirst=True)
+
+            started = time.perf_counter()
+            counts[name] = 0
+            skipped = 0
+            for batch in _read_batches(pa, path, file_format, chunk_size):
+                rows = batch.to_pylist()
+                if append:
+                    for row in rows:
+                        row.pop('id', None)
+                if append and name == 'users':
+                    existing = set(connection.execute(select(table.c.telegram_id).where(
+                        table.c.telegram_id.in_([row['telegram_id'] for row in rows])
+                    )).scalars())
+                    existing_users |= existing
+                    skipped += len(rows)
+                    rows = [row for row in rows if row['telegram_id'] not in existing]
+                    skipped -= len(rows)
+                elif existing_logs:
+                    skipped += len(rows)
+                    rows = [row for row in rows if (row['telegram_id'], row['date'], row['time']) not in existing_logs]
+                    skipped -= len(rows)
+                if rows:
+                    connection.execute(table.insert(), rows)
+                counts[name] += len(rows)
+            if skipped:
+                logger.info("%s: пропущено уже существующих строк: %d", name, skipped)
+
+            for index in indexes:
+                index.create(connection)
+            logger.info("%s: %d строк за %.1f с", name, counts[name], time.perf_counter() - started)
+        connection.commit()
+    return counts
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Выгрузка и загрузка данных бота")
+    parser.add_argument('command', choices=('export', 'import'))
+    parser.add_argument('directory')
+    parser.add_argument('--format', choices=tuple(FORMATS), default='parquet')
+    parser.add_argument('--chunk-size', type=int, default=BULK_CHUNK_SIZE)
+    parser.add_argument('--append', action='store_true', help="загрузить в непустые таблицы с новыми id")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if args.command == 'export':
+        counts = export_tables(args.directory, args.format, args.chunk_size)
+    else:
+        from migrations import migrate
+        migrate()
+        counts = import_tables(args.directory, args.format, args.chunk_size, args.append)
+        # Загрузка идет мимо событий ORM, поэтому поисковый индекс строится заново
+        from search_index import rebuild_index
+        counts['search_index'] = rebuild_index()
+    print(counts)
+
+
+if __name__ == '__main__':
+    main()
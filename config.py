@@ -5,3 +5,132 @@ load_dotenv()
 
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///fitness_bot.db")
+
+# Модели для маршрутизации запросов (см. openai_utils.ROUTES)
+OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-4o-mini")
+OPENAI_MODEL_CHEAP = os.getenv("OPENAI_MODEL_CHEAP", "gpt-4.1-nano")
+OPENAI_MODEL_VISION = os.getenv("OPENAI_MODEL_VISION", "gpt-4o")
+
+# Семантический кэш ответов на вопросы и рекомендации
+SEMANTIC_CACHE_TTL = int(os.getenv("SEMANTIC_CACHE_TTL", "21600"))
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.9"))
+SEMANTIC_CACHE_SIZE = int(os.getenv("SEMANTIC_CACHE_SIZE", "20000"))
+
+# Бюджет токенов OpenAI: общий (уточняется по заголовкам провайдера) и на пользователя
+LLM_TOKENS_PER_MINUTE = int(os.getenv("LLM_TOKENS_PER_MINUTE", "200000"))
+LLM_USER_TOKENS_PER_MINUTE = int(os.getenv("LLM_USER_TOKENS_PER_MINUTE", "20000"))
+LLM_USER_BURST_TOKENS = int(os.getenv("LLM_USER_BURST_TOKENS", "40000"))
+
+# Контроль допуска и деградация при перегрузке (см. admission.py).
+# Пороги давления для уровней 1..5: без рекомендаций, короткая история, дешевая модель,
+# отложенные итоги дня, отказ
+ADMISSION_LATENCY_TARGET = float(os.getenv("ADMISSION_LATENCY_TARGET", "10"))
+ADMISSION_MAX_INFLIGHT = int(os.getenv("ADMISSION_MAX_INFLIGHT", "40"))
+ADMISSION_THRESHOLDS = tuple(float(x) for x in os.getenv("ADMISSION_THRESHOLDS", "1,1.5,2,2.5,3.5").split(','))
+ADMISSION_RECOVERY_SECONDS = float(os.getenv("ADMISSION_RECOVERY_SECONDS", "30"))
+ADMISSION_PROBE_INTERVAL = float(os.getenv("ADMISSION_PROBE_INTERVAL", "5"))
+ADMISSION_SHORT_HISTORY = int(os.getenv("ADMISSION_SHORT_HISTORY", "3"))
+ADMISSION_DEGRADED_MAX_TOKENS = int(os.getenv("ADMISSION_DEGRADED_MAX_TOKENS", "500"))
+
+# Журнал расхода LLM (usage_ledger.py) и администраторы бота (/usage)
+LEDGER_BATCH_SIZE = int(os.getenv("LEDGER_BATCH_SIZE", "200"))
+LEDGER_FLUSH_INTERVAL = int(os.getenv("LEDGER_FLUSH_INTERVAL", "30"))
+LEDGER_MAX_BUFFER = int(os.getenv("LEDGER_MAX_BUFFER", "50000"))
+LEDGER_RAW_RETENTION_DAYS = int(os.getenv("LEDGER_RAW_RETENTION_DAYS", "30"))
+ADMIN_IDS = {int(x) for x in os.getenv("ADMIN_IDS", "").split(',') if x.strip()}
+
+# Фоновые задачи: итоги дня и автозакрытие незавершенных дней
+JOBS_CONCURRENCY = int(os.getenv("JOBS_CONCURRENCY", "4"))
+JOBS_MAX_ATTEMPTS = int(os.getenv("JOBS_MAX_ATTEMPTS", "3"))
+JOBS_RETRY_DELAY = float(os.getenv("JOBS_RETRY_DELAY", "5"))
+DEFAULT_TIMEZONE = os.getenv("DEFAULT_TIMEZONE", "Europe/Moscow")
+AUTO_CLOSE_INTERVAL = int(os.getenv("AUTO_CLOSE_INTERVAL", "900"))
+AUTO_CLOSE_LOOKBACK_DAYS = int(os.getenv("AUTO_CLOSE_LOOKBACK_DAYS", "30"))
+AUTO_CLOSE_BATCH_SIZE = int(os.getenv("AUTO_CLOSE_BATCH_SIZE", "100"))
+
+# HTTP-пулы для OpenAI и Telegram
+HTTP2_ENABLED = os.getenv("HTTP2_ENABLED", "1") == "1"
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "30"))
+OPENAI_POOL_SIZE = int(os.getenv("OPENAI_POOL_SIZE", "50"))
+OPENAI_KEEPALIVE_CONNECTIONS = int(os.getenv("OPENAI_KEEPALIVE_CONNECTIONS", "20"))
+OPENAI_CONNECT_TIMEOUT = float(os.getenv("OPENAI_CONNECT_TIMEOUT", "5"))
+OPENAI_POOL_TIMEOUT = float(os.getenv("OPENAI_POOL_TIMEOUT", "10"))
+OPENAI_TIMEOUTS = {
+    'photo': float(os.getenv("OPENAI_TIMEOUT_PHOTO", "60")),
+    'text': float(os.getenv("OPENAI_TIMEOUT_TEXT", "30")),
+    'summary': float(os.getenv("OPENAI_TIMEOUT_SUMMARY", "60")),
+    'default': float(os.getenv("OPENAI_TIMEOUT_DEFAULT", "45")),
+}
+TELEGRAM_POOL_SIZE = int(os.getenv("TELEGRAM_POOL_SIZE", "64"))
+TELEGRAM_CONNECT_TIMEOUT = float(os.getenv("TELEGRAM_CONNECT_TIMEOUT", "5"))
+TELEGRAM_READ_TIMEOUT = float(os.getenv("TELEGRAM_READ_TIMEOUT", "10"))
+TELEGRAM_WRITE_TIMEOUT = float(os.getenv("TELEGRAM_WRITE_TIMEOUT", "20"))
+TELEGRAM_POOL_TIMEOUT = float(os.getenv("TELEGRAM_POOL_TIMEOUT", "3"))
+TELEGRAM_POLL_READ_TIMEOUT = float(os.getenv("TELEGRAM_POLL_READ_TIMEOUT", "30"))
+
+# Очередь исходящих сообщений Telegram (лимиты Bot API)
+TELEGRAM_GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", "30"))
+TELEGRAM_CHAT_RATE = float(os.getenv("TELEGRAM_CHAT_RATE", "1"))
+TELEGRAM_CHAT_BURST = int(os.getenv("TELEGRAM_CHAT_BURST", "3"))
+TELEGRAM_GROUP_RATE_PER_MINUTE = float(os.getenv("TELEGRAM_GROUP_RATE_PER_MINUTE", "20"))
+TELEGRAM_SEND_MAX_RETRIES = int(os.getenv("TELEGRAM_SEND_MAX_RETRIES", "3"))
+
+# Кэш отрисованных отчетов истории за день
+REPORT_CACHE_MAX_BYTES = int(os.getenv("REPORT_CACHE_MAX_BYTES", str(16 * 1024 * 1024)))
+# Как часто отчет сверяется с БД на случай записей, добавленных мимо ORM (bulk_io)
+REPORT_CACHE_RECHECK_SECONDS = float(os.getenv("REPORT_CACHE_RECHECK_SECONDS", "60"))
+
+# Архив старых записей DailyLog
+ARCHIVE_AFTER_DAYS = int(os.getenv("ARCHIVE_AFTER_DAYS", "90"))
+ARCHIVE_BATCH_SIZE = int(os.getenv("ARCHIVE_BATCH_SIZE", "200"))
+ARCHIVE_INTERVAL = int(os.getenv("ARCHIVE_INTERVAL", "21600"))
+ARCHIVE_ZSTD_LEVEL = int(os.getenv("ARCHIVE_ZSTD_LEVEL", "10"))
+
+# Выгрузка и загрузка данных (python -m bulk_io)
+BULK_CHUNK_SIZE = int(os.getenv("BULK_CHUNK_SIZE", "50000"))
+
+# Локальное распознавание голосовых сообщений (faster-whisper)
+VOICE_MODEL = os.getenv("VOICE_MODEL", "base")
+VOICE_LANGUAGE = os.getenv("VOICE_LANGUAGE", "ru")
+VOICE_WORKERS = int(os.getenv("VOICE_WORKERS", "1"))
+VOICE_CPU_THREADS = int(os.getenv("VOICE_CPU_THREADS", "2"))
+VOICE_BATCH_SIZE = int(os.getenv("VOICE_BATCH_SIZE", "4"))
+VOICE_BATCH_WINDOW = float(os.getenv("VOICE_BATCH_WINDOW", "0.05"))
+VOICE_MAX_DURATION = int(os.getenv("VOICE_MAX_DURATION", "120"))
+
+# Полнотекстовый поиск по истории (/search)
+SEARCH_PAGE_SIZE = int(os.getenv("SEARCH_PAGE_SIZE", "5"))
+
+# Пакетный пересчет норм (python -m goal_recompute)
+GOAL_RECOMPUTE_BATCH_SIZE = int(os.getenv("GOAL_RECOMPUTE_BATCH_SIZE", "5000"))
+
+# Локальное хранилище фото приемов пищи
+PHOTO_STORE_DIR = os.getenv("PHOTO_STORE_DIR", "data/photos")
+PHOTO_THUMB_SIZE = int(os.getenv("PHOTO_THUMB_SIZE", "320"))
+PHOTO_VISION_SIZE = int(os.getenv("PHOTO_VISION_SIZE", "1024"))
+PHOTO_JPEG_QUALITY = int(os.getenv("PHOTO_JPEG_QUALITY", "80"))
+
+# Выгрузка состояния неактивных пользователей из памяти
+CONVERSATION_TIMEOUT = int(os.getenv("CONVERSATION_TIMEOUT", "1800"))
+USER_STATE_TTL = int(os.getenv("USER_STATE_TTL", "21600"))
+IDLE_SWEEP_INTERVAL = int(os.getenv("IDLE_SWEEP_INTERVAL", "600"))
+
+# Запись входящих обновлений для воспроизведения нагрузки (python -m traffic_replay).
+# Пустой путь — запись выключена; каждый запуск пишет свой файл с меткой времени и pid
+# рядом с этим путем. Без TRAFFIC_SALT соль псевдонимов новая при каждом запуске
+TRAFFIC_RECORD_PATH = os.getenv("TRAFFIC_RECORD_PATH", "")
+TRAFFIC_SALT = os.getenv("TRAFFIC_SALT", "")
+TRAFFIC_KEEP_TEXT = os.getenv("TRAFFIC_KEEP_TEXT", "0") == "1"
+TRAFFIC_FLUSH_INTERVAL = int(os.getenv("TRAFFIC_FLUSH_INTERVAL", "10"))
+
+# Профилирование по запросу (/profile и сигнал SIGUSR1, см. profiling.py)
+PROFILE_DIR = os.getenv("PROFILE_DIR", "data/profiles")
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", "0.005"))
+PROFILE_DEFAULT_SECONDS = int(os.getenv("PROFILE_DEFAULT_SECONDS", "30"))
+PROFILE_MAX_SECONDS = int(os.getenv("PROFILE_MAX_SECONDS", "600"))
+PROFILE_TOP_ALLOCATIONS = int(os.getenv("PROFILE_TOP_ALLOCATIONS", "30"))
+
+# Упреждающая загрузка данных для следующего шага пользователя (см. prefetch.py)
+PREFETCH_ENABLED = os.getenv("PREFETCH_ENABLED", "1") == "1"
+PREFETCH_TTL = int(os.getenv("PREFETCH_TTL", "300"))
@@ -0,0 +1,124 @@
+# day_log.py
+
+from dataclasses import dataclass
+from enum import IntEnum
+
+from database import Session
+from models import DailyLog
+
+
+class MealType(IntEnum):
+    """Тип записи дня; подписи совпадают с MEAL_TYPES и ключами разбивки итогов"""
+    BREAKFAST = 0
+    LUNCH = 1
+    DINNER = 2
+    SNACK = 3
+    ACTIVITY = 4
+    OTHER = 5
+    QUERY = 6
+
+    @property
+    def label(self) -> str:
+        return _LABELS[self]
+
+    @classmethod
+    def from_label(cls, label: str | None) -> 'MealType':
+        return _BY_LABEL.get(label, cls.OTHER)
+
+
+_LABELS = {
+    MealType.BREAKFAST: 'Завтрак',
+    MealType.LUNCH: 'Обед',
+    MealType.DINNER: 'Ужин',
+    MealType.SNACK: 'Перекус',
+    MealType.ACTIVITY: 'Физическая активность',
+    MealType.OTHER: 'Прием пищи',
+    MealType.QUERY: 'Запрос к ассистенту',
+}
+_BY_LABEL = {label: meal_type for meal_type, label in _LABELS.items()}
+
+
+@dataclass(slots=True)
+class LogEntry:
+    """
+    Запись дня в памяти: ссылка на строку DailyLog и разобранные числа.
+    Полный текст анализа хранится только в БД и загружается по требованию.
+    """
+    log_id: int
+    meal_type: MealType
+    calories: int = 0
+    protein: int = 0
+    fat: int = 0
+    carbs: int = 0
+    burned: int = 0
+
+
+class DayLog:
+    """Записи активного дня пользователя"""
+
+    __slots__ = ('entries',)
+
+    def __init__(self):
+        self.entries: list[LogEntry] = []
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def add(self, log_id: int, meal_type: str | None, nutrients: dict | None = None, burned: int = 0) -> LogEntry:
+        nutrients = nutrients or {}
+        entry = LogEntry(
+            log_id,
+            MealType.from_label(meal_type),
+            nutrients.get('calories', 0),
+            nutrients.get('protein', 0),
+            nutrients.get('fat', 0),
+            nutrients.get('carbs', 0),
+            burned,
+        )
+        self.entries.append(entry)
+        return entry
+
+    def add_query(self, log_id: int) -> LogEntry:
+        entry = LogEntry(log_id, MealType.QUERY)
+        self.entries.append(entry)
+        return entry
+
+    def totals(self) -> dict:
+        """Дневные итоги по записям в памяти, без обращения к БД"""
+        totals = {'calories': 0, 'protein': 0, 'fat': 0, 'carbs': 0, 'burned': 0}
+        for entry in self.entries:
+            totals['calories'] += entry.calories
+            totals['protein'] += entry.protein
+            totals['fat'] += entry.fat
+            totals['carbs'] += entry.carbs
+            totals['burned'] += entry.burned
+        return totals
+
+    def load_data(self) -> list[dict]:
+        """Загружает полные записи дня из БД одним запросом, в порядке добавления"""
+        if not self.entries:
+            return []
+        session = Session()
+        rows = dict(session.query(DailyLog.id, DailyLog.data).filter(
+            DailyLog.id.in_([entry.log_id for entry in self.entries])
+        ).all())
+        session.close()
+        return [rows[entry.log_id] for entry in self.entries if entry.log_id in rows]
+
+    def history(self) -> list[str]:
+        """Тексты прошлых ответов за день для контекста LLM"""
+        return history_texts(self.load_data())
+
+
+def history_texts(records: list[dict]) -> list[str]:
+    """Тексты записей дня (DailyLog.data) в том виде, в каком они передаются LLM"""
+    texts = []
+    for data in records:
+        if data.get('type') == 'query':
+            texts.append(f"Вопрос: {data.get('query', '')}\nОтвет: {data.get('response', '')}")
+        else:
+            texts.append(data.get('analysis', ''))
+    return texts
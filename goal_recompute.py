@@ -0,0 +1,207 @@
+# goal_recompute.py
+#
+# Пакетный пересчет дневных норм и системных промптов всех пользователей после
+# изменения коэффициентов в handlers/common.py.
+# Запуск:
+#   python -m goal_recompute [--dry-run] [--batch-size N] [--examples N]
+
+import argparse
+import importlib.util
+import logging
+import time
+
+from sqlalchemy import bindparam, select
+
+from config import GOAL_RECOMPUTE_BATCH_SIZE
+from database import engine
+from handlers.common import (
+    ACTIVITY_MULTIPLIERS, BMR_DEFAULT_OFFSET, BMR_GENDER_OFFSET, DEFAULT_ACTIVITY_MULTIPLIER, DEFAULT_GOALS,
+    DEFAULT_PROTEIN_PER_KG, FAT_PER_KG, GOAL_CALORIE_FACTORS, PROTEIN_PER_KG,
+    build_system_prompt, calculate_daily_goals,
+)
+from models import User
+
+logger = logging.getLogger(__name__)
+
+# Расчет по столбцам идет через numpy; без него — построчно той же функцией, что и в анкете
+NUMPY_AVAILABLE = importlib.util.find_spec('numpy') is not None
+
+PROFILE_FIELDS = ('height', 'weight', 'age', 'gender', 'goal')
+GOAL_KEYS = ('calories', 'protein', 'fat', 'carbs')
+
+_users = User.__table__
+_update = _users.update().where(_users.c.id == bindparam('_id')).values(user_info=bindparam('_user_info'))
+
+
+class _Columns:
+    """Поля профилей пачки пользователей, разложенные по столбцам"""
+
+    def __init__(self):
+        self.height, self.weight, self.age, self.gender, self.goal = [], [], [], [], []
+        self.bmr_offset, self.activity, self.calorie_factor, self.protein_per_kg = [], [], [], []
+
+    def append(self, height: float, weight: float, age: float, info: dict) -> None:
+        self.height.append(height)
+        self.weight.append(weight)
+        self.age.append(age)
+        self.gender.append(info['gender'])
+        self.goal.append(info['goal'])
+        self.bmr_offset.append(BMR_GENDER_OFFSET.get(info['gender'], BMR_DEFAULT_OFFSET))
+        self.activity.append(ACTIVITY_MULTIPLIERS.get(info.get('activity_level'), DEFAULT_ACTIVITY_MULTIPLIER))
+        self.calorie_factor.append(GOAL_CALORIE_FACTORS.get(info['goal'], 1.0))
+        self.protein_per_kg.append(PROTEIN_PER_KG.get(info['goal'], DEFAULT_PROTEIN_PER_KG))
+
+
+def _compute_numpy(columns: _Columns) -> list[tuple[int, int, int, int]]:
+    import numpy as np
+
+    weight = np.asarray(columns.weight, dtype=np.float64)
+    # Порядок операций тот же, что в calculate_daily_goals: результаты совпадают до бита
+    bmr = 10 * weight + 6.25 * np.asarray(columns.height, dtype=np.float64) \
+        - 5 * np.asarray(columns.age, dtype=np.float64) + np.asarray(columns.bmr_offset, dtype=np.float64)
+    tdee = bmr * np.asarray(columns.activity, dtype=np.float64)
+    # int() в скалярной версии отбрасывает дробную часть, то есть округляет к нулю
+    calories = np.trunc(tdee * np.asarray(columns.calorie_factor, dtype=np.float64)).astype(np.int64)
+    protein = np.trunc(np.asarray(columns.protein_per_kg, dtype=np.float64) * weight).astype(np.int64)
+    fat = np.trunc(FAT_PER_KG * weight).astype(np.int64)
+    carbs = np.trunc((calories - (protein * 4 + fat * 9)) / 4).astype(np.int64)
+    return list(zip(calories.tolist(), protein.tolist(), fat.tolist(), carbs.tolist()))
+
+
+def _compute_rows(columns: _Columns) -> list[tuple[int, int, int, int]]:
+    return [
+        calculate_daily_goals(*args)
+        for args in zip(columns.height, columns.weight, columns.age, columns.gender, columns.goal, columns.activity)
+    ]
+
+
+def compute_goals(columns: _Columns) -> list[tuple[int, int, int, int]]:
+    """Нормы (калории, белки, жиры, углеводы) для всех пользователей пачки"""
+    if not columns.weight:
+        return []
+    return _compute_numpy(columns) if NUMPY_AVAILABLE else _compute_rows(columns)
+
+
+def _new_stats() -> dict:
+    return {
+        'users': 0, 'skipped': 0, 'invalid': 0, 'changed': 0, 'goals_changed': 0, 'prompt_changed': 0,
+        'calories_delta_sum': 0, 'calories_delta_min': None, 'calories_delta_max': None, 'examples': [],
+    }
+
+
+def _recompute_batch(rows, stats: dict, examples: int) -> list[dict]:
+    """Пересчитывает пачку и возвращает параметры UPDATE только для изменившихся строк"""
+    profiles, columns, invalid = [], _Columns(), []
+    for user_id, telegram_id, info in rows:
+        stats['users'] += 1
+        info = info or {}
+        if any(info.get(name) is None for name in PROFILE_FIELDS):
+            stats['skipped'] += 1
+            continue
+        try:
+            height, weight, age = float(info['height']), float(info['weight']), float(info['age'])
+        except (TypeError, ValueError):
+            invalid.append((user_id, telegram_id, info))
+            continue
+        columns.append(height, weight, age, info)
+        profiles.append((user_id, telegram_id, info))
+
+    goals = compute_goals(columns)
+    stats['invalid'] += len(invalid)
+    goals.extend([DEFAULT_GOALS] * len(invalid))
+    profiles.extend(invalid)
+
+    updates = []
+    for (user_id, telegram_id, info), (calories, protein, fat, carbs) in zip(profiles, goals):
+        daily_goals = dict(zip(GOAL_KEYS, (calories, protein, fat, carbs)))
+        system_prompt = build_system_prompt(
+            info['height'], info['weight'], info['age'], info['gender'], info['goal'],
+            calories, protein, fat, carbs, info.get('activity_level'), info.get('training_experience')
+        )
+        old_goals = info.get('daily_goals') or {}
+        goals_changed = any(old_goals.get(key) != daily_goals[key] for key in GOAL_KEYS)
+        prompt_changed = info.get('system_prompt') != system_prompt
+        if not goals_changed and not prompt_changed:
+            continue
+
+        stats['changed'] += 1
+        stats['prompt_changed'] += prompt_changed
+        if goals_changed:
+            stats['goals_changed'] += 1
+            delta = calories - (old_goals.get('calories') or 0)
+            stats['calories_delta_sum'] += delta
+            if stats['calories_delta_min'] is None:
+                stats['calories_delta_min'] = stats['calories_delta_max'] = delta
+            stats['calories_delta_min'] = min(stats['calories_delta_min'], delta)
+            stats['calories_delta_max'] = max(stats['calories_delta_max'], delta)
+            if len(stats['examples']) < examples:
+                stats['examples'].append((telegram_id, old_goals, daily_goals))
+        # JSON-колонка записывается целиком: остальные поля профиля сохраняются как есть
+        new_info = {**info, 'daily_goals': daily_goals, 'system_prompt': system_prompt}
+        updates.append({'_id': user_id, '_user_info': new_info})
+    return updates
+
+
+def recompute_goals(dry_run: bool = False, batch_size: int = GOAL_RECOMPUTE_BATCH_SIZE, examples: int = 10) -> dict:
+    """
+    Пересчитывает нормы и промпты всех пользователей пачками по batch_size. Каждая пачка
+    читается и обновляется в одной транзакции, записываются только изменившиеся строки.
+    Уже начатые дни в работающем боте держат старые нормы до следующего /start_day.
+    """
+    stats = _new_stats()
+    started = time.perf_counter()
+    last_id = 0
+    while True:
+        with engine.begin() as connection:
+            query = select(_users.c.id, _users.c.telegram_id, _users.c.user_info).where(
+                _users.c.id > last_id
+            ).order_by(_users.c.id).limit(batch_size)
+            if not dry_run and engine.dialect.name != 'sqlite':
+                # Анкета, заполненная во время пересчета, не должна быть перезаписана
+                query = query.with_for_update()
+            rows = connection.execute(query).all()
+            if not rows:
+                break
+            last_id = rows[-1][0]
+            updates = _recompute_batch(rows, stats, examples)
+            if updates and not dry_run:
+                connection.execute(_update, updates)
+        logger.info("Обработано пользователей: %d, изменено: %d", stats['users'], stats['changed'])
+    stats['elapsed'] = round(time.perf_counter() - started, 2)
+    return stats
+
+
+def format_report(stats: dict, dry_run: bool) -> str:
+    lines = [
+        "Пробный запуск: изменения не записаны" if dry_run else "Изменения записаны",
+        f"Пользователей: {stats['users']}, без анкеты: {stats['skipped']}, "
+        f"с ошибкой в анкете (нормы по умолчанию): {stats['invalid']}",
+        f"Изменится: {stats['changed']} (нормы: {stats['goals_changed']}, промпт: {stats['prompt_changed']})",
+    ]
+    if stats['goals_changed']:
+        lines.append(
+            f"Калории: в среднем {stats['calories_delta_sum'] / stats['goals_changed']:+.0f} ккал, "
+            f"от {stats['calories_delta_min']:+d} до {stats['calories_delta_max']:+d}"
+        )
+    for telegram_id, old, new in stats['examples']:
+        before = '/'.join(str(old.get(key, '-')) for key in GOAL_KEYS)
+        after = '/'.join(str(new[key]) for key in GOAL_KEYS)
+        lines.append(f"  {telegram_id}: {before} -> {after}")
+    lines.append(f"Время: {stats['elapsed']} с, расчет: {'numpy' if NUMPY_AVAILABLE else 'построчно'}")
+    return '\n'.join(lines)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Пересчет дневных норм всех пользователей")
+    parser.add_argument('--dry-run', action='store_true', help="только отчет, без записи в базу")
+    parser.add_argument('--batch-size', type=int, default=GOAL_RECOMPUTE_BATCH_SIZE)
+    parser.add_argument('--examples', type=int, default=10, help="сколько изменений показать в отчете")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    stats = recompute_goals(args.dry_run, args.batch_size, args.examples)
+    print(format_report(stats, args.dry_run))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+# handlers/admin.py
+
+import datetime
+import logging
+from telegram import Update
+from telegram.ext import CommandHandler, ContextTypes
+
+from config import ADMIN_IDS, PROFILE_DEFAULT_SECONDS
+from profiling import profiler
+import usage_ledger
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_USAGE_DAYS = 7
+TOP_USERS = 10
+
+
+def parse_period(args: list[str], today: datetime.date) -> tuple[datetime.date, datetime.date]:
+    """
+    Период для /usage: без аргументов — последние 7 дней, "30" — последние 30 дней,
+    "01.10.2025 31.10.2025" — явный диапазон (одна дата — один день)
+    """
+    if not args:
+        return today - datetime.timedelta(days=DEFAULT_USAGE_DAYS - 1), today
+    if len(args) == 1 and args[0].isdigit():
+        days = int(args[0])
+        if days < 1:
+            raise ValueError(f"Период должен быть не меньше дня: {days}")
+        try:
+            return today - datetime.timedelta(days=days - 1), today
+        except OverflowError:
+            raise ValueError(f"Слишком длинный период: {days}")
+    dates = [datetime.datetime.strptime(arg, '%d.%m.%Y').date() for arg in args[:2]]
+    return min(dates), max(dates)
+
+
+def format_usage_report(start: datetime.date, end: datetime.date) -> str:
+    totals = usage_ledger.totals(start, end)
+    lines = [
+        f"💰 Расход LLM за {start.strftime('%d.%m.%Y')} — {end.strftime('%d.%m.%Y')}",
+        f"Вызовов: {totals['calls']}, токенов: {totals['prompt_tokens']} + {totals['completion_tokens']} "
+        f"(из кэша провайдера: {totals['cached_tokens']})",
+        f"Стоимость: ${totals['cost_usd']:.4f}",
+        f"Активных пользователей: {totals['active_users']}, "
+        f"на пользователя: ${totals['cost_per_user']:.4f}",
+    ]
+
+    flows = usage_ledger.by_flow(start, end)
+    if flows:
+        lines.append("\nПо сценариям:")
+        for flow, calls, cost, avg_latency, max_latency in flows:
+            lines.append(
+                f"• {flow}: {calls} выз., ${cost:.4f}, задержка {avg_latency / 1000:.1f} с "
+                f"(макс. {max_latency / 1000:.1f} с)"
+            )
+
+    top = usage_ledger.top_users(start, end, TOP_USERS)
+    if top:
+        lines.append(f"\nТоп-{len(top)} пользователей:")
+        for i, (telegram_id, calls, tokens, cost) in enumerate(top, 1):
+            lines.append(f"{i}. {telegram_id}: ${cost:.4f}, {calls} выз., {tokens} ток.")
+    return '\n'.join(lines)
+
+
+async def usage_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Отчет о расходе LLM для администраторов: /usage [дней | ДД.ММ.ГГГГ [ДД.ММ.ГГГГ]]"""
+    if update.effective_user.id not in ADMIN_IDS:
+        # Для остальных команда не существует
+        return
+
+    try:
+        start, end = parse_period(context.args or [], datetime.date.today())
+    except ValueError:
+        await update.message.reply_text("Формат: /usage [дней] или /usage ДД.ММ.ГГГГ ДД.ММ.ГГГГ")
+        return
+
+    # Записи из буфера попадают в отчет сразу, а не после очередной пачки
+    await usage_ledger.ledger.flush()
+    await update.message.reply_text(format_usage_report(start, end))
+
+
+def parse_profile_args(args: list[str]) -> tuple[int | None, int | None]:
+    """
+    Длительность для /profile: без аргументов — PROFILE_DEFAULT_SECONDS,
+    "30" или "30s" — секунды, "200u" — число обновлений
+    """
+    if not args:
+        return PROFILE_DEFAULT_SECONDS, None
+    value = args[0].lower()
+    amount = int(value[:-1] if value.endswith('u') else value.removesuffix('s'))
+    if amount < 1:
+        raise ValueError(f"Длительность профилирования должна быть не меньше 1: {value}")
+    return (None, amount) if value.endswith('u') else (amount, None)
+
+
+async def profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Профилирование работающего бота для администраторов: /profile [секунд | Nu | stop]"""
+    if update.effective_user.id not in ADMIN_IDS:
+        return
+
+    if context.args and context.args[0].lower() == 'stop':
+        if not profiler.active:
+            await update.message.reply_text("Профилирование не запущено")
+        else:
+            await profiler.finish()
+        return
+
+    try:
+        seconds, updates = parse_profile_args(context.args or [])
+    except ValueError:
+        await update.message.reply_text("Формат: /profile [секунд], /profile 200u (обновлений) или /profile stop")
+        return
+
+    chat_id = update.effective_chat.id
+
+    async def notify(summary: str, paths: list[str]):
+        await context.bot.send_message(chat_id, summary + "\n\nФайлы:\n" + '\n'.join(paths))
+
+    if not profiler.start(context.application, seconds, updates, notify=notify):
+        await update.message.reply_text("Профилирование уже идет: /profile stop, чтобы завершить")
+        return
+    await update.message.reply_text(
+        f"🔬 Профилирование запущено на {f'{updates} обновлений' if updates else f'{seconds} с'}"
+    )
+
+
+def register_admin_handlers(app):
+    app.add_handler(CommandHandler('usage', usage_command))
+    app.add_handler(CommandHandler('profile', profile_command))
@@ -1,8 +1,36 @@
 # handlers/common.py
 
+import time
 from prompts import AGENT_SYSTEM_PROMPT_TEMPLATE
+import metrics
 
-def calculate_daily_goals(height, weight, age, gender, goal, activity_multiplier=1.2):
+# Повторные нажатия на тяжелые кнопки игнорируются, пока действие выполняется
+# и еще DEBOUNCE_SECONDS после его завершения
+DEBOUNCE_SECONDS = 3.0
+_IN_FLIGHT = float('inf')
+_action_state: dict[tuple[int, str], float] = {}
+
+# Коэффициенты расчета норм. Их же использует пакетный пересчет (goal_recompute.py),
+# поэтому после изменения достаточно запустить python -m goal_recompute
+ACTIVITY_MULTIPLIERS = {
+    'Сидячий образ жизни': 1.2,
+    'Легкая активность (1-2 тренировки в неделю)': 1.375,
+    'Средняя активность (3-4 тренировки в неделю)': 1.55,
+    'Высокая активность (5+ тренировок в неделю)': 1.725,
+    'Профессиональный спортсмен': 1.9
+}
+DEFAULT_ACTIVITY_MULTIPLIER = 1.2
+# Формула Миффлина-Сан Жеора: 10*вес + 6.25*рост - 5*возраст + поправка по полу
+BMR_GENDER_OFFSET = {'Мужской': 5}
+BMR_DEFAULT_OFFSET = -161
+GOAL_CALORIE_FACTORS = {'Сбросить вес': 0.85, 'Набрать массу': 1.15}  # Дефицит и профицит 15%
+PROTEIN_PER_KG = {'Набрать массу': 2.0}
+DEFAULT_PROTEIN_PER_KG = 1.8
+FAT_PER_KG = 0.8
+DEFAULT_GOALS = (2000, 75, 60, 250)  # Значения по умолчанию при ошибке в анкете
+
+
+def calculate_daily_goals(height, weight, age, gender, goal, activity_multiplier=DEFAULT_ACTIVITY_MULTIPLIER):
     """
     Рассчитывает дневные нормы калорий и макронутриентов с учетом уровня активности
     """
@@ -11,34 +39,22 @@ def calculate_daily_goals(height, weight, age, gender, goal, activity_multiplier
         weight = float(weight)
         age = float(age)
     except ValueError:
-        return 2000, 75, 60, 250  # Значения по умолчанию при ошибке
+        return DEFAULT_GOALS
 
     # Формула Миффлина-Сан Жеора для расчета базового обмена веществ (BMR)
-    if gender == 'Мужской':
-        bmr = 10 * weight + 6.25 * height - 5 * age + 5
-    else:
-        bmr = 10 * weight + 6.25 * height - 5 * age - 161
+    bmr = 10 * weight + 6.25 * height - 5 * age + BMR_GENDER_OFFSET.get(gender, BMR_DEFAULT_OFFSET)
 
     # Учитываем уровень активности
     tdee = bmr * activity_multiplier
 
     # Корректируем калории в зависимости от цели
-    if goal == 'Сбросить вес':
-        calories = int(tdee * 0.85)  # Дефицит 15%
-    elif goal == 'Набрать массу':
-        calories = int(tdee * 1.15)  # Профицит 15%
-    else:  # Поддерживать вес
-        calories = int(tdee)
-
-    # Рассчитываем макронутриенты
-    if goal == 'Набрать массу':
-        protein = int(2.0 * weight)  # 2г белка на кг веса
-    else:
-        protein = int(1.8 * weight)  # 1.8г белка на кг веса
-    
-    fat = int(0.8 * weight)  # 0.8г жира на кг веса
+    calories = int(tdee * GOAL_CALORIE_FACTORS.get(goal, 1.0))
+
+    # Рассчитываем макронутриенты: белок и жир на кг веса, оставшиеся калории в углеводы
+    protein = int(PROTEIN_PER_KG.get(goal, DEFAULT_PROTEIN_PER_KG) * weight)
+    fat = int(FAT_PER_KG * weight)
     remaining_calories = calories - (protein * 4 + fat * 9)
-    carbs = int(remaining_calories / 4)  # Оставшиеся калории в углеводы
+    carbs = int(remaining_calories / 4)
 
     return calories, protein, fat, carbs
 
@@ -67,3 +83,33 @@ def build_system_prompt(height, weight, age, gender, goal, calories, protein, fa
         prompt += f"\nОпыт тренировок: {training_exp}"
 
     return prompt
+
+
+def begin_action(user_id: int, action: str) -> bool:
+    """Отмечает начало действия пользователя; False, если оно выполняется или только что завершилось"""
+    now = time.monotonic()
+    finished_at = _action_state.get((user_id, action))
+    if finished_at is not None and (finished_at == _IN_FLIGHT or now - finished_at < DEBOUNCE_SECONDS):
+        return False
+    _action_state[(user_id, action)] = _IN_FLIGHT
+    return True
+
+def end_action(user_id: int, action: str):
+    """Отмечает завершение действия и чистит устаревшие отметки"""
+    now = time.monotonic()
+    _action_state[(user_id, action)] = now
+    if len(_action_state) > 10000:
+        for key, finished_at in list(_action_state.items()):
+            if finished_at != _IN_FLIGHT and now - finished_at >= DEBOUNCE_SECONDS:
+                del _action_state[key]
+
+async def run_debounced(update, context, action: str, handler):
+    """Запускает handler, если то же действие пользователя сейчас не выполняется"""
+    user_id = update.effective_user.id
+    if not begin_action(user_id, action):
+        metrics.incr('debounce.dropped', action=action)
+        return
+    try:
+        await handler(update, context)
+    finally:
+        end_action(user_id, action)
@@ -1,5 +1,6 @@
 # handlers/history.py
 
+import asyncio
 import datetime
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import (
@@ -10,9 +11,16 @@ from telegram.ext import (
     ConversationHandler,
     ContextTypes,
 )
+from archive import archived_dates, load_logs, recent_logs
+from config import CONVERSATION_TIMEOUT
 from database import Session
 from models import DailyLog, User
 from openai_utils import summarize_daily_intake
+from prefetch import prefetcher
+from report_cache import day_reports
+from collections import OrderedDict
+from functools import lru_cache
+from sqlalchemy import event
 import calendar
 import logging
 
@@ -22,49 +30,212 @@ ANALYZE_START, ANALYZE_END = range(2)
 
 logger = logging.getLogger(__name__)
 
-def get_calendar_keyboard(year: int, month: int):
-    """Создает клавиатуру-календарь для выбора даты"""
+# Кэш дней с записями: (telegram_id, year, month) -> frozenset дней
+LOGGED_DAYS_CACHE_SIZE = 4096
+_logged_days_cache: "OrderedDict[tuple[int, int, int], frozenset[int]]" = OrderedDict()
+
+
+def _b36(n: int) -> str:
+    """Кодирует неотрицательное число в base36 для компактного callback_data"""
+    digits = '0123456789abcdefghijklmnopqrstuvwxyz'
+    out = ''
+    while True:
+        n, r = divmod(n, 36)
+        out = digits[r] + out
+        if n == 0:
+            return out
+
+
+def encode_month(year: int, month: int) -> str:
+    """callback_data для перехода к месяцу: 'hm:<base36(year*12+month-1)>'"""
+    return f'hm:{_b36(year * 12 + month - 1)}'
+
+
+def encode_date(date: datetime.date) -> str:
+    """callback_data для выбора даты: 'hd:<base36(ordinal)>'"""
+    return f'hd:{_b36(date.toordinal())}'
+
+
+def decode_month(data: str) -> tuple[int, int]:
+    """Обратное преобразование encode_month"""
+    year, month0 = divmod(int(data[3:], 36), 12)
+    return year, month0 + 1
+
+
+def decode_date(data: str) -> datetime.date:
+    """Обратное преобразование encode_date"""
+    return datetime.date.fromordinal(int(data[3:], 36))
+
+
+def _shift_month(year: int, month: int, delta: int) -> tuple[int, int]:
+    year, month0 = divmod(year * 12 + month - 1 + delta, 12)
+    return year, month0 + 1
+
+
+# Неизменяемые части календаря, общие для всех месяцев
+_WEEKDAY_ROW = [InlineKeyboardButton(day, callback_data='ignore') for day in ["Пн", "Вт", "Ср", "Чт", "Пт", "Сб", "Вс"]]
+_EMPTY_DAY_BUTTON = InlineKeyboardButton(" ", callback_data='ignore')
+_CANCEL_ROW = [InlineKeyboardButton("❌ Отмена", callback_data='cancel_history')]
+
+@lru_cache(maxsize=512)
+def get_calendar_keyboard(year: int, month: int, marked_days: frozenset = frozenset()):
+    """Создает клавиатуру-календарь для выбора даты.
+
+    Результат кэшируется по (year, month, marked_days): разметка неизменяема,
+    поэтому один и тот же объект безопасно переиспользовать между пользователями.
+    """
     keyboard = []
     
     # Заголовок с месяцем и годом
     month_name = calendar.month_name[month]
     keyboard.append([
-        InlineKeyboardButton(f"◀️", callback_data=f'calendar_prev_{year}_{month}'),
+        InlineKeyboardButton("◀️", callback_data=encode_month(*_shift_month(year, month, -1))),
         InlineKeyboardButton(f"{month_name} {year}", callback_data='ignore'),
-        InlineKeyboardButton(f"▶️", callback_data=f'calendar_next_{year}_{month}')
+        InlineKeyboardButton("▶️", callback_data=encode_month(*_shift_month(year, month, 1)))
     ])
     
     # Дни недели
-    days = ["Пн", "Вт", "Ср", "Чт", "Пт", "Сб", "Вс"]
-    keyboard.append([InlineKeyboardButton(day, callback_data='ignore') for day in days])
+    keyboard.append(_WEEKDAY_ROW)
     
     # Получаем матрицу дней месяца
     cal = calendar.monthcalendar(year, month)
     
-    # Добавляем дни
+    # Добавляем дни (дни с записями помечаем точкой)
     for week in cal:
         row = []
         for day in week:
             if day == 0:
-                row.append(InlineKeyboardButton(" ", callback_data='ignore'))
+                row.append(_EMPTY_DAY_BUTTON)
             else:
                 row.append(InlineKeyboardButton(
-                    str(day),
-                    callback_data=f'date_{year}_{month}_{day}'
+                    f"{day}•" if day in marked_days else str(day),
+                    callback_data=encode_date(datetime.date(year, month, day))
                 ))
         keyboard.append(row)
     
     # Добавляем кнопку отмены
-    keyboard.append([InlineKeyboardButton("❌ Отмена", callback_data='cancel_history')])
+    keyboard.append(_CANCEL_ROW)
     
     return InlineKeyboardMarkup(keyboard)
 
+def get_logged_days(telegram_id: int, year: int, month: int) -> frozenset[int]:
+    """Возвращает дни месяца, за которые у пользователя есть записи.
+
+    Результат кэшируется; новые записи дополняют кэш через обработчик after_insert.
+    """
+    key = (telegram_id, year, month)
+    days = _logged_days_cache.get(key)
+    if days is not None:
+        _logged_days_cache.move_to_end(key)
+        return days
+
+    first = datetime.date(year, month, 1)
+    last = datetime.date(year, month, calendar.monthrange(year, month)[1])
+    session = Session()
+    rows = session.query(DailyLog.date).filter(
+        DailyLog.telegram_id == telegram_id,
+        DailyLog.date >= first,
+        DailyLog.date <= last
+    ).distinct().all()
+    archived = archived_dates(session, telegram_id, first, last)
+    session.close()
+
+    days = frozenset(row[0].day for row in rows) | frozenset(date.day for date in archived)
+    _logged_days_cache[key] = days
+    if len(_logged_days_cache) > LOGGED_DAYS_CACHE_SIZE:
+        _logged_days_cache.popitem(last=False)
+    return days
+
+@event.listens_for(DailyLog, 'after_insert')
+def _mark_logged_day(mapper, connection, target):
+    """Дополняет кэш дней с записями при сохранении нового DailyLog"""
+    if target.date is None:
+        return
+    key = (target.telegram_id, target.date.year, target.date.month)
+    days = _logged_days_cache.get(key)
+    if days is not None and target.date.day not in days:
+        _logged_days_cache[key] = days | {target.date.day}
+
+def get_user_calendar(telegram_id: int, year: int, month: int):
+    """Клавиатура-календарь с отметками дней, за которые у пользователя есть записи"""
+    return get_calendar_keyboard(year, month, get_logged_days(telegram_id, year, month))
+
+def render_day_report(telegram_id: int, date: datetime.date) -> tuple[int, str | None]:
+    """Текст истории за день и id последней записи; (0, None), если записей нет"""
+    session = Session()
+    logs = load_logs(session, telegram_id, date)
+    session.close()
+
+    if not logs:
+        return 0, None
+
+    parts = []
+    daily_summary = None
+    
+    for log in logs:
+        data = log.data
+        time_str = log.time.strftime('%H:%M')
+        
+        if data['type'] in ('summary', 'day_end'):
+            daily_summary = data
+            continue
+            
+        if data['type'] == 'meal':
+            meal_type = data.get('meal_type', 'Прием пищи')
+            nutrients = data.get('nutrients', {})
+            parts.append(
+                f"🕐 {time_str} - {meal_type}\n"
+                f"Состав: {data['analysis']}\n"
+                f"Калории: {nutrients.get('calories', 0)} ккал\n"
+                f"Белки: {nutrients.get('protein', 0)}г\n"
+                f"Жиры: {nutrients.get('fat', 0)}г\n"
+                f"Углеводы: {nutrients.get('carbs', 0)}г\n"
+            )
+        elif data['type'] == 'activity':
+            parts.append(
+                f"🕐 {time_str} - Физическая активность\n"
+                f"Активность: {data.get('activity', data.get('text', ''))}\n"
+                f"Анализ: {data['analysis']}\n"
+                f"Сожжено калорий: {data.get('calories_burned', 0)} ккал\n"
+            )
+        elif data['type'] == 'query':
+            parts.append(
+                f"🕐 {time_str} - Запрос к ассистенту\n"
+                f"Вопрос: {data['query']}\n"
+                f"Ответ: {data['response']}\n"
+            )
+
+    # Добавляем итоги дня, если есть
+    if daily_summary:
+        parts.append("\n" + daily_summary['summary'])
+    
+    report = "\n\n".join(parts)
+    return max(log.id for log in logs), f"📖 История за {date.strftime('%d.%m.%Y')}:\n\n{report}"
+
+def _day_key(date: datetime.date) -> str:
+    return f'day:{date.isoformat()}'
+
+async def _render_into_cache(telegram_id: int, date: datetime.date) -> None:
+    await asyncio.to_thread(day_reports.get_or_render, telegram_id, date, render_day_report)
+
+def prefetch_adjacent_days(telegram_id: int, date: datetime.date) -> None:
+    """
+    После просмотра дня следующим обычно нажимают "Предыдущий день": соседние дни
+    отрисовываются в кэш отчетов в фоне. Задачи для прежних дней снимаются, но уже
+    начатая в потоке отрисовка доходит до конца; отчет, за дату которого за это время
+    появилась запись, кэш не сохранит (см. ReportCache).
+    """
+    prefetcher.cancel(telegram_id, 'day:')
+    for day in (date - datetime.timedelta(days=1), date + datetime.timedelta(days=1)):
+        if day <= datetime.date.today():
+            prefetcher.schedule(telegram_id, _day_key(day), _render_into_cache, telegram_id, day)
+
 async def history_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Начало просмотра истории"""
     today = datetime.date.today()
     await update.message.reply_text(
         "📅 Выберите дату для просмотра истории:",
-        reply_markup=get_calendar_keyboard(today.year, today.month)
+        reply_markup=get_user_calendar(update.effective_user.id, today.year, today.month)
     )
     return HISTORY_DATE
 
@@ -73,47 +244,34 @@ async def handle_calendar_callback(update: Update, context: ContextTypes.DEFAULT
     query = update.callback_query
     await query.answer()
     
+    if not query.data.startswith('hd:'):
+        # Пользователь ушел со страницы дня: соседние дни больше не понадобятся
+        prefetcher.cancel(update.effective_user.id, 'day:')
+
     if query.data == 'cancel_history':
         await query.message.edit_text("❌ Просмотр истории отменен")
         return ConversationHandler.END
     
-    if query.data.startswith('calendar_'):
-        # Обработка навигации по календарю
-        _, direction, year, month = query.data.split('_')
-        year, month = int(year), int(month)
-        
-        if direction == 'prev':
-            if month == 1:
-                month = 12
-                year -= 1
-            else:
-                month -= 1
-        else:  # next
-            if month == 12:
-                month = 1
-                year += 1
-            else:
-                month += 1
+    if query.data.startswith('hm:'):
+        # Обработка навигации по календарю: кнопка уже содержит целевой месяц
+        year, month = decode_month(query.data)
         
         await query.message.edit_text(
             "📅 Выберите дату для просмотра истории:",
-            reply_markup=get_calendar_keyboard(year, month)
+            reply_markup=get_user_calendar(update.effective_user.id, year, month)
         )
         return HISTORY_DATE
     
-    if query.data.startswith('date_'):
+    if query.data.startswith('hd:'):
         # Обработка выбора даты
-        _, year, month, day = query.data.split('_')
-        date = datetime.date(int(year), int(month), int(day))
+        date = decode_date(query.data)
         
-        session = Session()
-        logs = session.query(DailyLog).filter_by(
-            telegram_id=update.effective_user.id,
-            date=date
-        ).order_by(DailyLog.time).all()
-        session.close()
+        # Прошедшие дни не меняются: отчет берется из кэша, пока за дату не появится новая запись.
+        # Если этот день уже отрисовывается заранее, дожидаемся той задачи, а не рисуем второй раз
+        await prefetcher.result(update.effective_user.id, _day_key(date))
+        report = day_reports.get_or_render(update.effective_user.id, date, render_day_report)
 
-        if not logs:
+        if report is None:
             keyboard = [[InlineKeyboardButton("◀️ Назад к календарю", callback_data='back_to_calendar')]]
             await query.message.edit_text(
                 f"📭 Нет данных за {date.strftime('%d.%m.%Y')}",
@@ -121,70 +279,27 @@ async def handle_calendar_callback(update: Update, context: ContextTypes.DEFAULT
             )
             return HISTORY_DATE
 
-        parts = []
-        daily_summary = None
-        
-        for log in logs:
-            data = log.data
-            time_str = log.time.strftime('%H:%M')
-            
-            if data['type'] == 'summary':
-                daily_summary = data
-                continue
-                
-            if data['type'] == 'meal':
-                meal_type = data.get('meal_type', 'Прием пищи')
-                nutrients = data.get('nutrients', {})
-                parts.append(
-                    f"🕐 {time_str} - {meal_type}\n"
-                    f"Состав: {data['analysis']}\n"
-                    f"Калории: {nutrients.get('calories', 0)} ккал\n"
-                    f"Белки: {nutrients.get('protein', 0)}г\n"
-                    f"Жиры: {nutrients.get('fat', 0)}г\n"
-                    f"Углеводы: {nutrients.get('carbs', 0)}г\n"
-                )
-            elif data['type'] == 'activity':
-                parts.append(
-                    f"🕐 {time_str} - Физическая активность\n"
-                    f"Активность: {data['activity']}\n"
-                    f"Анализ: {data['analysis']}\n"
-                    f"Сожжено калорий: {data.get('calories_burned', 0)} ккал\n"
-                )
-            elif data['type'] == 'query':
-                parts.append(
-                    f"🕐 {time_str} - Запрос к ассистенту\n"
-                    f"Вопрос: {data['query']}\n"
-                    f"Ответ: {data['response']}\n"
-                )
+        prefetch_adjacent_days(update.effective_user.id, date)
 
-        # Добавляем итоги дня, если есть
-        if daily_summary:
-            parts.append("\n" + daily_summary['summary'])
-        
-        report = "\n\n".join(parts)
-        
         # Добавляем кнопки навигации
         keyboard = [
             [
                 InlineKeyboardButton("◀️ Предыдущий день", 
-                    callback_data=f'date_{(date - datetime.timedelta(days=1)).strftime("%Y_%m_%d")}'),
+                    callback_data=encode_date(date - datetime.timedelta(days=1))),
                 InlineKeyboardButton("Следующий день ▶️", 
-                    callback_data=f'date_{(date + datetime.timedelta(days=1)).strftime("%Y_%m_%d")}')
+                    callback_data=encode_date(date + datetime.timedelta(days=1)))
             ],
             [InlineKeyboardButton("◀️ Назад к календарю", callback_data='back_to_calendar')]
         ]
         
-        await query.message.edit_text(
-            f"📖 История за {date.strftime('%d.%m.%Y')}:\n\n{report}",
-            reply_markup=InlineKeyboardMarkup(keyboard)
-        )
+        await query.message.edit_text(report, reply_markup=InlineKeyboardMarkup(keyboard))
         return HISTORY_DATE
     
     if query.data == 'back_to_calendar':
         today = datetime.date.today()
         await query.message.edit_text(
             "📅 Выберите дату для просмотра истории:",
-            reply_markup=get_calendar_keyboard(today.year, today.month)
+            reply_markup=get_user_calendar(update.effective_user.id, today.year, today.month)
         )
         return HISTORY_DATE
 
@@ -194,7 +309,7 @@ async def analyze_period_start(update: Update, context: ContextTypes.DEFAULT_TYP
     context.user_data['analyze_period'] = {}
     await update.message.reply_text(
         "📅 Выберите начальную дату периода:",
-        reply_markup=get_calendar_keyboard(today.year, today.month)
+        reply_markup=get_user_calendar(update.effective_user.id, today.year, today.month)
     )
     return ANALYZE_START
 
@@ -207,23 +322,9 @@ async def handle_analyze_calendar(update: Update, context: ContextTypes.DEFAULT_
         await query.message.edit_text("❌ Анализ периода отменен")
         return ConversationHandler.END
     
-    if query.data.startswith('calendar_'):
-        # Обработка навигации по календарю
-        _, direction, year, month = query.data.split('_')
-        year, month = int(year), int(month)
-        
-        if direction == 'prev':
-            if month == 1:
-                month = 12
-                year -= 1
-            else:
-                month -= 1
-        else:  # next
-            if month == 12:
-                month = 1
-                year += 1
-            else:
-                month += 1
+    if query.data.startswith('hm:'):
+        # Обработка навигации по календарю: кнопка уже содержит целевой месяц
+        year, month = decode_month(query.data)
         
         message = "📅 Выберите "
         message += "начальную" if context.user_data['analyze_period'].get('start_date') is None else "конечную"
@@ -231,21 +332,20 @@ async def handle_analyze_calendar(update: Update, context: ContextTypes.DEFAULT_
         
         await query.message.edit_text(
             message,
-            reply_markup=get_calendar_keyboard(year, month)
+            reply_markup=get_user_calendar(update.effective_user.id, year, month)
         )
         return ANALYZE_START if context.user_data['analyze_period'].get('start_date') is None else ANALYZE_END
     
-    if query.data.startswith('date_'):
+    if query.data.startswith('hd:'):
         # Обработка выбора даты
-        _, year, month, day = query.data.split('_')
-        selected_date = datetime.date(int(year), int(month), int(day))
+        selected_date = decode_date(query.data)
         
         if context.user_data['analyze_period'].get('start_date') is None:
             # Выбрана начальная дата
             context.user_data['analyze_period']['start_date'] = selected_date
             await query.message.edit_text(
                 "📅 Выберите конечную дату периода:",
-                reply_markup=get_calendar_keyboard(selected_date.year, selected_date.month)
+                reply_markup=get_user_calendar(update.effective_user.id, selected_date.year, selected_date.month)
             )
             return ANALYZE_END
         else:
@@ -254,17 +354,14 @@ async def handle_analyze_calendar(update: Update, context: ContextTypes.DEFAULT_
             if selected_date < start_date:
                 await query.message.edit_text(
                     "❗ Конечная дата не может быть раньше начальной. Выберите другую дату:",
-                    reply_markup=get_calendar_keyboard(selected_date.year, selected_date.month)
+                    reply_markup=get_user_calendar(update.effective_user.id, selected_date.year, selected_date.month)
                 )
                 return ANALYZE_END
             
             session = Session()
-            logs = session.query(DailyLog).filter(
-                DailyLog.telegram_id == update.effective_user.id,
-                DailyLog.date >= start_date,
-                DailyLog.date <= selected_date,
-                DailyLog.data['type'].astext == 'summary'  # Только итоги дней
-            ).order_by(DailyLog.date).all()
+            # Только итоги дней, включая перенесенные в архив
+            logs = load_logs(session, update.effective_user.id, start_date, selected_date,
+                             types=('day_end', 'summary'))
             session.close()
 
             if not logs:
@@ -331,7 +428,7 @@ async def handle_analyze_calendar(update: Update, context: ContextTypes.DEFAULT_
         today = datetime.date.today()
         await query.message.edit_text(
             "📅 Выберите начальную дату периода:",
-            reply_markup=get_calendar_keyboard(today.year, today.month)
+            reply_markup=get_user_calendar(update.effective_user.id, today.year, today.month)
         )
         return ANALYZE_START
 
@@ -345,9 +442,7 @@ async def handle_history(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         # Получаем историю из БД
         session = Session()
-        logs = session.query(DailyLog).filter(
-            DailyLog.telegram_id == update.effective_user.id
-        ).order_by(DailyLog.date.desc()).limit(7).all()
+        logs = recent_logs(session, update.effective_user.id, 7)
         session.close()
 
         if not logs:
@@ -520,7 +615,7 @@ def register_history_handlers(app):
         entry_points=[CommandHandler('history', history_start)],
         states={
             HISTORY_DATE: [
-                CallbackQueryHandler(handle_calendar_callback, pattern='^(date_|calendar_|back_to_calendar|cancel_history)')
+                CallbackQueryHandler(handle_calendar_callback, pattern='^(hd:|hm:|back_to_calendar|cancel_history)')
             ]
         },
         fallbacks=[
@@ -528,7 +623,8 @@ def register_history_handlers(app):
             CallbackQueryHandler(lambda u, c: ConversationHandler.END, pattern='^cancel$')
         ],
         per_message=True,
-        per_user=True
+        per_user=True,
+        conversation_timeout=CONVERSATION_TIMEOUT
     )
 
     # Конверсация для анализа периода
@@ -536,10 +632,10 @@ def register_history_handlers(app):
         entry_points=[CommandHandler('analyze_period', analyze_period_start)],
         states={
             ANALYZE_START: [
-                CallbackQueryHandler(handle_analyze_calendar, pattern='^(date_|calendar_|restart_analysis|cancel_history)')
+                CallbackQueryHandler(handle_analyze_calendar, pattern='^(hd:|hm:|restart_analysis|cancel_history)')
             ],
             ANALYZE_END: [
-                CallbackQueryHandler(handle_analyze_calendar, pattern='^(date_|calendar_|restart_analysis|cancel_history)')
+                CallbackQueryHandler(handle_analyze_calendar, pattern='^(hd:|hm:|restart_analysis|cancel_history)')
             ]
         },
         fallbacks=[
@@ -547,7 +643,8 @@ def register_history_handlers(app):
             CallbackQueryHandler(lambda u, c: ConversationHandler.END, pattern='^cancel$')
         ],
         per_message=True,
-        per_user=True
+        per_user=True,
+        conversation_timeout=CONVERSATION_TIMEOUT
     )
 
     # Регистрируем обработчики в правильном порядке
@@ -0,0 +1,87 @@
+# handlers/search.py
+
+import datetime
+import logging
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.ext import CallbackQueryHandler, CommandHandler, ContextTypes
+
+from handlers.history import render_day_report
+from report_cache import day_reports
+from search_index import search
+
+logger = logging.getLogger(__name__)
+
+# Номер страницы и дата найденной записи передаются в callback_data,
+# сам запрос хранится в user_data: он может не поместиться в 64 байта
+_PAGE_PREFIX = 'sp:'
+_DAY_PREFIX = 'sd:'
+
+
+def _results(telegram_id: int, query: str, page: int) -> tuple[str, InlineKeyboardMarkup | None]:
+    hits, has_more = search(telegram_id, query, page)
+    if not hits:
+        text = "🔍 Ничего не найдено" if page == 0 else "🔍 Больше результатов нет"
+        return f"{text} по запросу «{query}»", None
+
+    lines = [f"🔍 Результаты по запросу «{query}» (стр. {page + 1}):"]
+    keyboard = []
+    for hit in hits:
+        lines.append(f"\n📅 {hit.date.strftime('%d.%m.%Y')} — {hit.kind}\n{hit.excerpt}")
+        keyboard.append([InlineKeyboardButton(
+            f"📅 {hit.date.strftime('%d.%m.%Y')} — {hit.kind}",
+            callback_data=f'{_DAY_PREFIX}{hit.date.toordinal()}:{page}'
+        )])
+
+    navigation = []
+    if page > 0:
+        navigation.append(InlineKeyboardButton("◀️ Назад", callback_data=f'{_PAGE_PREFIX}{page - 1}'))
+    if has_more:
+        navigation.append(InlineKeyboardButton("Далее ▶️", callback_data=f'{_PAGE_PREFIX}{page + 1}'))
+    if navigation:
+        keyboard.append(navigation)
+    return '\n'.join(lines), InlineKeyboardMarkup(keyboard)
+
+
+async def search_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Поиск по истории: /search борщ"""
+    query = ' '.join(context.args or []).strip()
+    if not query:
+        await update.message.reply_text(
+            "🔍 Укажите, что найти, например: /search борщ\n"
+            "Поиск идет по приемам пищи, активности и вопросам ассистенту."
+        )
+        return
+
+    context.user_data['search_query'] = query
+    text, markup = _results(update.effective_user.id, query, 0)
+    await update.message.reply_text(text, reply_markup=markup)
+
+
+async def handle_search_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Переход по страницам результатов и просмотр дня найденной записи"""
+    query = update.callback_query
+    await query.answer()
+
+    search_query = context.user_data.get('search_query')
+    if not search_query:
+        await query.message.edit_text("🔍 Результаты устарели, повторите поиск командой /search")
+        return
+
+    if query.data.startswith(_PAGE_PREFIX):
+        text, markup = _results(update.effective_user.id, search_query, int(query.data[len(_PAGE_PREFIX):]))
+        await query.message.edit_text(text, reply_markup=markup)
+        return
+
+    ordinal, page = query.data[len(_DAY_PREFIX):].split(':')
+    date = datetime.date.fromordinal(int(ordinal))
+    report = day_reports.get_or_render(update.effective_user.id, date, render_day_report)
+    keyboard = [[InlineKeyboardButton("◀️ К результатам поиска", callback_data=f'{_PAGE_PREFIX}{page}')]]
+    await query.message.edit_text(
+        report or f"📭 Нет данных за {date.strftime('%d.%m.%Y')}",
+        reply_markup=InlineKeyboardMarkup(keyboard)
+    )
+
+
+def register_search_handlers(app):
+    app.add_handler(CommandHandler('search', search_command))
+    app.add_handler(CallbackQueryHandler(handle_search_callback, pattern=f'^({_PAGE_PREFIX}|{_DAY_PREFIX})'))
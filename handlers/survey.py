@@ -9,9 +9,12 @@ from telegram.ext import (
     filters,
     ContextTypes,
 )
+from config import CONVERSATION_TIMEOUT
 from database import Session
 from models import User
-from handlers.common import calculate_daily_goals, build_system_prompt
+from handlers.common import (
+    ACTIVITY_MULTIPLIERS, DEFAULT_ACTIVITY_MULTIPLIER, build_system_prompt, calculate_daily_goals,
+)
 
 # Уровни логирования (по желанию)
 logger = logging.getLogger(__name__)
@@ -250,14 +253,7 @@ async def save_survey(update: Update, context: ContextTypes.DEFAULT_TYPE):
     training_exp = context.user_data['training_experience']
 
     # Применяем множитель активности к базовому обмену
-    activity_multipliers = {
-        'Сидячий образ жизни': 1.2,
-        'Легкая активность (1-2 тренировки в неделю)': 1.375,
-        'Средняя активность (3-4 тренировки в неделю)': 1.55,
-        'Высокая активность (5+ тренировок в неделю)': 1.725,
-        'Профессиональный спортсмен': 1.9
-    }
-    activity_multiplier = activity_multipliers.get(activity_level, 1.2)
+    activity_multiplier = ACTIVITY_MULTIPLIERS.get(activity_level, DEFAULT_ACTIVITY_MULTIPLIER)
 
     calories, protein, fat, carbs = calculate_daily_goals(h, w, a, g, goal, activity_multiplier)
     system_prompt = build_system_prompt(h, w, a, g, goal, calories, protein, fat, carbs, 
@@ -338,5 +334,6 @@ def register_survey_handlers(app):
         },
         fallbacks=[CommandHandler('cancel', cancel_survey)],
         per_user=True,
+        conversation_timeout=CONVERSATION_TIMEOUT,
     )
     app.add_handler(conv)
@@ -1,14 +1,33 @@
 # handlers/tracking.py
 
+import asyncio
 import datetime
+import functools
 import logging
-import re
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+from sqlalchemy import case, func
 from telegram import Update, ReplyKeyboardMarkup, ReplyKeyboardRemove, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import CommandHandler, MessageHandler, filters, ContextTypes, ConversationHandler, CallbackQueryHandler
+from config import (
+    AUTO_CLOSE_BATCH_SIZE, AUTO_CLOSE_INTERVAL, AUTO_CLOSE_LOOKBACK_DAYS, CONVERSATION_TIMEOUT, DEFAULT_TIMEZONE,
+    VOICE_MAX_DURATION,
+)
+from admission import OVERLOADED_MESSAGE, Level, Overloaded, admission
 from database import Session
+from day_log import DayLog, history_texts
 from models import DailyLog, User
-from openai_utils import analyze_food_image, analyze_food_text, get_recommendations
-from handlers.common import build_system_prompt
+from openai_utils import analyze_food_image, analyze_food_text, get_recommendations, warm_up_connections
+from jobs import runner
+from llm_scheduler import Priority
+import metrics
+import nutrition_db
+from photo_store import THUMBNAIL, VISION, photo_store
+from prefetch import prefetcher
+from response_parser import parse_response
+from semantic_cache import partition_for, remaining_for, response_cache
+from transcription import transcriber
+from user_state import forget_active_day, remember_active_day
+from handlers.common import build_system_prompt, run_debounced
 from handlers.history import handle_history, handle_analyze_period
 
 logger = logging.getLogger(__name__)
@@ -20,22 +39,24 @@ MEAL_TEXT = 2
 
 MEAL_TYPES = ['Завтрак', 'Обед', 'Ужин', 'Перекус', 'Физическая активность']
 
+# Ключ семантического кэша для кнопки "получить рекомендации"
+ADVICE_CACHE_QUESTION = 'текущие рекомендации по дню'
+
 def format_analysis_for_user(analysis: str) -> str:
     """Форматирует анализ для вывода пользователю"""
     # Извлекаем секции из анализа
-    analysis_match = re.search(r'\[АНАЛИЗ\](.*?)\[/АНАЛИЗ\]', analysis, re.DOTALL)
-    nutrients_match = re.search(r'\[НУТРИЕНТЫ\](.*?)\[/НУТРИЕНТЫ\]', analysis, re.DOTALL)
-    calories_match = re.search(r'\[КАЛОРИИ\](.*?)\[/КАЛОРИИ\]', analysis, re.DOTALL)
-    recommendations_match = re.search(r'\[РЕКОМЕНДАЦИИ\](.*?)\[/РЕКОМЕНДАЦИИ\]', analysis, re.DOTALL)
+    parsed = parse_response(analysis)
+    analysis_text = parsed.section('АНАЛИЗ')
+    nutrients_text = parsed.section('НУТРИЕНТЫ')
+    calories_text = parsed.section('КАЛОРИИ')
+    recommendations_text = parsed.section('РЕКОМЕНДАЦИИ')
 
     parts = []
     
-    if analysis_match:
-        analysis_text = analysis_match.group(1).strip()
+    if analysis_text is not None:
         parts.append(f"📝 *Анализ:*\n{analysis_text}")
     
-    if nutrients_match:
-        nutrients_text = nutrients_match.group(1).strip()
+    if nutrients_text is not None:
         # Форматируем нутриенты
         nutrients_lines = nutrients_text.split('\n')
         formatted_nutrients = []
@@ -52,13 +73,11 @@ def format_analysis_for_user(analysis: str) -> str:
                 formatted_nutrients.append(line.strip())
         parts.append(f"📊 *Нутриенты:*\n" + "\n".join(formatted_nutrients))
     
-    if calories_match:
-        calories_text = calories_match.group(1).strip()
+    if calories_text is not None:
         if 'Сожжено:' in calories_text:
             parts.append(f"🏃‍♂️ *Физическая активность:*\n{calories_text}")
     
-    if recommendations_match:
-        recommendations_text = recommendations_match.group(1).strip()
+    if recommendations_text is not None:
         parts.append(f"💡 *Рекомендации:*\n{recommendations_text}")
     
     return "\n\n".join(parts)
@@ -113,29 +132,13 @@ async def start_day(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❗ Сначала пройдите опрос командой /start")
         return
 
-    ui = user.user_info
-    h, w, a = ui['height'], ui['weight'], ui['age']
-    g, goal = ui['gender'], ui['goal']
-    dg = ui['daily_goals']
+    init_day_state(context.user_data, user.user_info, datetime.date.today())
+    remember_active_day(update.effective_user.id, context.user_data['date'])
+    dg = context.user_data['daily_goals']
     calories, protein, fat, carbs = (
         dg['calories'], dg['protein'], dg['fat'], dg['carbs']
     )
 
-    system_prompt = build_system_prompt(
-        h, w, a, g, goal, calories, protein, fat, carbs
-    )
-    context.user_data['system_prompt'] = system_prompt
-    context.user_data['logs'] = []
-    context.user_data['date'] = datetime.date.today()
-    context.user_data['daily_totals'] = {
-        'calories': 0,
-        'protein': 0,
-        'fat': 0,
-        'carbs': 0,
-        'burned': 0
-    }
-    context.user_data['daily_goals'] = dg
-
     await update.message.reply_text(
         f"📅 День {context.user_data['date'].strftime('%d.%m.%Y')} начат!\n\n"
         f"Ваши цели на сегодня:\n"
@@ -146,23 +149,56 @@ async def start_day(update: Update, context: ContextTypes.DEFAULT_TYPE):
         reply_markup=get_main_keyboard()
     )
 
-async def end_day(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if 'date' not in context.user_data:
-        message = update.message or update.callback_query.message
-        await message.reply_text("❗ День ещё не начат. Используйте /start_day")
-        return
-
-    # Отправляем сообщение о подготовке итогов
-    message = update.message or update.callback_query.message
-    progress_message = await message.reply_text(
-        "🔄 Фитоша анализирует ваш день и готовит подробный отчет...\n"
-        "Это займет несколько секунд."
+def init_day_state(user_data: dict, user_info: dict, date: datetime.date, logs: list | None = None):
+    """Заполняет user_data активного дня; logs — уже сохраненные записи DailyLog за этот день"""
+    dg = user_info['daily_goals']
+    user_data['system_prompt'] = build_system_prompt(
+        user_info['height'], user_info['weight'], user_info['age'], user_info['gender'], user_info['goal'],
+        dg['calories'], dg['protein'], dg['fat'], dg['carbs']
     )
+    day_log = DayLog()
+    for log in logs or []:
+        data = log.data
+        if data.get('type') == 'query':
+            day_log.add_query(log.id)
+        elif data.get('type') == 'meal':
+            # Старые записи из текста без сохраненных нутриентов разбираются один раз здесь
+            day_log.add(log.id, data.get('meal_type'),
+                        data.get('nutrients') or extract_nutrients(data.get('analysis', '')))
+        elif data.get('type') == 'activity':
+            day_log.add(log.id, data.get('meal_type'), burned=data.get('calories_burned', 0))
+    user_data['logs'] = day_log
+    user_data['date'] = date
+    user_data['daily_totals'] = day_log.totals()
+    user_data['daily_goals'] = dg
+    user_data['goal'] = user_info['goal']
 
-    totals = context.user_data.get('daily_totals', {})
-    goals = context.user_data.get('daily_goals', {})
-    logs = context.user_data.get('logs', [])
-    
+def restore_day_state(telegram_id: int, user_data: dict, date: datetime.date) -> bool:
+    """
+    Восстанавливает активный день, выгруженный из памяти, по записям в БД.
+    False, если пользователь не найден или день уже закрыт.
+    """
+    session = Session()
+    user = session.query(User).filter_by(telegram_id=telegram_id).first()
+    logs = session.query(DailyLog).filter_by(
+        telegram_id=telegram_id,
+        date=date
+    ).order_by(DailyLog.time).all()
+    session.close()
+
+    if not user or 'daily_goals' not in (user.user_info or {}):
+        return False
+    if any(log.data.get('type') == 'day_end' for log in logs):
+        return False
+    init_day_state(user_data, user.user_info, date, logs)
+    return True
+
+def _first_line(text: str | None) -> str:
+    """Первая строка описания для краткой разбивки итогов"""
+    return text.strip().split('\n', 1)[0].strip() if text else ''
+
+def build_day_summary(date: datetime.date, totals: dict, goals: dict, logs: list) -> tuple[str, dict]:
+    """Формирует текст итогов дня и разбивку по приемам пищи"""
     net_calories = totals.get('calories', 0) - totals.get('burned', 0)
     goal_calories = goals.get('calories', 0)
     
@@ -175,10 +211,11 @@ async def end_day(update: Update, context: ContextTypes.DEFAULT_TYPE):
         'Физическая активность': {'burned': 0, 'items': []}
     }
     
-    # Анализируем логи
+    # Анализируем логи; числа берутся из сохраненных в записи значений, текст разбирается только для описания
     logger.info(f"Начинаем анализ логов. Всего записей: {len(logs)}")
     for log in logs:
-        if '[АНАЛИЗ]' in log:
+        log_text = log if isinstance(log, str) else log.get('analysis', '')
+        if '[АНАЛИЗ]' in log_text:
             meal_type = None
             # Проверяем тип записи
             if isinstance(log, dict):
@@ -196,28 +233,26 @@ async def end_day(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 logger.warning(f"Не удалось определить тип приема пищи для записи: {log[:100]}...")
                 continue
 
+            parsed = parse_response(log_text)
+            description = _first_line(parsed.section('АНАЛИЗ'))
+            stored = log if isinstance(log, dict) else {}
             if meal_type == 'Физическая активность':
-                log_text = log if isinstance(log, str) else log.get('analysis', '')
-                calories_match = re.search(r'Сожжено: (\d+)', log_text)
-                if calories_match:
-                    burned = int(calories_match.group(1))
+                burned = stored.get('calories_burned') or parsed.burned
+                if burned:
                     meals_breakdown[meal_type]['burned'] += burned
                     logger.info(f"Добавлена физическая активность: {burned} ккал")
-                    activity_desc = re.search(r'\[АНАЛИЗ\](.*?)\[', log_text)
-                    if activity_desc:
-                        meals_breakdown[meal_type]['items'].append(activity_desc.group(1).strip())
+                    if description:
+                        meals_breakdown[meal_type]['items'].append(description)
             else:
-                log_text = log if isinstance(log, str) else log.get('analysis', '')
-                nutrients = extract_nutrients(log_text)
+                nutrients = stored.get('nutrients') or parsed.nutrients
                 if meal_type and nutrients:
                     meals_breakdown[meal_type]['calories'] += nutrients['calories']
                     meals_breakdown[meal_type]['protein'] += nutrients['protein']
                     meals_breakdown[meal_type]['fat'] += nutrients['fat']
                     meals_breakdown[meal_type]['carbs'] += nutrients['carbs']
                     logger.info(f"Добавлен прием пищи {meal_type}: {nutrients}")
-                    food_desc = re.search(r'\[АНАЛИЗ\](.*?)\[', log_text)
-                    if food_desc:
-                        meals_breakdown[meal_type]['items'].append(food_desc.group(1).strip())
+                    if description:
+                        meals_breakdown[meal_type]['items'].append(description)
     
     logger.info("Итоговая разбивка по приемам пищи:")
     for meal_type, data in meals_breakdown.items():
@@ -238,7 +273,7 @@ async def end_day(update: Update, context: ContextTypes.DEFAULT_TYPE):
         calories_status = f"⚠️ Недобор калорий на {abs(calories_diff)} ккал"
     
     # Формируем детальный отчет
-    summary_parts = [f"📊 *Итоги дня {context.user_data['date'].strftime('%d.%m.%Y')}*"]
+    summary_parts = [f"📊 *Итоги дня {date.strftime('%d.%m.%Y')}*"]
     
     # Общие показатели
     summary_parts.append("\n💫 *Общие показатели:*")
@@ -279,51 +314,265 @@ async def end_day(update: Update, context: ContextTypes.DEFAULT_TYPE):
             summary_parts.append("• Активности: " + "\n  ▫️ ".join([''] + meals_breakdown['Физическая активность']['items']))
     
     summary = "\n".join(summary_parts)
+    return summary, meals_breakdown
 
-    # Получаем рекомендации на основе итогов дня
-    formatted_logs = []
-    for log in context.user_data.get('logs', []):
-        if isinstance(log, dict):
-            formatted_logs.append(log.get('analysis', ''))
-        else:
-            formatted_logs.append(log)
+def totals_from_logs(logs: list) -> dict:
+    """Считает дневные итоги по сохраненным записям DailyLog"""
+    totals = {'calories': 0, 'protein': 0, 'fat': 0, 'carbs': 0, 'burned': 0}
+    for log in logs:
+        data = log.data
+        if data.get('type') == 'meal':
+            update_daily_totals(totals, data.get('nutrients') or extract_nutrients(data.get('analysis', '')))
+        elif data.get('type') == 'activity':
+            totals['burned'] += data.get('calories_burned', 0)
+    return totals
 
-    recommendations = await get_recommendations(
-        context.user_data['system_prompt'],
-        formatted_logs,
-        summary
-    )
+def day_end_data(summary: str, recommendations: str | None, totals: dict, goals: dict,
+                 meals_breakdown: dict, auto_closed: bool = False) -> dict:
+    """Содержимое записи итогов дня"""
+    data = {
+        'type': 'day_end',
+        'summary': summary,
+        'recommendations': recommendations,
+        'totals': totals,
+        'goals': goals,
+        'meals_breakdown': meals_breakdown
+    }
+    if auto_closed:
+        data['auto_closed'] = True
+    return data
 
-    formatted_recommendations = format_analysis_for_user(recommendations)
+def load_day_end(session, telegram_id: int, date: datetime.date):
+    return session.query(DailyLog).filter(
+        DailyLog.telegram_id == telegram_id,
+        DailyLog.date == date,
+        DailyLog.data['type'].as_string() == 'day_end'
+    ).first()
 
-    # Сохраняем итоги дня
+def save_day_end(telegram_id: int, date: datetime.date, data: dict):
+    """
+    Идемпотентно сохраняет итоги дня: повторный вызов не создает дубликат,
+    а ручное завершение дня заменяет автоматическое.
+    """
     session = Session()
-    session.add(DailyLog(
-        telegram_id=update.effective_user.id,
-        date=context.user_data['date'],
-        time=datetime.datetime.now(),
-        data={
-            'type': 'day_end',
-            'summary': summary,
-            'recommendations': recommendations,
-            'totals': totals,
-            'goals': goals,
-            'meals_breakdown': meals_breakdown
-        }
-    ))
+    existing = load_day_end(session, telegram_id, date)
+    if existing is None:
+        session.add(DailyLog(
+            telegram_id=telegram_id,
+            date=date,
+            time=datetime.datetime.now(),
+            data=data
+        ))
+    elif existing.data.get('auto_closed') or not existing.data.get('recommendations'):
+        existing.data = data
+        existing.time = datetime.datetime.now()
     session.commit()
     session.close()
 
+async def deliver_day_summary(bot, chat_id: int, telegram_id: int, date: datetime.date, summary: str,
+                              meals_breakdown: dict, totals: dict, goals: dict,
+                              system_prompt: str, logs: list[str]):
+    """Фоновая задача: получает рекомендации по итогам дня, сохраняет итоги и отправляет их пользователю"""
+    session = Session()
+    existing = load_day_end(session, telegram_id, date)
+    session.close()
+
+    # При повторе после сбоя отправки рекомендации уже сохранены — не запрашиваем их снова
+    if existing is not None and not existing.data.get('auto_closed') and existing.data.get('recommendations'):
+        recommendations = existing.data['recommendations']
+    else:
+        recommendations = await get_recommendations(
+            system_prompt,
+            logs,
+            summary,
+            user_id=telegram_id,
+            priority=Priority.BACKGROUND,
+            flow='day_end'
+        )
+        save_day_end(telegram_id, date, day_end_data(summary, recommendations, totals, goals, meals_breakdown))
+
+    await bot.send_message(
+        chat_id,
+        f"💡 *Рекомендации по итогам дня {date.strftime('%d.%m.%Y')}:*\n{format_analysis_for_user(recommendations)}",
+        parse_mode='Markdown'
+    )
+
+async def deliver_day_summary_failed(bot, chat_id: int, telegram_id: int, date: datetime.date, summary: str,
+                                     meals_breakdown: dict, totals: dict, goals: dict,
+                                     system_prompt: str, logs: list[str]):
+    """Если рекомендации получить не удалось, итоги дня все равно сохраняются"""
+    save_day_end(telegram_id, date, day_end_data(summary, None, totals, goals, meals_breakdown))
+    await bot.send_message(
+        chat_id,
+        "❌ Не удалось подготовить рекомендации по итогам дня. Итоги сохранены в истории."
+    )
+
+def day_summary_job(bot, chat_id: int, telegram_id: int, date: datetime.date, summary: str,
+                    meals_breakdown: dict, totals: dict, goals: dict, system_prompt: str, logs: list[str]):
+    """Постановка фоновой задачи рекомендаций по итогам дня (для запуска сразу или через admission.defer)"""
+    return functools.partial(
+        runner.submit,
+        f"day_end:{telegram_id}:{date.isoformat()}",
+        deliver_day_summary,
+        bot, chat_id, telegram_id, date, summary,
+        meals_breakdown, totals, goals, system_prompt, logs,
+        fallback=deliver_day_summary_failed
+    )
+
+async def resume_deferred_summaries(application):
+    """
+    Задача при запуске: отложенные под нагрузкой рекомендации хранились только в памяти.
+    Сегодняшние итоги дня, завершенного вручную и еще без рекомендаций, ставятся в очередь заново.
+    """
+    session = Session()
+    today = datetime.date.today()
+    pending = [
+        log for log in session.query(DailyLog).filter(
+            DailyLog.date == today,
+            DailyLog.data['type'].as_string() == 'day_end'
+        )
+        if not log.data.get('recommendations') and not log.data.get('auto_closed')
+    ]
+    users = {
+        user.telegram_id: user.user_info or {}
+        for user in session.query(User).filter(User.telegram_id.in_({log.telegram_id for log in pending}))
+    }
+    jobs = []
+    for day_end in pending:
+        system_prompt = users.get(day_end.telegram_id, {}).get('system_prompt')
+        if not system_prompt:
+            continue
+        records = [
+            log.data for log in session.query(DailyLog).filter_by(
+                telegram_id=day_end.telegram_id,
+                date=day_end.date
+            ).order_by(DailyLog.time)
+            if log.data.get('type') in ('meal', 'activity', 'query')
+        ]
+        data = day_end.data
+        # Бот работает в личных чатах: id чата совпадает с id пользователя
+        jobs.append(day_summary_job(
+            application.bot, day_end.telegram_id, day_end.telegram_id, day_end.date, data['summary'],
+            data['meals_breakdown'], data['totals'], data['goals'], system_prompt, history_texts(records)
+        ))
+    session.close()
+
+    if jobs:
+        logger.info("Повторно поставлено рекомендаций по итогам дня: %d", len(jobs))
+    for job in jobs:
+        if admission.defers_background:
+            admission.defer(job)
+        else:
+            job()
+
+async def end_day(update: Update, context: ContextTypes.DEFAULT_TYPE):
     message = update.message or update.callback_query.message
+    if 'date' not in context.user_data:
+        await message.reply_text("❗ День ещё не начат. Используйте /start_day")
+        return
+
+    date = context.user_data['date']
+    totals = context.user_data.get('daily_totals', {})
+    goals = context.user_data.get('daily_goals', {})
+    day_log = context.user_data.get('logs') or DayLog()
+    system_prompt = context.user_data['system_prompt']
+
+    # Полные тексты записей загружаем из БД один раз
+    records = day_log.load_data()
+    summary, meals_breakdown = build_day_summary(
+        date, totals, goals, [data for data in records if data.get('type') in ('meal', 'activity')]
+    )
+    formatted_logs = history_texts(records)
+
+    # Очищаем данные дня: рекомендации готовятся в фоне и придут отдельным сообщением
+    context.user_data.clear()
+    forget_active_day(update.effective_user.id)
+
     await message.reply_text(
         f"{summary}\n\n"
-        f"💡 *Рекомендации:*\n{formatted_recommendations}",
+        f"⏳ Фитоша готовит рекомендации по итогам дня и пришлет их отдельным сообщением.",
         parse_mode='Markdown',
         reply_markup=None
     )
 
-    # Очищаем данные дня
-    context.user_data.clear()
+    telegram_id = update.effective_user.id
+    submit_summary = day_summary_job(
+        context.bot, update.effective_chat.id, telegram_id, date, summary,
+        meals_breakdown, totals, goals, system_prompt, formatted_logs
+    )
+    if admission.defers_background:
+        # Под нагрузкой рекомендации откладываются; итоги сохраняются сразу, чтобы день
+        # считался завершенным, и будут дополнены рекомендациями после восстановления
+        save_day_end(telegram_id, date, day_end_data(summary, None, totals, goals, meals_breakdown))
+        admission.defer(submit_summary)
+    else:
+        submit_summary()
+
+def _local_today(timezone: str) -> datetime.date:
+    try:
+        tz = ZoneInfo(timezone)
+    except (ZoneInfoNotFoundError, ValueError):
+        tz = ZoneInfo(DEFAULT_TIMEZONE)
+    return datetime.datetime.now(tz).date()
+
+async def close_stale_days(application, pairs: list[tuple[int, datetime.date]]):
+    """Фоновая задача: закрывает пачку незавершенных дней (без обращения к LLM)"""
+    session = Session()
+    users = {
+        user.telegram_id: user.user_info or {}
+        for user in session.query(User).filter(User.telegram_id.in_({tid for tid, _ in pairs}))
+    }
+    closed = 0
+    for telegram_id, date in pairs:
+        user_info = users.get(telegram_id, {})
+        # День закрывается только после полуночи по времени пользователя
+        if date >= _local_today(user_info.get('timezone', DEFAULT_TIMEZONE)):
+            continue
+        logs = session.query(DailyLog).filter_by(
+            telegram_id=telegram_id,
+            date=date
+        ).order_by(DailyLog.time).all()
+        if any(log.data.get('type') == 'day_end' for log in logs):
+            continue
+
+        totals = totals_from_logs(logs)
+        goals = user_info.get('daily_goals', {})
+        summary, meals_breakdown = build_day_summary(
+            date, totals, goals, [log.data for log in logs if log.data.get('type') in ('meal', 'activity')]
+        )
+        session.add(DailyLog(
+            telegram_id=telegram_id,
+            date=date,
+            time=datetime.datetime.now(),
+            data=day_end_data(summary, None, totals, goals, meals_breakdown, auto_closed=True)
+        ))
+        closed += 1
+
+        # Незавершенный день в памяти тоже больше не актуален
+        user_data = application.user_data.get(telegram_id)
+        if user_data and user_data.get('date') == date:
+            user_data.clear()
+    session.commit()
+    session.close()
+    if closed:
+        logger.info("Автоматически закрыто дней: %d", closed)
+        metrics.incr('day_end.auto_closed', closed)
+
+async def auto_close_stale_days(application):
+    """Периодическая задача: находит дни без итогов и ставит их закрытие пачками"""
+    session = Session()
+    pairs = session.query(DailyLog.telegram_id, DailyLog.date).filter(
+        DailyLog.date >= datetime.date.today() - datetime.timedelta(days=AUTO_CLOSE_LOOKBACK_DAYS),
+        DailyLog.date <= datetime.date.today()
+    ).group_by(DailyLog.telegram_id, DailyLog.date).having(
+        func.sum(case((DailyLog.data['type'].as_string() == 'day_end', 1), else_=0)) == 0
+    ).order_by(DailyLog.date, DailyLog.telegram_id).all()
+    session.close()
+
+    for i in range(0, len(pairs), AUTO_CLOSE_BATCH_SIZE):
+        batch = [tuple(pair) for pair in pairs[i:i + AUTO_CLOSE_BATCH_SIZE]]
+        telegram_id, date = batch[0]
+        runner.submit(f"auto_close:{telegram_id}:{date.isoformat()}:{len(batch)}", close_stale_days, application, batch)
 
 async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
@@ -351,6 +600,7 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             'snack': 'Перекус'
         }
         context.user_data['meal_type'] = meal_types[meal_type]
+        prefetch_meal_context(update.effective_user.id, context.user_data)
         await query.message.edit_text(
             "Как вы хотите добавить запись?",
             reply_markup=get_input_method_keyboard()
@@ -371,6 +621,7 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             context.user_data['expecting_text'] = True
             return MEAL_TEXT
     elif query.data == 'back_to_main':
+        prefetcher.cancel(update.effective_user.id, 'meal')
         await query.message.edit_text(
             "Выберите действие:",
             reply_markup=get_main_keyboard()
@@ -392,9 +643,9 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     elif query.data == 'start_day':
         await start_day(update, context)
     elif query.data == 'end_day':
-        await end_day(update, context)
+        await run_debounced(update, context, 'end_day', end_day)
     elif query.data == 'get_advice':
-        await get_current_advice(update, context)
+        await run_debounced(update, context, 'get_advice', get_current_advice)
 
 async def get_current_advice(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Получить рекомендации на основе текущих данных за день"""
@@ -408,6 +659,7 @@ async def get_current_advice(update: Update, context: ContextTypes.DEFAULT_TYPE)
 
     totals = context.user_data.get('daily_totals', {})
     goals = context.user_data.get('daily_goals', {})
+    remaining_calories, remaining_protein = remaining_for(context.user_data)
     
     current_status = (
         f"Текущие показатели:\n"
@@ -415,14 +667,24 @@ async def get_current_advice(update: Update, context: ContextTypes.DEFAULT_TYPE)
         f"Белки: {totals.get('protein', 0)}/{goals.get('protein', 0)}г\n"
         f"Жиры: {totals.get('fat', 0)}/{goals.get('fat', 0)}г\n"
         f"Углеводы: {totals.get('carbs', 0)}/{goals.get('carbs', 0)}г\n"
-        f"Сожжено калорий: {totals.get('burned', 0)} ккал"
+        f"Сожжено калорий: {totals.get('burned', 0)} ккал\n"
+        f"Осталось: {remaining_calories} ккал, белка {remaining_protein}г"
     )
 
-    recommendations = await get_recommendations(
-        context.user_data['system_prompt'],
-        context.user_data['logs'],
-        current_status
-    )
+    # Повторный запрос советов при том же состоянии дня берем из кэша пользователя
+    partition = partition_for(update.effective_user.id, context.user_data)
+    recommendations = response_cache.get(ADVICE_CACHE_QUESTION, partition, kind='advice')
+    if recommendations is None:
+        recommendations = await get_recommendations(
+            context.user_data['system_prompt'],
+            context.user_data['logs'].history(),
+            current_status,
+            user_id=update.effective_user.id,
+            flow='advice'
+        )
+        # Ответ, урезанный под нагрузкой, не кэшируем: он пережил бы восстановление
+        if admission.level == Level.NORMAL:
+            response_cache.put(ADVICE_CACHE_QUESTION, partition, recommendations, kind='advice')
 
     await update.callback_query.message.reply_text(
         f"📊 {current_status}\n\n"
@@ -457,6 +719,7 @@ async def handle_meal_type(update: Update, context: ContextTypes.DEFAULT_TYPE):
             'snack': 'Перекус'
         }
         context.user_data['meal_type'] = meal_types[meal_type]
+        prefetch_meal_context(update.effective_user.id, context.user_data)
         await query.message.edit_text(
             "Как вы хотите добавить запись?",
             reply_markup=get_input_method_keyboard()
@@ -472,6 +735,7 @@ async def handle_meal_type(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return MEAL_TYPE
         
         context.user_data['meal_type'] = meal_type
+        prefetch_meal_context(update.effective_user.id, context.user_data)
         
         if meal_type == 'Физическая активность':
             await update.message.reply_text(
@@ -541,6 +805,29 @@ async def show_day_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
         parse_mode='Markdown'
     )
 
+async def _load_meal_context(logs: DayLog) -> tuple[DayLog, int, list[str]]:
+    history, _ = await asyncio.gather(asyncio.to_thread(logs.history), warm_up_connections())
+    return logs, len(logs), history
+
+
+def prefetch_meal_context(telegram_id: int, user_data: dict) -> None:
+    """
+    После выбора типа записи почти всегда приходит фото или текст: история дня для
+    промпта загружается заранее, а соединение с OpenAI открывается, если пул остыл.
+    Системный промпт уже лежит в user_data (init_day_state), загружать его не нужно.
+    """
+    if 'date' in user_data:
+        prefetcher.schedule(telegram_id, 'meal', _load_meal_context, user_data.setdefault('logs', DayLog()))
+
+
+async def day_history(telegram_id: int, logs: DayLog) -> list[str]:
+    """История дня для запроса к LLM: из упреждающей загрузки, если записи с тех пор не менялись"""
+    prefetched = await prefetcher.result(telegram_id, 'meal')
+    if prefetched is not None and prefetched[0] is logs and prefetched[1] == len(logs):
+        return prefetched[2]
+    return logs.history()
+
+
 def clear_conversation_state(context: ContextTypes.DEFAULT_TYPE):
     """Очищает все состояния разговора из контекста"""
     keys_to_clear = ['meal_type', 'expecting_photo', 'expecting_text', 'expecting_question']
@@ -574,20 +861,27 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
     
     try:
-        # Получаем файл фото
+        # Получаем файл фото и сохраняем его локально: ссылка Telegram содержит токен бота и со временем истекает
         photo = update.message.photo[-1]
         photo_file = await photo.get_file()
-        photo_url = photo_file.file_path
+        photo_bytes = bytes(await photo_file.download_as_bytearray())
+        photo_key, is_new_photo = await asyncio.to_thread(photo_store.put, photo_bytes)
+        # Модели отдается уменьшенная копия, поэтому она нужна до запроса; миниатюра подождет
+        await photo_store.build_derivatives_async(photo_key, (VISION,))
+        if is_new_photo:
+            runner.submit(f"photo_derivatives:{photo_key}", photo_store.build_derivatives_async,
+                          photo_key, (THUMBNAIL,))
         
         logger.info("Начинаем анализ фото для пользователя %s (тип: %s)", 
                    update.effective_user.id, context.user_data.get('meal_type'))
         
         # Получаем анализ фото
         analysis = await analyze_food_image(
-            photo_url,
+            await asyncio.to_thread(photo_store.data_url, photo_key),
             context.user_data['system_prompt'],
-            [log.get('analysis', log) if isinstance(log, dict) else log for log in context.user_data.get('logs', [])],
-            update.message.caption
+            await day_history(update.effective_user.id, context.user_data['logs']),
+            update.message.caption,
+            user_id=update.effective_user.id
         )
         
         logger.info("Получен анализ фото для пользователя %s", update.effective_user.id)
@@ -607,23 +901,20 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 'meal_type': context.user_data.get('meal_type', 'Прием пищи'),
                 'analysis': analysis,
                 'nutrients': nutrients,
-                'photo_url': photo_url
+                'photo_key': photo_key
             }
         )
         session.add(log_entry)
         session.commit()
+        log_id = log_entry.id
         session.close()
         
         logger.info("Сохранена запись в БД для пользователя %s", update.effective_user.id)
         
-        # Добавляем анализ в историю дня
-        if 'logs' not in context.user_data:
-            context.user_data['logs'] = []
-        context.user_data['logs'].append({
-            'type': 'meal',
-            'meal_type': context.user_data.get('meal_type', 'Прием пищи'),
-            'analysis': analysis
-        })
+        # Добавляем запись в историю дня (текст анализа остается только в БД)
+        context.user_data.setdefault('logs', DayLog()).add(
+            log_id, context.user_data.get('meal_type', 'Прием пищи'), nutrients
+        )
         
         # Удаляем сообщение о прогрессе
         await progress_message.delete()
@@ -641,6 +932,9 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
         # Завершаем разговор
         return ConversationHandler.END
         
+    except Overloaded:
+        await progress_message.edit_text(OVERLOADED_MESSAGE)
+        return MEAL_PHOTO
     except Exception as e:
         logger.error("Ошибка при обработке фото для пользователя %s: %s", 
                     update.effective_user.id, str(e), exc_info=True)
@@ -652,8 +946,8 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
         # Очищаем все состояния разговора
         clear_conversation_state(context)
 
-async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Обработчик текстовых описаний еды или активности"""
+async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str | None = None):
+    """Обработчик текстовых описаний еды или активности; text — расшифровка голосового сообщения"""
     if 'expecting_text' not in context.user_data and 'expecting_question' not in context.user_data:
         await update.message.reply_text(
             "❗ Пожалуйста, сначала выберите тип записи",
@@ -669,19 +963,29 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         if 'expecting_question' in context.user_data:
             del context.user_data['expecting_question']
-            await handle_open_query(update, context, progress_message)
+            await handle_open_query(update, context, progress_message, text)
             return ConversationHandler.END
 
         del context.user_data['expecting_text']
+        text = text or update.message.text
         
-        # Получаем анализ текста
-        analysis = await analyze_food_text(
-            update.message.text,
-            context.user_data['system_prompt'],
-            [log.get('analysis', log) if isinstance(log, dict) else log for log in context.user_data.get('logs', [])]
-        )
+        # Простые записи считаем по локальному справочнику, остальное — через LLM
+        analysis = None
+        if context.user_data.get('meal_type') != 'Физическая активность':
+            analysis = nutrition_db.estimate_meal(text)
+            if analysis is not None:
+                metrics.incr('router.requests', tier='local', flow='text')
+
+        if analysis is None:
+            analysis = await analyze_food_text(
+                text,
+                context.user_data['system_prompt'],
+                await day_history(update.effective_user.id, context.user_data.setdefault('logs', DayLog())),
+                user_id=update.effective_user.id
+            )
         
         # Обновляем статистику
+        nutrients, calories_burned = {}, 0
         if context.user_data.get('meal_type') == 'Физическая активность':
             calories_burned = extract_calories_burned(analysis)
             if calories_burned > 0:
@@ -702,24 +1006,21 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
             data={
                 'type': 'activity' if context.user_data.get('meal_type') == 'Физическая активность' else 'meal',
                 'meal_type': context.user_data.get('meal_type', 'Прием пищи'),
-                'text': update.message.text,
+                'text': text,
                 'analysis': analysis,
+                'nutrients': nutrients,
                 'calories_burned': calories_burned if context.user_data.get('meal_type') == 'Физическая активность' else 0
             }
         )
         session.add(log_entry)
         session.commit()
+        log_id = log_entry.id
         session.close()
         
-        # Добавляем анализ в историю дня
-        if 'logs' not in context.user_data:
-            context.user_data['logs'] = []
-        context.user_data['logs'].append({
-            'type': 'activity' if context.user_data.get('meal_type') == 'Физическая активность' else 'meal',
-            'meal_type': context.user_data.get('meal_type', 'Прием пищи'),
-            'analysis': analysis,
-            'calories_burned': calories_burned if context.user_data.get('meal_type') == 'Физическая активность' else 0
-        })
+        # Добавляем запись в историю дня (текст анализа остается только в БД)
+        context.user_data.setdefault('logs', DayLog()).add(
+            log_id, context.user_data.get('meal_type', 'Прием пищи'), nutrients, calories_burned
+        )
         
         # Удаляем сообщение о прогрессе
         await progress_message.delete()
@@ -742,6 +1043,9 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
         # Завершаем разговор
         return ConversationHandler.END
         
+    except Overloaded:
+        await progress_message.edit_text(OVERLOADED_MESSAGE)
+        return MEAL_TEXT
     except Exception as e:
         logger.error("Ошибка при обработке текста: %s", e)
         await progress_message.edit_text(
@@ -752,7 +1056,45 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
         # Очищаем все состояния разговора
         clear_conversation_state(context)
 
-async def handle_open_query(update: Update, context: ContextTypes.DEFAULT_TYPE, progress_message=None):
+async def handle_voice(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Голосовое сообщение: расшифровывается локально и дальше обрабатывается как текст —
+    описание еды или активности, если ждем запись, иначе как вопрос ассистенту
+    """
+    expecting_text = 'expecting_text' in context.user_data or 'expecting_question' in context.user_data
+    # Вне диалога записи сообщение — вопрос, а он требует начатого дня: проверяем до распознавания
+    if not expecting_text and 'date' not in context.user_data:
+        return await handle_open_query(update, context)
+    state = MEAL_TEXT if expecting_text else None
+
+    voice = update.message.voice
+    if not transcriber.available:
+        await update.message.reply_text("🎤 Голосовые сообщения пока не поддерживаются, опишите текстом")
+        return state
+    if voice.duration and voice.duration > VOICE_MAX_DURATION:
+        await update.message.reply_text(
+            f"🎤 Сообщение слишком длинное: запишите до {VOICE_MAX_DURATION} секунд или опишите текстом"
+        )
+        return state
+
+    progress_message = await update.message.reply_text("🎤 Распознаю голосовое сообщение...")
+    try:
+        voice_file = await voice.get_file()
+        text = await transcriber.transcribe(bytes(await voice_file.download_as_bytearray()))
+    except Exception as e:
+        logger.error("Не удалось получить голосовое сообщение пользователя %s: %s", update.effective_user.id, e)
+        text = None
+    if not text:
+        await progress_message.edit_text("❌ Не удалось разобрать сообщение. Попробуйте еще раз или опишите текстом")
+        return state
+    await progress_message.edit_text(f"🎤 Распознано: {text}")
+
+    if expecting_text:
+        return await handle_text(update, context, text)
+    return await handle_open_query(update, context, text=text)
+
+async def handle_open_query(update: Update, context: ContextTypes.DEFAULT_TYPE, progress_message=None,
+                            text: str | None = None):
     """Обработчик открытых вопросов"""
     if 'date' not in context.user_data:
         if progress_message:
@@ -769,15 +1111,14 @@ async def handle_open_query(update: Update, context: ContextTypes.DEFAULT_TYPE,
         )
 
     try:
-        user_query = update.message.text
+        user_query = text or update.message.text
         system_prompt = context.user_data['system_prompt']
         
         # Получаем текущую статистику
         totals = context.user_data.get('daily_totals', {})
         goals = context.user_data.get('daily_goals', {})
         
-        net_calories = totals.get('calories', 0) - totals.get('burned', 0)
-        remaining_calories = goals.get('calories', 0) - net_calories
+        remaining_calories, remaining_protein = remaining_for(context.user_data)
         
         # Формируем контекст для запроса
         context_info = (
@@ -785,24 +1126,33 @@ async def handle_open_query(update: Update, context: ContextTypes.DEFAULT_TYPE,
             f"- Потреблено калорий: {totals.get('calories', 0)} ккал\n"
             f"- Сожжено калорий: {totals.get('burned', 0)} ккал\n"
             f"- Осталось калорий: {remaining_calories} ккал\n"
+            f"- Осталось белка: {remaining_protein}г\n"
             f"- Белки: {totals.get('protein', 0)}г / {goals.get('protein', 0)}г\n"
             f"- Жиры: {totals.get('fat', 0)}г / {goals.get('fat', 0)}г\n"
             f"- Углеводы: {totals.get('carbs', 0)}г / {goals.get('carbs', 0)}г\n"
         )
         
         # Получаем рекомендации с учетом контекста
-        formatted_logs = []
-        for log in context.user_data.get('logs', []):
-            if isinstance(log, dict):
-                formatted_logs.append(log.get('analysis', ''))
-            else:
-                formatted_logs.append(log)
+        formatted_logs = context.user_data.setdefault('logs', DayLog()).history()
 
-        recommendations = await get_recommendations(
-            system_prompt,
-            formatted_logs,
-            f"Контекст:\n{context_info}\n\nВопрос пользователя: {user_query}"
+        # Похожий вопрос того же пользователя при том же состоянии дня отвечаем из кэша
+        partition = partition_for(update.effective_user.id, context.user_data)
+        recommendations = response_cache.get(user_query, partition)
+        # Ответ из кэша мог быть посчитан при чуть другом остатке: рядом показываются точные числа
+        status_note = (
+            f"📊 Сейчас осталось: {remaining_calories} ккал, белка {remaining_protein}г\n\n"
+            if recommendations is not None else ''
         )
+        if recommendations is None:
+            recommendations = await get_recommendations(
+                system_prompt,
+                formatted_logs,
+                f"Контекст:\n{context_info}\n\nВопрос пользователя: {user_query}",
+                user_id=update.effective_user.id,
+                flow='query'
+            )
+            if admission.level == Level.NORMAL:
+                response_cache.put(user_query, partition, recommendations)
         
         # Форматируем ответ
         formatted_response = format_analysis_for_user(recommendations)
@@ -821,12 +1171,11 @@ async def handle_open_query(update: Update, context: ContextTypes.DEFAULT_TYPE,
         )
         session.add(log_entry)
         session.commit()
+        log_id = log_entry.id
         session.close()
         
         # Добавляем запрос в историю дня
-        if 'logs' not in context.user_data:
-            context.user_data['logs'] = []
-        context.user_data['logs'].append(f"Вопрос: {user_query}\nОтвет: {recommendations}")
+        context.user_data['logs'].add_query(log_id)
         
         # Удаляем сообщение о прогрессе
         if progress_message:
@@ -835,18 +1184,20 @@ async def handle_open_query(update: Update, context: ContextTypes.DEFAULT_TYPE,
         # Отправляем ответ с форматированием
         if formatted_response:
             await update.message.reply_text(
-                f"💡 *Ответ на ваш вопрос:*\n\n{formatted_response}",
+                f"{status_note}💡 *Ответ на ваш вопрос:*\n\n{formatted_response}",
                 parse_mode='Markdown',
                 reply_markup=get_main_keyboard()
             )
         else:
             # Если форматированный ответ пустой, отправляем оригинальные рекомендации
             await update.message.reply_text(
-                f"💡 *Ответ на ваш вопрос:*\n\n{recommendations}",
+                f"{status_note}💡 *Ответ на ваш вопрос:*\n\n{recommendations}",
                 parse_mode='Markdown',
                 reply_markup=get_main_keyboard()
             )
         
+    except Overloaded:
+        await progress_message.edit_text(OVERLOADED_MESSAGE)
     except Exception as e:
         logger.error("Ошибка при обработке запроса: %s", e)
         if progress_message:
@@ -856,62 +1207,13 @@ async def handle_open_query(update: Update, context: ContextTypes.DEFAULT_TYPE,
 
 def extract_nutrients(analysis: str) -> dict:
     """Извлекает информацию о нутриентах из анализа"""
-    try:
-        # Ищем секцию с нутриентами
-        start = analysis.find('[НУТРИЕНТЫ]')
-        end = analysis.find('[/НУТРИЕНТЫ]')
-        if start == -1 or end == -1:
-            return {'calories': 0, 'protein': 0, 'fat': 0, 'carbs': 0}
-        
-        nutrients_text = analysis[start:end]
-        
-        # Извлекаем значения
-        nutrients = {
-            'calories': 0,
-            'protein': 0,
-            'fat': 0,
-            'carbs': 0
-        }
-        
-        for line in nutrients_text.split('\n'):
-            line = line.strip()
-            if 'Калории:' in line:
-                nutrients['calories'] = int(line.split(':')[1].replace('ккал', '').strip())
-            elif 'Белки:' in line:
-                nutrients['protein'] = int(line.split(':')[1].replace('г', '').strip())
-            elif 'Жиры:' in line:
-                nutrients['fat'] = int(line.split(':')[1].replace('г', '').strip())
-            elif 'Углеводы:' in line:
-                nutrients['carbs'] = int(line.split(':')[1].replace('г', '').strip())
-        
-        return nutrients
-    except Exception as e:
-        logger.error("Ошибка при извлечении нутриентов: %s", e)
-        return {'calories': 0, 'protein': 0, 'fat': 0, 'carbs': 0}
+    return parse_response(analysis).nutrients
 
 def extract_calories_burned(analysis: str) -> int:
     """Извлекает информацию о сожженных калориях из анализа"""
-    try:
-        # Ищем секцию с калориями
-        start = analysis.find('[КАЛОРИИ]')
-        end = analysis.find('[/КАЛОРИИ]')
-        if start == -1 or end == -1:
-            return 0
-        
-        calories_text = analysis[start:end]
-        
-        # Извлекаем значение
-        for line in calories_text.split('\n'):
-            line = line.strip()
-            if 'Сожжено:' in line:
-                calories = int(line.split(':')[1].replace('ккал', '').strip())
-                logger.info(f"Извлечено сожженных калорий: {calories}")
-                return calories
-        
-        return 0
-    except Exception as e:
-        logger.error("Ошибка при извлечении сожженных калорий: %s", e)
-        return 0
+    calories = parse_response(analysis).burned
+    logger.info(f"Извлечено сожженных калорий: {calories}")
+    return calories
 
 def update_daily_totals(totals: dict, nutrients: dict):
     """Обновляет дневные итоги на основе новых данных"""
@@ -938,6 +1240,7 @@ def register_tracking_handlers(app):
             ],
             MEAL_TEXT: [
                 MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text),
+                MessageHandler(filters.VOICE, handle_voice),
                 CallbackQueryHandler(handle_callback, pattern='^input_'),
                 CallbackQueryHandler(handle_callback, pattern='^back_to_meal_type$')
             ]
@@ -948,6 +1251,7 @@ def register_tracking_handlers(app):
             CallbackQueryHandler(handle_callback, pattern='^back_to_main$')
         ],
         per_user=True,
+        conversation_timeout=CONVERSATION_TIMEOUT,
         name="meal_conversation"
     )
 
@@ -959,6 +1263,7 @@ def register_tracking_handlers(app):
         states={
             MEAL_TEXT: [
                 MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text),
+                MessageHandler(filters.VOICE, handle_voice),
                 CallbackQueryHandler(handle_callback, pattern='^back_to_main$')
             ]
         },
@@ -968,9 +1273,13 @@ def register_tracking_handlers(app):
             CallbackQueryHandler(handle_callback, pattern='^back_to_main$')
         ],
         per_user=True,
+        conversation_timeout=CONVERSATION_TIMEOUT,
         name="activity_conversation"
     )
 
+    # Фоновое закрытие дней, которые пользователи не завершили сами
+    runner.every('auto_close_sweep', AUTO_CLOSE_INTERVAL, auto_close_stale_days, app, first_delay=60)
+
     # Регистрируем обработчики в правильном порядке
     app.add_handler(CommandHandler('start_day', start_day))
     app.add_handler(CommandHandler('end_day', end_day))
@@ -980,3 +1289,4 @@ def register_tracking_handlers(app):
     app.add_handler(conv_activity)  # Потом активность
     app.add_handler(CallbackQueryHandler(handle_callback, pattern='^(day_stats|ask_question|start_day|end_day|get_advice)$'))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_open_query))
+    app.add_handler(MessageHandler(filters.VOICE, handle_voice))
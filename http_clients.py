@@ -0,0 +1,169 @@
+# http_clients.py
+
+import importlib.util
+import logging
+import time
+
+import httpx
+
+import config
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# HTTP/2 у httpx требует пакет h2 (httpx[http2]); без него остаемся на HTTP/1.1
+HTTP2_AVAILABLE = importlib.util.find_spec('h2') is not None
+
+
+def http2_enabled() -> bool:
+    if config.HTTP2_ENABLED and not HTTP2_AVAILABLE:
+        logger.warning("HTTP/2 включен в настройках, но пакет h2 не установлен — используется HTTP/1.1")
+    return config.HTTP2_ENABLED and HTTP2_AVAILABLE
+
+
+# Транспорты по имени клиента: по ним видно, когда пул последний раз использовался
+_transports: dict[str, 'InstrumentedTransport'] = {}
+
+
+class _TrackedStream(httpx.AsyncByteStream):
+    """Тело ответа, которое сообщает пулу о закрытии соединения"""
+
+    def __init__(self, stream: httpx.AsyncByteStream, on_close):
+        self._stream = stream
+        self._on_close = on_close
+
+    async def __aiter__(self):
+        async for chunk in self._stream:
+            yield chunk
+
+    async def aclose(self) -> None:
+        try:
+            await self._stream.aclose()
+        finally:
+            self._on_close()
+
+
+class InstrumentedTransport(httpx.AsyncBaseTransport):
+    """
+    Транспорт с пулом заданного размера и метриками заполненности:
+    число запросов в работе, доля занятого пула, случаи полного пула и задержки.
+    """
+
+    def __init__(self, name: str, limits: httpx.Limits, http2: bool):
+        self.name = name
+        self.max_connections = limits.max_connections
+        self.keepalive_expiry = limits.keepalive_expiry
+        self.in_flight = 0
+        self.last_used = 0.0
+        self._transport = httpx.AsyncHTTPTransport(limits=limits, http2=http2)
+        _transports[name] = self
+
+    def _update_gauges(self) -> None:
+        metrics.set_gauge('http_pool.in_flight', self.in_flight, client=self.name)
+        if self.max_connections:
+            metrics.set_gauge('http_pool.saturation', self.in_flight / self.max_connections, client=self.name)
+
+    def _release(self) -> None:
+        self.in_flight -= 1
+        self._update_gauges()
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        self.in_flight += 1
+        self.last_used = time.monotonic()
+        if self.max_connections and self.in_flight > self.max_connections:
+            # Запрос будет ждать свободного соединения в пуле
+            metrics.incr('http_pool.saturated', client=self.name)
+        self._update_gauges()
+        started = time.perf_counter()
+        try:
+            response = await self._transport.handle_async_request(request)
+        except BaseException:
+            self._release()
+            raise
+        metrics.observe('http_pool.time_to_headers', time.perf_counter() - started, client=self.name)
+        released = False
+
+        def release_once():
+            nonlocal released
+            if not released:
+                released = True
+                self._release()
+
+        return httpx.Response(
+            status_code=response.status_code,
+            headers=response.headers,
+            stream=_TrackedStream(response.stream, release_once),
+            extensions=response.extensions,
+        )
+
+    async def aclose(self) -> None:
+        await self._transport.aclose()
+
+
+def openai_http_client() -> httpx.AsyncClient:
+    """Общий HTTP-клиент для AsyncOpenAI"""
+    limits = httpx.Limits(
+        max_connections=config.OPENAI_POOL_SIZE,
+        max_keepalive_connections=config.OPENAI_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry=config.HTTP_KEEPALIVE_EXPIRY,
+    )
+    return httpx.AsyncClient(
+        transport=InstrumentedTransport('openai', limits, http2_enabled()),
+        timeout=httpx.Timeout(
+            config.OPENAI_TIMEOUTS['default'],
+            connect=config.OPENAI_CONNECT_TIMEOUT,
+            pool=config.OPENAI_POOL_TIMEOUT,
+        ),
+    )
+
+
+def pool_is_cold(name: str) -> bool:
+    """
+    True, если соединения пула могли закрыться по keepalive_expiry: клиентом давно
+    не пользовались и запросов в работе нет. Такой пул стоит прогреть заранее.
+    """
+    transport = _transports.get(name)
+    if transport is None or transport.in_flight:
+        return False
+    return time.monotonic() - transport.last_used > (transport.keepalive_expiry or 0) / 2
+
+
+def openai_timeout(flow: str) -> httpx.Timeout:
+    """Таймаут запроса к OpenAI для конкретного сценария (фото анализируется дольше текста)"""
+    return httpx.Timeout(
+        config.OPENAI_TIMEOUTS.get(flow, config.OPENAI_TIMEOUTS['default']),
+        connect=config.OPENAI_CONNECT_TIMEOUT,
+        pool=config.OPENAI_POOL_TIMEOUT,
+    )
+
+
+def telegram_requests():
+    """
+    Запросы python-telegram-bot: общий пул для отправки сообщений и отдельное
+    соединение для long polling, чтобы getUpdates не занимал общий пул.
+    """
+    from telegram.request import HTTPXRequest
+
+    http2 = http2_enabled()
+    http_version = '2' if http2 else '1.1'
+
+    def build(name: str, pool_size: int, read_timeout: float) -> HTTPXRequest:
+        limits = httpx.Limits(
+            max_connections=pool_size,
+            max_keepalive_connections=pool_size,
+            keepalive_expiry=config.HTTP_KEEPALIVE_EXPIRY,
+        )
+        return HTTPXRequest(
+            connection_pool_size=pool_size,
+            connect_timeout=config.TELEGRAM_CONNECT_TIMEOUT,
+            read_timeout=read_timeout,
+            write_timeout=config.TELEGRAM_WRITE_TIMEOUT,
+            pool_timeout=config.TELEGRAM_POOL_TIMEOUT,
+            http_version=http_version,
+            httpx_kwargs={'transport': InstrumentedTransport(name, limits, http2)},
+        )
+
+    return (
+        build('telegram', config.TELEGRAM_POOL_SIZE, config.TELEGRAM_READ_TIMEOUT),
+        build('telegram_updates', 1, config.TELEGRAM_POLL_READ_TIMEOUT),
+    )
@@ -0,0 +1,96 @@
+# jobs.py
+
+import asyncio
+import logging
+
+from config import JOBS_CONCURRENCY, JOBS_MAX_ATTEMPTS, JOBS_RETRY_DELAY
+import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class JobRunner:
+    """
+    Фоновые задачи внутри процесса бота.
+    - одновременно выполняется не больше concurrency задач;
+    - задача с тем же job_id не ставится повторно, пока предыдущая не завершилась;
+    - при ошибке задача повторяется с экспоненциальной задержкой, после последней
+      неудачной попытки вызывается fallback (если задан) с теми же аргументами.
+    Сами задачи должны быть идемпотентными: повтор не должен дублировать данные.
+    """
+
+    def __init__(self, concurrency: int = JOBS_CONCURRENCY, max_attempts: int = JOBS_MAX_ATTEMPTS,
+                 retry_delay: float = JOBS_RETRY_DELAY):
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._pending: dict[str, asyncio.Task] = {}
+        self._periodic: list[tuple[str, float, float, object]] = []
+        self._periodic_tasks: list[asyncio.Task] = []
+
+    def submit(self, job_id: str, func, *args, fallback=None, **kwargs) -> bool:
+        """Ставит задачу в очередь; False, если задача с таким job_id уже выполняется"""
+        if job_id in self._pending:
+            metrics.incr('jobs.deduplicated', job=func.__name__)
+            return False
+        task = asyncio.get_running_loop().create_task(self._run(job_id, func, fallback, args, kwargs))
+        self._pending[job_id] = task
+        task.add_done_callback(lambda _: self._pending.pop(job_id, None))
+        metrics.set_gauge('jobs.pending', len(self._pending))
+        return True
+
+    async def _run(self, job_id: str, func, fallback, args: tuple, kwargs: dict) -> None:
+        for attempt in range(1, self.max_attempts + 1):
+            async with self._semaphore:
+                try:
+                    with metrics.timer('jobs.duration', job=func.__name__):
+                        await func(*args, **kwargs)
+                    metrics.incr('jobs.succeeded', job=func.__name__)
+                    return
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    logger.error("Задача %s, попытка %d/%d: %s", job_id, attempt, self.max_attempts, e,
+                                 exc_info=True)
+                    metrics.incr('jobs.retries', job=func.__name__)
+            if attempt < self.max_attempts:
+                await asyncio.sleep(self.retry_delay * 2 ** (attempt - 1))
+
+        metrics.incr('jobs.failed', job=func.__name__)
+        if fallback is not None:
+            try:
+                await fallback(*args, **kwargs)
+            except Exception as e:
+                logger.error("Fallback задачи %s не выполнен: %s", job_id, e, exc_info=True)
+
+    def every(self, name: str, interval: float, func, *args, first_delay: float | None = None) -> None:
+        """Регистрирует периодическую задачу; запускается вместе с start()"""
+        self._periodic.append((name, interval, interval if first_delay is None else first_delay, (func, args)))
+
+    async def _periodic_loop(self, name: str, interval: float, first_delay: float, func, args) -> None:
+        await asyncio.sleep(first_delay)
+        while True:
+            self.submit(name, func, *args)
+            await asyncio.sleep(interval)
+
+    async def start(self) -> None:
+        for name, interval, first_delay, (func, args) in self._periodic:
+            self._periodic_tasks.append(asyncio.get_running_loop().create_task(
+                self._periodic_loop(name, interval, first_delay, func, args)
+            ))
+        logger.info("Фоновые задачи запущены: %d периодических", len(self._periodic))
+
+    async def drain(self) -> None:
+        """Ждет завершения разовых задач, включая поставленные во время ожидания"""
+        while self._pending:
+            await asyncio.gather(*list(self._pending.values()), return_exceptions=True)
+
+    async def stop(self) -> None:
+        tasks = self._periodic_tasks + list(self._pending.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._periodic_tasks.clear()
+
+
+runner = JobRunner()
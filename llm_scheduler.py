@@ -0,0 +1,261 @@
+# llm_scheduler.py
+
+import asyncio
+import bisect
+import itertools
+import logging
+import re
+import time
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from enum import IntEnum
+
+from config import LLM_TOKENS_PER_MINUTE, LLM_USER_TOKENS_PER_MINUTE, LLM_USER_BURST_TOKENS
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Идентификатор для вызовов вне контекста пользователя
+SYSTEM_USER = 0
+
+
+class Priority(IntEnum):
+    """Чем меньше значение, тем раньше запрос получает бюджет"""
+    INTERACTIVE = 0
+    BACKGROUND = 1
+
+
+class TokenBucket:
+    """Классическое ведро токенов; крупный запрос ждет полного ведра и уходит в долг"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float, now: float) -> float:
+        self._refill(now)
+        missing = min(amount, self.capacity) - self.tokens
+        return 0.0 if missing <= 0 else missing / self.rate
+
+    def consume(self, amount: float, now: float) -> None:
+        self._refill(now)
+        self.tokens -= amount
+
+    def refund(self, amount: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+    @property
+    def full(self) -> bool:
+        self._refill(time.monotonic())
+        return self.tokens >= self.capacity
+
+
+@dataclass(order=True)
+class _Waiter:
+    priority: int
+    finish_tag: float
+    seq: int
+    user_id: int = field(compare=False)
+    tokens: int = field(compare=False)
+    enqueued: float = field(compare=False)
+    future: asyncio.Future = field(compare=False)
+
+
+def _parse_reset(value: str) -> float:
+    """Разбирает x-ratelimit-reset-tokens вида '6m0s', '1.5s', '120ms'"""
+    seconds = 0.0
+    for amount, unit in re.findall(r'([\d.]+)(ms|h|m|s)', value):
+        seconds += float(amount) * {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600}[unit]
+    return seconds
+
+
+class LLMScheduler:
+    """
+    Очередь запросов к LLM с бюджетом токенов.
+    - у каждого пользователя свое ведро токенов (лимит в минуту + запас на всплеск);
+    - общий бюджет токенов в минуту синхронизируется с заголовками x-ratelimit-* провайдера;
+    - внутри одного приоритета запросы упорядочены по схеме взвешенной честной очереди
+      (self-clocked fair queuing), так что активный пользователь не вытесняет остальных;
+    - интерактивные запросы всегда обслуживаются раньше фоновых.
+    """
+
+    def __init__(self, tokens_per_minute: int = LLM_TOKENS_PER_MINUTE,
+                 user_tokens_per_minute: int = LLM_USER_TOKENS_PER_MINUTE,
+                 user_burst_tokens: int = LLM_USER_BURST_TOKENS):
+        self.user_rate = user_tokens_per_minute / 60
+        self.user_burst = user_burst_tokens
+        self.weights: dict[int, float] = {}
+        self._global = TokenBucket(tokens_per_minute / 60, tokens_per_minute)
+        self._users: dict[int, TokenBucket] = {}
+        self._last_finish: dict[int, float] = {}
+        self._virtual_time = 0.0
+        self._seq = itertools.count()
+        self._waiting: list[_Waiter] = []
+        self._wakeup: asyncio.Event | None = None
+        self._dispatcher: asyncio.Task | None = None
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._waiting)
+
+    def _bucket(self, user_id: int) -> TokenBucket:
+        bucket = self._users.get(user_id)
+        if bucket is None:
+            bucket = self._users[user_id] = TokenBucket(self.user_rate, self.user_burst)
+        return bucket
+
+    def _ensure_dispatcher(self) -> None:
+        if self._dispatcher is None or self._dispatcher.done():
+            self._wakeup = asyncio.Event()
+            self._dispatcher = asyncio.get_running_loop().create_task(self._dispatch())
+
+    async def acquire(self, user_id: int, tokens: int, priority: Priority = Priority.INTERACTIVE) -> None:
+        """Ждет, пока запрос на tokens токенов уложится в бюджеты пользователя и общий"""
+        self._ensure_dispatcher()
+        weight = self.weights.get(user_id, 1.0)
+        start = max(self._virtual_time, self._last_finish.get(user_id, 0.0))
+        finish = start + tokens / weight
+        self._last_finish[user_id] = finish
+
+        waiter = _Waiter(
+            int(priority), finish, next(self._seq), user_id, tokens,
+            time.monotonic(), asyncio.get_running_loop().create_future()
+        )
+        bisect.insort(self._waiting, waiter)
+        metrics.set_gauge('llm_scheduler.queue_depth', len(self._waiting))
+        self._wakeup.set()
+        try:
+            await waiter.future
+        except asyncio.CancelledError:
+            if waiter in self._waiting:
+                self._waiting.remove(waiter)
+            elif waiter.future.done() and not waiter.future.cancelled():
+                self.settle(user_id, tokens, 0)
+            raise
+
+    def settle(self, user_id: int, reserved: int, used: int) -> None:
+        """Сверяет резерв с фактическим расходом: возвращает излишек или списывает недостачу"""
+        diff = reserved - used
+        bucket = self._bucket(user_id)
+        if diff > 0:
+            bucket.refund(diff)
+            self._global.refund(diff)
+        elif diff < 0:
+            now = time.monotonic()
+            bucket.consume(-diff, now)
+            self._global.consume(-diff, now)
+
+    @asynccontextmanager
+    async def reserve(self, user_id: int | None, tokens: int, priority: Priority = Priority.INTERACTIVE):
+        """
+        Резервирует бюджет на время вызова. Внутри блока вызывающий записывает
+        фактический расход в reservation['used']; при ошибке резерв возвращается.
+        """
+        user_id = SYSTEM_USER if user_id is None else user_id
+        await self.acquire(user_id, tokens, priority)
+        reservation = {'used': 0}
+        try:
+            yield reservation
+        finally:
+            self.settle(user_id, tokens, reservation['used'])
+
+    def update_from_headers(self, headers) -> None:
+        """Подстраивает общий бюджет под лимиты, которые сообщил провайдер"""
+        limit = headers.get('x-ratelimit-limit-tokens')
+        remaining = headers.get('x-ratelimit-remaining-tokens')
+        try:
+            if limit:
+                limit = int(limit)
+                if limit != self._global.capacity:
+                    logger.info("Лимит провайдера: %d токенов в минуту", limit)
+                self._global.capacity = limit
+                self._global.rate = limit / 60
+            if remaining:
+                now = time.monotonic()
+                self._global._refill(now)
+                self._global.tokens = min(self._global.tokens, int(remaining))
+                reset = headers.get('x-ratelimit-reset-tokens')
+                if reset:
+                    metrics.set_gauge('llm_scheduler.provider_reset_seconds', _parse_reset(reset))
+                metrics.set_gauge('llm_scheduler.provider_remaining_tokens', int(remaining))
+        except ValueError:
+            logger.warning("Не удалось разобрать заголовки лимитов: %s / %s", limit, remaining)
+
+    def _grant(self, waiter: _Waiter, now: float) -> None:
+        self._waiting.remove(waiter)
+        self._bucket(waiter.user_id).consume(waiter.tokens, now)
+        self._global.consume(waiter.tokens, now)
+        self._virtual_time = max(self._virtual_time, waiter.finish_tag)
+        waiter.future.set_result(None)
+        metrics.observe('llm_scheduler.wait', now - waiter.enqueued, priority=Priority(waiter.priority).name)
+        metrics.set_gauge('llm_scheduler.queue_depth', len(self._waiting))
+
+    def _prune(self) -> None:
+        """Удаляет состояние пользователей, которые не влияют на очередь"""
+        if len(self._users) < 10000:
+            return
+        waiting = {w.user_id for w in self._waiting}
+        for user_id in [u for u, b in self._users.items() if u not in waiting and b.full]:
+            del self._users[user_id]
+        for user_id in [u for u, f in self._last_finish.items() if u not in waiting and f <= self._virtual_time]:
+            del self._last_finish[user_id]
+
+    async def _dispatch(self) -> None:
+        while True:
+            if not self._waiting:
+                self._prune()
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            now = time.monotonic()
+            delay = None
+            for waiter in list(self._waiting):
+                if waiter.future.done():
+                    self._waiting.remove(waiter)
+                    continue
+                user_wait = self._bucket(waiter.user_id).wait_time(waiter.tokens, now)
+                if user_wait > 0:
+                    # Пользователь исчерпал свой бюджет — пропускаем вперед остальных
+                    delay = user_wait if delay is None else min(delay, user_wait)
+                    continue
+                global_wait = self._global.wait_time(waiter.tokens, now)
+                if global_wait > 0:
+                    # Общий бюджет не позволяет обгонять голову очереди
+                    delay = global_wait if delay is None else min(delay, global_wait)
+                    break
+                self._grant(waiter, now)
+                delay = 0
+                break
+
+            if delay:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+
+
+def estimate_tokens(messages: list[dict], max_tokens: int) -> int:
+    """Грубая оценка расхода: ~3 символа на токен для русского текста, ~1100 токенов на фото"""
+    chars, images = 0, 0
+    for message in messages:
+        content = message['content']
+        if isinstance(content, str):
+            chars += len(content)
+        else:
+            for item in content:
+                if item.get('type') == 'image_url':
+                    images += 1
+                else:
+                    chars += len(item.get('text', ''))
+    return chars // 3 + images * 1100 + max_tokens
+
+
+scheduler = LLMScheduler()
@@ -0,0 +1,74 @@
+# metrics.py
+
+import threading
+import time
+from contextlib import contextmanager
+
+# Простые in-process метрики: счетчики, gauge-значения и наблюдения (count/sum/max)
+_lock = threading.Lock()
+_counters: dict[str, float] = {}
+_gauges: dict[str, float] = {}
+_observations: dict[str, list[float]] = {}
+
+
+def _key(name: str, labels: dict) -> str:
+    if not labels:
+        return name
+    return name + "{" + ",".join(f"{k}={v}" for k, v in sorted(labels.items())) + "}"
+
+
+def incr(name: str, value: float = 1, **labels) -> None:
+    """Увеличивает счетчик"""
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def set_gauge(name: str, value: float, **labels) -> None:
+    """Устанавливает текущее значение показателя"""
+    with _lock:
+        _gauges[_key(name, labels)] = value
+
+
+def observe(name: str, value: float, **labels) -> None:
+    """Записывает наблюдение (например, задержку в секундах)"""
+    key = _key(name, labels)
+    with _lock:
+        stat = _observations.get(key)
+        if stat is None:
+            _observations[key] = [1, value, value]
+        else:
+            stat[0] += 1
+            stat[1] += value
+            stat[2] = max(stat[2], value)
+
+
+@contextmanager
+def timer(name: str, **labels):
+    """Замеряет длительность блока и записывает ее через observe"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - started, **labels)
+
+
+def snapshot() -> dict:
+    """Возвращает копию всех метрик"""
+    with _lock:
+        return {
+            'counters': dict(_counters),
+            'gauges': dict(_gauges),
+            'observations': {
+                key: {'count': c, 'sum': s, 'max': m, 'avg': s / c}
+                for key, (c, s, m) in _observations.items()
+            },
+        }
+
+
+def reset() -> None:
+    """Сбрасывает все метрики"""
+    with _lock:
+        _counters.clear()
+        _gauges.clear()
+        _observations.clear()
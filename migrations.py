@@ -0,0 +1,107 @@
+# migrations.py
+
+import logging
+from sqlalchemy import Column, Integer, MetaData, Table, select, text
+from database import Base, engine
+
+logger = logging.getLogger(__name__)
+
+_metadata = MetaData()
+schema_migrations = Table(
+    'schema_migrations', _metadata,
+    Column('version', Integer, primary_key=True)
+)
+
+
+def _initial_schema(connection):
+    """Таблицы моделей и индексы (в т.ч. для таблиц, созданных до появления индексов)"""
+    import models
+    Base.metadata.create_all(connection)
+    for index in models.DailyLog.__table__.indexes:
+        index.create(connection, checkfirst=True)
+
+
+def _daily_logs_archive(connection):
+    """Холодная таблица для сжатых записей старых дней"""
+    import models
+    models.DailyLogArchive.__table__.create(connection, checkfirst=True)
+
+
+def _search_index(connection):
+    """Полнотекстовый индекс истории (FTS5), заполняется существующими записями"""
+    from search_index import create_index
+    create_index(connection)
+
+
+def _llm_usage(connection):
+    """Журнал расхода LLM и дневные итоги по нему"""
+    import models
+    models.LlmUsage.__table__.create(connection, checkfirst=True)
+    models.LlmUsageDaily.__table__.create(connection, checkfirst=True)
+
+
+def _daily_logs_autoincrement(connection):
+    """
+    daily_logs с AUTOINCREMENT: без него SQLite выдает новой записи id удаленной
+    (перенесенной в архив) строки, и она затирает архивную запись в индексе /search.
+    Таблица пересоздается, счетчик id начинается не ниже последнего id в архиве.
+    """
+    import models
+    if connection.dialect.name != 'sqlite':
+        return
+    table_sql = connection.exec_driver_sql(
+        "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'daily_logs'"
+    ).scalar()
+    if 'AUTOINCREMENT' not in table_sql.upper():
+        connection.exec_driver_sql("DROP INDEX IF EXISTS ix_daily_logs_user_date")
+        connection.exec_driver_sql("ALTER TABLE daily_logs RENAME TO daily_logs_old")
+        models.DailyLog.__table__.create(connection)
+        connection.exec_driver_sql(
+            "INSERT INTO daily_logs (id, telegram_id, date, time, data) "
+            "SELECT id, telegram_id, date, time, data FROM daily_logs_old"
+        )
+        connection.exec_driver_sql("DROP TABLE daily_logs_old")
+
+    high_water = connection.execute(text(
+        "SELECT MAX(COALESCE((SELECT MAX(id) FROM daily_logs), 0), "
+        "COALESCE((SELECT MAX(last_log_id) FROM daily_logs_archive), 0))"
+    )).scalar()
+    connection.execute(text("DELETE FROM sqlite_sequence WHERE name = 'daily_logs'"))
+    connection.execute(text("INSERT INTO sqlite_sequence (name, seq) VALUES ('daily_logs', :seq)"),
+                       {'seq': high_water})
+
+
+def _search_index_numbers(connection):
+    """Переиндексация истории: в индекс /search добавлены числа из текста записей"""
+    from search_index import reindex
+    reindex(connection)
+
+
+# Шаги применяются по порядку, каждый ровно один раз
+MIGRATIONS = [
+    (1, _initial_schema),
+    (2, _daily_logs_archive),
+    (3, _search_index),
+    (4, _llm_usage),
+    (5, _daily_logs_autoincrement),
+    (6, _search_index_numbers),
+]
+
+
+def migrate(bind=engine) -> int:
+    """Применяет недостающие миграции и возвращает текущую версию схемы"""
+    with bind.begin() as connection:
+        schema_migrations.create(connection, checkfirst=True)
+        applied = set(connection.execute(select(schema_migrations.c.version)).scalars())
+        for version, step in MIGRATIONS:
+            if version in applied:
+                continue
+            logger.info("Применяется миграция %d: %s", version, step.__name__)
+            step(connection)
+            connection.execute(schema_migrations.insert().values(version=version))
+    return MIGRATIONS[-1][0]
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    print(f"Версия схемы: {migrate()}")
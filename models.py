@@ -1,5 +1,5 @@
-from sqlalchemy import Column, Integer, String, Date, JSON, DateTime
-from database import Base, engine
+from sqlalchemy import Column, Integer, String, Date, JSON, DateTime, Float, Index, LargeBinary
+from database import Base
 
 class User(Base):
     __tablename__ = 'users'
@@ -15,4 +15,64 @@ class DailyLog(Base):
     time = Column(DateTime, nullable=False)
     data = Column(JSON)
 
-Base.metadata.create_all(engine)
\ No newline at end of file
+    # Выборки истории всегда идут по пользователю и дате. id не переиспользуются
+    # (AUTOINCREMENT): на них ссылаются архивные блоки и полнотекстовый индекс
+    __table_args__ = (
+        Index('ix_daily_logs_user_date', 'telegram_id', 'date'),
+        {'sqlite_autoincrement': True},
+    )
+
+class DailyLogArchive(Base):
+    """Архив старых записей: все записи пользователя за день одним сжатым блоком (см. archive.py)"""
+    __tablename__ = 'daily_logs_archive'
+    id = Column(Integer, primary_key=True)
+    telegram_id = Column(Integer, nullable=False)
+    date = Column(Date, nullable=False)
+    entries = Column(Integer, nullable=False)
+    last_log_id = Column(Integer, nullable=False)
+    codec = Column(String(8), nullable=False)
+    raw_size = Column(Integer, nullable=False)
+    payload = Column(LargeBinary, nullable=False)
+
+    __table_args__ = (
+        Index('ix_daily_logs_archive_user_date', 'telegram_id', 'date', unique=True),
+    )
+
+class LlmUsage(Base):
+    """Расход на один вызов LLM (см. usage_ledger.py); хранится LEDGER_RAW_RETENTION_DAYS дней"""
+    __tablename__ = 'llm_usage'
+    id = Column(Integer, primary_key=True)
+    time = Column(DateTime, nullable=False)
+    telegram_id = Column(Integer, nullable=False)
+    flow = Column(String(32), nullable=False)
+    model = Column(String(64), nullable=False)
+    prompt_tokens = Column(Integer, nullable=False)
+    completion_tokens = Column(Integer, nullable=False)
+    cached_tokens = Column(Integer, nullable=False)
+    latency_ms = Column(Integer, nullable=False)
+    cost_usd = Column(Float, nullable=False)
+
+    __table_args__ = (
+        Index('ix_llm_usage_time', 'time'),
+    )
+
+class LlmUsageDaily(Base):
+    """Дневные итоги расхода по пользователю, сценарию и модели"""
+    __tablename__ = 'llm_usage_daily'
+    id = Column(Integer, primary_key=True)
+    date = Column(Date, nullable=False)
+    telegram_id = Column(Integer, nullable=False)
+    flow = Column(String(32), nullable=False)
+    model = Column(String(64), nullable=False)
+    calls = Column(Integer, nullable=False)
+    prompt_tokens = Column(Integer, nullable=False)
+    completion_tokens = Column(Integer, nullable=False)
+    cached_tokens = Column(Integer, nullable=False)
+    latency_ms_sum = Column(Integer, nullable=False)
+    latency_ms_max = Column(Integer, nullable=False)
+    cost_usd = Column(Float, nullable=False)
+
+    # Ключ для накопления итогов (upsert) и выборок по диапазону дат
+    __table_args__ = (
+        Index('ix_llm_usage_daily_key', 'date', 'telegram_id', 'flow', 'model', unique=True),
+    )
@@ -0,0 +1,292 @@
+# nutrition_db.py
+
+import difflib
+import logging
+import mmap
+import os
+import re
+import struct
+from dataclasses import dataclass
+
+logger = logging.getLogger(__name__)
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+FOODS_CSV = os.path.join(DATA_DIR, 'foods.csv')
+FOODS_TABLE = os.path.join(DATA_DIR, 'foods.bin')
+
+# Формат таблицы: заголовок, затем строки фиксированной длины
+# (ккал, белки, жиры, углеводы на 100 г в десятых долях; вес штуки и порции в граммах;
+# смещение и длина имен в блоке строк), затем блок имен в UTF-8 ("имя|синоним|...")
+_MAGIC = b'FOOD1'
+_HEADER = struct.Struct('<5sI')
+_ROW = struct.Struct('<HHHHHHII')
+
+_UNIT_GRAMS = {'кг': 1000, 'г': 1, 'гр': 1, 'л': 1000, 'мл': 1}
+_UNIT_CUP = 250
+
+_NUMBER_WORDS = {
+    'один': 1, 'одна': 1, 'одно': 1, 'два': 2, 'две': 2, 'три': 3, 'четыре': 4,
+    'пять': 5, 'шесть': 6, 'половина': 0.5, 'пол': 0.5,
+}
+_QTY = r'(?P<qty>\d+(?:[.,]\d+)?|' + '|'.join(_NUMBER_WORDS) + r')'
+_UNIT = (
+    r'(?P<unit>кг|гр|грамм(?:а|ов)?|г|мл|л|шт|штук[аи]?|ломтик(?:а|ов)?|'
+    r'кус(?:ок|ка|ков|очек|очка|очков)|стакан(?:а|ов)?|чаш(?:ка|ки|ек)|'
+    r'тарелк[аи]|тарелок|порци(?:я|и|й))\.?'
+)
+_LEADING_PORTION = re.compile(rf'^(?:{_QTY}\s*)?(?:{_UNIT})?\s+(?P<name>.+)$')
+_TRAILING_PORTION = re.compile(rf'^(?P<name>.+?)\s+{_QTY}\s*(?:{_UNIT})?$')
+# Запятая между цифрами — десятичная ("0,5 кг"), а не разделитель позиций
+_ITEM_SEPARATORS = re.compile(r'(?<!\d),|,(?!\d)|[;\n+]|\s+и\s+')
+_WITH_SEPARATOR = re.compile(r'\s+с(?:о)?\s+')
+
+_ENDINGS = sorted([
+    'ами', 'ями', 'ого', 'его', 'ому', 'ему', 'ыми', 'ими', 'ах', 'ях', 'ов', 'ев', 'ей',
+    'ой', 'ый', 'ий', 'ая', 'яя', 'ое', 'ее', 'ые', 'ие', 'ую', 'юю', 'ом', 'ем', 'ам', 'ям',
+    'а', 'я', 'ы', 'и', 'у', 'ю', 'е', 'о', 'ь', 'й',
+], key=len, reverse=True)
+
+# Слова, которые не влияют на выбор продукта
+_COOKING_WORDS = {'отварн', 'варен', 'свеж', 'домашн', 'натуральн'}
+# Способы приготовления с маслом: в справочнике таких блюд нет, а отварной вариант
+# занизил бы калорийность, поэтому такие записи оценивает LLM
+_FAT_COOKING_WORDS = {'жарен', 'обжарен', 'запечен', 'тушен', 'фри', 'гриль', 'фритюр'}
+
+FUZZY_CUTOFF = 0.8
+# Порция больше этого веса — скорее опечатка ("огурец 999999"), ее оценивает LLM
+MAX_PORTION_GRAMS = 5000
+
+
+@dataclass(frozen=True)
+class FoodItem:
+    """Продукт из справочника и его пищевая ценность на 100 г"""
+    name: str
+    kcal: float
+    protein: float
+    fat: float
+    carbs: float
+    piece_g: int
+    serving_g: int
+
+
+@dataclass(frozen=True)
+class Portion:
+    """Найденный продукт с рассчитанным весом порции"""
+    food: FoodItem
+    grams: float
+    text: str
+
+    def nutrient(self, per_100g: float) -> int:
+        return round(per_100g * self.grams / 100)
+
+
+def _stem(word: str) -> str:
+    word = word.lower().replace('ё', 'е')
+    for ending in _ENDINGS:
+        if word.endswith(ending) and len(word) - len(ending) >= 3:
+            return word[:-len(ending)]
+    return word
+
+
+def normalize_name(name: str) -> str:
+    """Приводит название продукта к ключу индекса: стеммы слов через пробел"""
+    words = re.findall(r'[а-яёa-z-]+', name.lower())
+    return ' '.join(_stem(word) for word in words)
+
+
+def build_table(csv_path: str = FOODS_CSV, table_path: str = FOODS_TABLE) -> None:
+    """Собирает компактную бинарную таблицу из CSV-справочника"""
+    rows = []
+    names_blob = bytearray()
+    with open(csv_path, encoding='utf-8') as f:
+        next(f)  # заголовок
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            name, aliases, kcal, protein, fat, carbs, piece_g, serving_g = line.split(';')
+            names = '|'.join([name] + [a for a in aliases.split('|') if a]).encode('utf-8')
+            rows.append((
+                round(float(kcal) * 10), round(float(protein) * 10),
+                round(float(fat) * 10), round(float(carbs) * 10),
+                int(piece_g), int(serving_g), len(names_blob), len(names)
+            ))
+            names_blob += names
+
+    tmp_path = table_path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(_HEADER.pack(_MAGIC, len(rows)))
+        for row in rows:
+            f.write(_ROW.pack(*row))
+        f.write(names_blob)
+    os.replace(tmp_path, table_path)
+    logger.info("Собрана таблица продуктов: %d записей", len(rows))
+
+
+class NutritionDB:
+    """Справочник продуктов поверх memory-mapped таблицы с индексом по стеммам названий"""
+
+    def __init__(self, table_path: str = FOODS_TABLE):
+        with open(table_path, 'rb') as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self._count = _HEADER.unpack_from(self._mm, 0)
+        if magic != _MAGIC:
+            raise ValueError(f"Неверный формат таблицы продуктов: {table_path}")
+        self._names_offset = _HEADER.size + self._count * _ROW.size
+        self._index: dict[str, int] = {}
+        for row_id in range(self._count):
+            for name in self._names(row_id):
+                self._index.setdefault(normalize_name(name), row_id)
+        self._keys = list(self._index)
+
+    def __len__(self) -> int:
+        return self._count
+
+    def _names(self, row_id: int) -> list[str]:
+        *_, offset, length = _ROW.unpack_from(self._mm, _HEADER.size + row_id * _ROW.size)
+        start = self._names_offset + offset
+        return self._mm[start:start + length].decode('utf-8').split('|')
+
+    def _item(self, row_id: int) -> FoodItem:
+        kcal, protein, fat, carbs, piece_g, serving_g, _, _ = _ROW.unpack_from(
+            self._mm, _HEADER.size + row_id * _ROW.size
+        )
+        return FoodItem(
+            self._names(row_id)[0], kcal / 10, protein / 10, fat / 10, carbs / 10,
+            piece_g, serving_g
+        )
+
+    def lookup(self, name: str) -> FoodItem | None:
+        """Ищет продукт: точное совпадение ключа, затем без слов о способе готовки, затем нечетко"""
+        key = normalize_name(name)
+        if not key:
+            return None
+        row_id = self._index.get(key)
+        if row_id is None and any(word in _FAT_COOKING_WORDS for word in key.split()):
+            return None
+        if row_id is None:
+            stripped = ' '.join(w for w in key.split() if w not in _COOKING_WORDS)
+            row_id = self._index.get(stripped)
+            if row_id is None and stripped:
+                # Нечетко сравниваются только названия из того же числа слов: иначе общее
+                # "суп" или "салат" совпало бы с конкретным блюдом, а такое лучше оценит LLM
+                words = len(stripped.split())
+                keys = [k for k in self._keys if len(k.split()) == words]
+                match = difflib.get_close_matches(stripped, keys, n=1, cutoff=FUZZY_CUTOFF)
+                row_id = self._index[match[0]] if match else None
+        return self._item(row_id) if row_id is not None else None
+
+    def parse_portion(self, text: str) -> Portion | None:
+        """Разбирает одну позицию вида "200 г гречки", "2 яйца", "банан" """
+        text = text.strip().lower().rstrip('.!')
+        match = _LEADING_PORTION.match(text) or _TRAILING_PORTION.match(text)
+        qty, unit, name = None, None, text
+        if match:
+            qty = match.group('qty')
+            unit = match.group('unit')
+            if qty is not None:
+                qty = _NUMBER_WORDS.get(qty) or float(qty.replace(',', '.'))
+            elif unit is not None:
+                qty = 1  # "стакан кефира"
+            name = match.group('name')
+
+        if qty is not None and qty <= 0:
+            return None
+        food = self.lookup(name)
+        if food is None:
+            return None
+
+        piece = food.piece_g or food.serving_g
+        if qty is None:
+            # Одно название без количества — обычная порция ("пельмени", "пицца")
+            grams = food.serving_g
+        elif unit is None and qty >= 20:
+            grams = qty  # голое большое число — граммы ("гречка 200")
+        elif unit is None and qty < 1:
+            grams = qty * food.serving_g  # доля порции ("половина пиццы")
+        elif unit is None:
+            grams = qty * piece  # малое число — штуки ("2 яйца")
+        elif unit in _UNIT_GRAMS or unit.startswith('грамм'):
+            grams = qty * _UNIT_GRAMS.get(unit, 1)
+        elif unit.startswith(('стакан', 'чаш')):
+            grams = qty * _UNIT_CUP
+        elif unit.startswith(('тарел', 'порци')):
+            grams = qty * food.serving_g
+        else:  # штуки, ломтики, куски
+            grams = qty * piece
+        if grams > MAX_PORTION_GRAMS:
+            return None
+        return Portion(food, grams, text)
+
+    def parse_meal(self, text: str) -> tuple[list[Portion], list[str]]:
+        """Разбирает описание приема пищи на найденные позиции и нераспознанный остаток"""
+        portions, unmatched = [], []
+        for part in _ITEM_SEPARATORS.split(text):
+            part = part.strip()
+            if not part:
+                continue
+            portion = self.parse_portion(part)
+            if portion is not None:
+                portions.append(portion)
+                continue
+            # "гречка с курицей" -> отдельные компоненты
+            sub_parts = [p for p in _WITH_SEPARATOR.split(part) if p.strip()]
+            sub_portions = [self.parse_portion(p) for p in sub_parts] if len(sub_parts) > 1 else [None]
+            if all(sub_portions):
+                portions.extend(sub_portions)
+            else:
+                unmatched.append(part)
+        return portions, unmatched
+
+
+def format_estimate(portions: list[Portion]) -> str:
+    """Формирует ответ в том же размеченном формате, что и LLM"""
+    lines = []
+    totals = {'calories': 0, 'protein': 0, 'fat': 0, 'carbs': 0}
+    for p in portions:
+        calories = p.nutrient(p.food.kcal)
+        totals['calories'] += calories
+        totals['protein'] += p.nutrient(p.food.protein)
+        totals['fat'] += p.nutrient(p.food.fat)
+        totals['carbs'] += p.nutrient(p.food.carbs)
+        lines.append(f"{p.food.name} — {round(p.grams)} г: {calories} ккал")
+
+    return (
+        "[АНАЛИЗ]\n" + "\n".join(lines) + "\n"
+        "Оценка по справочнику продуктов.\n"
+        "[/АНАЛИЗ]\n"
+        "[НУТРИЕНТЫ]\n"
+        f"Калории: {totals['calories']} ккал\n"
+        f"Белки: {totals['protein']} г\n"
+        f"Жиры: {totals['fat']} г\n"
+        f"Углеводы: {totals['carbs']} г\n"
+        "[/НУТРИЕНТЫ]"
+    )
+
+
+_db: NutritionDB | None = None
+
+
+def load() -> NutritionDB:
+    """Загружает справочник (пересобирает таблицу, если CSV новее)"""
+    global _db
+    if _db is None:
+        if (
+            not os.path.exists(FOODS_TABLE)
+            or os.path.getmtime(FOODS_TABLE) < os.path.getmtime(FOODS_CSV)
+        ):
+            build_table()
+        _db = NutritionDB()
+        logger.info("Справочник продуктов загружен: %d записей", len(_db))
+    return _db
+
+
+def estimate_meal(text: str) -> str | None:
+    """
+    Оценивает прием пищи по справочнику.
+    Возвращает размеченный анализ, если распознаны все позиции, иначе None.
+    """
+    portions, unmatched = load().parse_meal(text)
+    if not portions or unmatched:
+        return None
+    return format_estimate(portions)
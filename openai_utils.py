@@ -1,22 +1,248 @@
+import asyncio
+import functools
+import hashlib
+import json
 import logging
-from openai import AsyncOpenAI
-from config import OPENAI_API_KEY
+import re
+import time
+from dataclasses import dataclass
+from admission import Level, admission
+from config import (
+    ADMISSION_DEGRADED_MAX_TOKENS, ADMISSION_SHORT_HISTORY, OPENAI_API_KEY, OPENAI_MODEL, OPENAI_MODEL_CHEAP,
+    OPENAI_MODEL_VISION,
+)
+from http_clients import openai_http_client, openai_timeout, pool_is_cold
+from llm_scheduler import Priority, estimate_tokens, scheduler
+from usage_ledger import ledger
+import metrics
 
 logger = logging.getLogger(__name__)
-client = AsyncOpenAI(api_key=OPENAI_API_KEY)
+_client = None
+_http_client = None
 
+# Прогрев соединения не должен задерживать ничего, кроме себя самого
+_WARM_UP_TIMEOUT = 5
+
+
+def get_client():
+    """AsyncOpenAI создается при первом запросе: импорт openai заметно замедляет старт процесса"""
+    global _client, _http_client
+    if _client is None:
+        from openai import AsyncOpenAI
+        _http_client = openai_http_client()
+        _client = AsyncOpenAI(api_key=OPENAI_API_KEY, http_client=_http_client)
+    return _client
+
+
+async def warm_up_connections() -> None:
+    """
+    Заранее открывает соединение (TCP + TLS) с API, если пул простаивал и keep-alive
+    соединения могли закрыться. HEAD на базовый адрес не требует ключа и не тарифицируется.
+    """
+    client = get_client()
+    if _http_client is None or not pool_is_cold('openai'):
+        return
+    try:
+        await _http_client.head(str(client.base_url), timeout=_WARM_UP_TIMEOUT)
+        metrics.incr('http_pool.warm_ups', client='openai')
+    except Exception as e:
+        logger.debug("Прогрев соединения с OpenAI не удался: %s", e)
+
+
+@dataclass(frozen=True)
+class Route:
+    """Уровень маршрутизации: модель и лимит ответа"""
+    tier: str
+    model: str
+    max_tokens: int
+
+
+ROUTES = {
+    'cheap': Route('cheap', OPENAI_MODEL_CHEAP, 400),
+    'default': Route('default', OPENAI_MODEL, 1000),
+    'vision': Route('vision', OPENAI_MODEL_VISION, 1000),
+}
+
+# Цена за 1M токенов (input, output) в USD — для оценки экономии от маршрутизации
+MODEL_PRICES = {
+    'gpt-4.1-nano': (0.10, 0.40),
+    'gpt-4o-mini': (0.15, 0.60),
+    'gpt-4o': (2.50, 10.00),
+}
+
+_ITEM_SEPARATORS = re.compile(r',|;|\+|\sи\s')
+_COMPLEX_MARKERS = re.compile(r'[?\n]|меню|ресторан|выбери|посоветуй|рецепт', re.IGNORECASE)
+_LOW_CONFIDENCE_MARKERS = re.compile(
+    r'не удалось|не могу|невозможно (?:определить|оценить)|сложно (?:определить|оценить)|не видно|неразборчив',
+    re.IGNORECASE
+)
+_CALORIES_VALUE = re.compile(r'(?:Калории|Сожжено):\s*(\d+)')
+
+
+def classify_text_request(text: str) -> str:
+    """
+    Определяет уровень сложности текстовой записи.
+    Короткие записи из 1–3 продуктов ("яблоко", "2 яйца и тост") идут в 'cheap',
+    меню, вопросы и длинные описания — в 'default'.
+    """
+    text = text.strip()
+    if (
+        len(text) <= 80
+        and len(_ITEM_SEPARATORS.split(text)) <= 3
+        and not _COMPLEX_MARKERS.search(text)
+    ):
+        return 'cheap'
+    return 'default'
+
+
+def is_low_confidence(analysis: str) -> bool:
+    """Ответ считается неуверенным, если модель сомневается или не дала калорийность"""
+    if _LOW_CONFIDENCE_MARKERS.search(analysis):
+        return True
+    match = _CALORIES_VALUE.search(analysis)
+    return match is None or int(match.group(1)) == 0
+
+
+# Потоки анализа еды: под нагрузкой в них отключаются рекомендации
+_ANALYSIS_FLOWS = ('photo', 'text')
+_NO_RECOMMENDATIONS_NOTE = (
+    "\n\nСейчас высокая нагрузка: ответь кратко и не добавляй секцию [РЕКОМЕНДАЦИИ]."
+)
+
+
+def _degrade(route: Route, messages: list[dict], flow: str, level: Level) -> tuple[Route, list[dict]]:
+    """Облегчает запрос в соответствии с уровнем деградации (см. admission.Level)"""
+    if level >= Level.NO_RECOMMENDATIONS and flow in _ANALYSIS_FLOWS:
+        messages = [dict(messages[0], content=messages[0]['content'] + _NO_RECOMMENDATIONS_NOTE)] + messages[1:]
+        route = Route(route.tier, route.model, min(route.max_tokens, ADMISSION_DEGRADED_MAX_TOKENS))
+    if level >= Level.SHORT_HISTORY:
+        # История дня передается ответами ассистента: оставляем только последние
+        history = [i for i, message in enumerate(messages) if message['role'] == 'assistant']
+        dropped = set(history[:-ADMISSION_SHORT_HISTORY] if ADMISSION_SHORT_HISTORY else history)
+        messages = [message for i, message in enumerate(messages) if i not in dropped]
+    if level >= Level.CHEAP_MODEL and route.model != OPENAI_MODEL_CHEAP:
+        route = Route('degraded', OPENAI_MODEL_CHEAP, route.max_tokens)
+    return route, messages
+
+
+def _cost(model: str, prompt_tokens: int, completion_tokens: int) -> float:
+    price_in, price_out = MODEL_PRICES.get(model, MODEL_PRICES['gpt-4o-mini'])
+    return (prompt_tokens * price_in + completion_tokens * price_out) / 1_000_000
+
+
+def _record_usage(route: Route, usage, flow: str, user_id: int | None, latency: float) -> None:
+    """
+    Пишет в метрики решение маршрутизатора, стоимость и экономию относительно 'default',
+    а в журнал расхода — запись о вызове
+    """
+    metrics.incr('router.requests', tier=route.tier, flow=flow)
+    if usage is None:
+        return
+    cost = _cost(route.model, usage.prompt_tokens, usage.completion_tokens)
+    ledger.record(user_id, flow, route.model, usage, latency, cost)
+    baseline = _cost(ROUTES['default'].model, usage.prompt_tokens, usage.completion_tokens)
+    metrics.incr('llm.tokens', usage.total_tokens, model=route.model)
+    metrics.incr('llm.cost_usd', cost, model=route.model)
+    metrics.incr('router.saved_usd', baseline - cost, flow=flow)
+
+
+async def _chat(route: Route, messages: list[dict], flow: str, *,
+                user_id: int | None = None, priority: Priority = Priority.INTERACTIVE, **kwargs) -> str:
+    """
+    Единая точка вызова chat.completions: проходит контроль допуска (под нагрузкой запрос
+    облегчается или отклоняется с Overloaded), резервирует бюджет токенов в планировщике,
+    подстраивает его по заголовкам лимитов провайдера и пишет метрики.
+    """
+    route, messages = _degrade(route, messages, flow, admission.admit(priority, flow))
+    async with scheduler.reserve(user_id, estimate_tokens(messages, route.max_tokens), priority) as reservation:
+        started = time.perf_counter()
+        admission.started()
+        try:
+            raw = await get_client().chat.completions.with_raw_response.create(
+                model=route.model,
+                messages=messages,
+                max_tokens=route.max_tokens,
+                timeout=openai_timeout(flow),
+                **kwargs
+            )
+        finally:
+            admission.finished(time.perf_counter() - started)
+        scheduler.update_from_headers(raw.headers)
+        resp = raw.parse()
+        latency = time.perf_counter() - started
+        metrics.observe('llm.latency', latency, flow=flow, model=route.model)
+        if resp.usage is not None:
+            reservation['used'] = resp.usage.total_tokens
+        _record_usage(route, resp.usage, flow, user_id, latency)
+    return resp.choices[0].message.content.strip()
+
+
+_inflight: dict[str, asyncio.Task] = {}
+
+
+def _normalize_arg(value):
+    if isinstance(value, str):
+        return ' '.join(value.split())
+    if isinstance(value, (list, tuple)):
+        return [_normalize_arg(v) for v in value]
+    if isinstance(value, dict):
+        return {k: _normalize_arg(v) for k, v in value.items()}
+    return value
+
+
+def _request_key(name: str, args: tuple, kwargs: dict) -> str:
+    payload = json.dumps(
+        [name, _normalize_arg(args), _normalize_arg(kwargs)],
+        ensure_ascii=False, sort_keys=True, default=str
+    )
+    return hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
+
+def _forget_inflight(key: str, task: asyncio.Task) -> None:
+    if _inflight.get(key) is task:
+        del _inflight[key]
+    if not task.cancelled():
+        task.exception()  # помечаем исключение как полученное, даже если ждать некому
+
+
+def single_flight(func):
+    """
+    Объединяет одновременные одинаковые запросы: вызовы с тем же нормализованным
+    набором аргументов ждут одну общую задачу вместо повторного обращения к API.
+    Отмена одного из ожидающих не отменяет общий запрос.
+    """
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        key = _request_key(func.__name__, args, kwargs)
+        task = _inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(func(*args, **kwargs))
+            _inflight[key] = task
+            task.add_done_callback(functools.partial(_forget_inflight, key))
+        else:
+            logger.debug("Запрос %s уже выполняется, ждем его результат", func.__name__)
+            metrics.incr('singleflight.coalesced', func=func.__name__)
+        return await asyncio.shield(task)
+    return wrapper
+
+
+@single_flight
 async def analyze_food_image(
     image_url: str,
     system_prompt: str,
     history: list[str] | None = None,
-    user_caption: str | None = None
+    user_caption: str | None = None,
+    *,
+    user_id: int | None = None,
+    priority: Priority = Priority.INTERACTIVE
 ) -> str:
     """
-    Анализ фото по его публичному URL.
-    - image_url: URL картинки (telegram.org/file/…)
+    Анализ фото по URL.
+    - image_url: URL картинки или data URL из photo_store
     - system_prompt: ваш промпт
     - history: тексты прошлых ответов за день
     - user_caption: подпись к фото (если есть)
+    - user_id, priority: для планировщика бюджета токенов
     """
     try:
         # 1) Собираем систему и историю
@@ -55,24 +281,27 @@ async def analyze_food_image(
         for msg in messages:
             logger.debug("%s %s", msg["role"], msg["content"] if msg["role"]!="user" else "[USER image/text items]")
 
-        # 4) Отправляем
-        resp = await client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=messages,
-            max_tokens=1000,
-            temperature=0.7
-        )
-        return resp.choices[0].message.content.strip()
+        # 4) Отправляем; при неуверенном ответе повторяем на более сильной vision-модели
+        analysis = await _chat(ROUTES['default'], messages, 'photo', user_id=user_id, priority=priority, temperature=0.7)
+        if is_low_confidence(analysis) and admission.level < Level.CHEAP_MODEL:
+            logger.info("Неуверенный анализ фото, эскалация на %s", ROUTES['vision'].model)
+            metrics.incr('router.escalations', flow='photo')
+            analysis = await _chat(ROUTES['vision'], messages, 'photo', user_id=user_id, priority=priority, temperature=0.7)
+        return analysis
         
     except Exception as e:
         logger.error("Ошибка при анализе фото: %s", str(e), exc_info=True)
         raise
 
 
+@single_flight
 async def analyze_food_text(
     text: str,
     system_prompt: str,
-    history: list[str] | None = None
+    history: list[str] | None = None,
+    *,
+    user_id: int | None = None,
+    priority: Priority = Priority.INTERACTIVE
 ) -> str:
     """
     Анализ текстового описания еды.
@@ -83,23 +312,28 @@ async def analyze_food_text(
             messages.append({"role": "assistant", "content": prev})
     messages.append({"role": "user", "content": text})
 
-    logger.debug("=== analyze_food_text REQUEST ===")
+    tier = classify_text_request(text)
+    logger.debug("=== analyze_food_text REQUEST (%s) ===", tier)
     for msg in messages:
         logger.debug("%s %s", msg["role"], msg["content"])
 
-    resp = await client.chat.completions.create(
-        model="gpt-4o-mini",
-        messages=messages,
-        max_tokens=1000
-    )
-    return resp.choices[0].message.content.strip()
+    analysis = await _chat(ROUTES[tier], messages, 'text', user_id=user_id, priority=priority)
+    if tier == 'cheap' and is_low_confidence(analysis) and admission.level < Level.CHEAP_MODEL:
+        logger.info("Неуверенный ответ дешевой модели, эскалация на %s", ROUTES['default'].model)
+        metrics.incr('router.escalations', flow='text')
+        analysis = await _chat(ROUTES['default'], messages, 'text', user_id=user_id, priority=priority)
+    return analysis
 
 
+@single_flight
 async def summarize_daily_intake(
     system_prompt: str,
     history: list[str],
     totals: dict,
-    goals: dict
+    goals: dict,
+    *,
+    user_id: int | None = None,
+    priority: Priority = Priority.BACKGROUND
 ) -> str:
     """
     Подведение итогов дня.
@@ -119,20 +353,21 @@ async def summarize_daily_intake(
         {"role": "user", "content": f"Проанализируй день и дай рекомендации:\n{summary}"}
     ]
 
-    resp = await client.chat.completions.create(
-        model="gpt-4o-mini",
-        messages=messages,
-        max_tokens=1000
-    )
-    return resp.choices[0].message.content.strip()
+    return await _chat(ROUTES['default'], messages, 'summary', user_id=user_id, priority=priority)
 
+@single_flight
 async def get_recommendations(
     system_prompt: str,
     history: list[str] | None = None,
-    query: str | None = None
+    query: str | None = None,
+    *,
+    user_id: int | None = None,
+    priority: Priority = Priority.INTERACTIVE,
+    flow: str = 'recommendations'
 ) -> str:
     """
     Получение рекомендаций на основе истории и текущего запроса.
+    flow — сценарий вызова для метрик и журнала расхода ('day_end', 'advice', 'query').
     """
     messages: list[dict] = [{"role": "system", "content": system_prompt}]
     if history:
@@ -141,9 +376,4 @@ async def get_recommendations(
     if query:
         messages.append({"role": "user", "content": query})
 
-    resp = await client.chat.completions.create(
-        model="gpt-4o-mini",
-        messages=messages,
-        max_tokens=1000
-    )
-    return resp.choices[0].message.content.strip()
+    return await _chat(ROUTES['default'], messages, flow, user_id=user_id, priority=priority)
@@ -0,0 +1,108 @@
+# photo_store.py
+
+import asyncio
+import base64
+import hashlib
+import importlib.util
+import io
+import logging
+import mmap
+import os
+import tempfile
+
+from config import PHOTO_STORE_DIR, PHOTO_THUMB_SIZE, PHOTO_VISION_SIZE, PHOTO_JPEG_QUALITY
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Уменьшенные копии строятся через Pillow; без него хранится только оригинал,
+# и он же отдается модели
+PIL_AVAILABLE = importlib.util.find_spec('PIL') is not None
+
+# Относительный PHOTO_STORE_DIR считается от каталога бота, а не от текущего каталога процесса
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+ORIGINAL = 'orig'
+THUMBNAIL = 'thumb'
+VISION = 'vision'
+
+_SIZES = {VISION: PHOTO_VISION_SIZE, THUMBNAIL: PHOTO_THUMB_SIZE}
+
+
+class PhotoStore:
+    """
+    Локальное хранилище фото с адресацией по содержимому.
+    - ключ — sha256 исходных байтов, одинаковые фото хранятся один раз;
+    - файлы раскладываются по каталогам ab/cd/<ключ>.<вариант>.jpg, чтобы в одном
+      каталоге не скапливались сотни тысяч файлов;
+    - запись атомарная (временный файл + rename), чтение — через mmap;
+    - копия для модели строится до запроса к ней, миниатюра — в фоне.
+    """
+
+    def __init__(self, root: str = PHOTO_STORE_DIR):
+        self.root = os.path.join(BASE_DIR, root)
+
+    def path(self, key: str, variant: str = ORIGINAL) -> str:
+        return os.path.join(self.root, key[:2], key[2:4], f'{key}.{variant}.jpg')
+
+    def exists(self, key: str, variant: str = ORIGINAL) -> bool:
+        return os.path.exists(self.path(key, variant))
+
+    def _write(self, path: str, data: bytes) -> None:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def put(self, data: bytes) -> tuple[str, bool]:
+        """Сохраняет оригинал; возвращает (ключ, True, если такого фото еще не было)"""
+        key = hashlib.sha256(data).hexdigest()
+        path = self.path(key)
+        if os.path.exists(path):
+            metrics.incr('photo_store.deduplicated')
+            return key, False
+        self._write(path, data)
+        metrics.incr('photo_store.stored')
+        metrics.incr('photo_store.bytes', len(data))
+        return key, True
+
+    def read(self, key: str, variant: str = ORIGINAL) -> bytes:
+        """Читает вариант фото через mmap; если варианта еще нет — оригинал"""
+        path = self.path(key, variant)
+        if variant != ORIGINAL and not os.path.exists(path):
+            path = self.path(key)
+        with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            return mapped[:]
+
+    def data_url(self, key: str, variant: str = VISION) -> str:
+        """Фото в виде data URL для vision-запроса: модели не нужен доступ к файлам Telegram"""
+        return 'data:image/jpeg;base64,' + base64.b64encode(self.read(key, variant)).decode('ascii')
+
+    def build_derivatives(self, key: str, variants: tuple[str, ...] = (VISION, THUMBNAIL)) -> None:
+        """Строит недостающие уменьшенные копии (по длинной стороне, JPEG): миниатюру и копию для модели"""
+        variants = [variant for variant in variants if not self.exists(key, variant)]
+        if not PIL_AVAILABLE or not variants:
+            return
+        from PIL import Image
+
+        with Image.open(io.BytesIO(self.read(key))) as image:
+            image = image.convert('RGB')
+            for variant in variants:
+                size = _SIZES[variant]
+                copy = image.copy()
+                copy.thumbnail((size, size))
+                out = io.BytesIO()
+                copy.save(out, 'JPEG', quality=PHOTO_JPEG_QUALITY, optimize=True)
+                self._write(self.path(key, variant), out.getvalue())
+                metrics.incr('photo_store.bytes', out.tell(), variant=variant)
+
+    async def build_derivatives_async(self, key: str, variants: tuple[str, ...] = (VISION, THUMBNAIL)) -> None:
+        await asyncio.to_thread(self.build_derivatives, key, variants)
+
+
+photo_store = PhotoStore()
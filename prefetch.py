@@ -0,0 +1,87 @@
+# prefetch.py
+
+import asyncio
+import logging
+
+from config import PREFETCH_ENABLED, PREFETCH_TTL
+import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class Prefetcher:
+    """
+    Упреждающие задачи для следующего шага пользователя, который почти наверняка известен:
+    после выбора типа приема пищи приходит фото, после дня в истории — соседний день.
+    - задача адресуется парой (telegram_id, name); повторный schedule того же имени
+      заменяет прежнюю задачу, cancel(prefix) снимает задачи, когда пользователь ушел;
+    - result() забирает результат (дожидаясь задачи, если она еще идет) ровно один раз;
+    - незабранный результат выбрасывается через ttl секунд.
+    Ошибка упреждающей задачи не видна пользователю: обработчик просто сделает работу сам.
+    Отмена снимает только ожидание: работа, уже отданная в поток (asyncio.to_thread),
+    доходит до конца, поэтому ее результат должен быть безопасен и без получателя.
+    """
+
+    def __init__(self, ttl: float = PREFETCH_TTL, enabled: bool = PREFETCH_ENABLED):
+        self.ttl = ttl
+        self.enabled = enabled
+        self._tasks: dict[tuple[int, str], asyncio.Task] = {}
+
+    def __len__(self) -> int:
+        return len(self._tasks)
+
+    def schedule(self, telegram_id: int, name: str, func, *args) -> None:
+        """Запускает func(*args) в фоне; func — корутинная функция"""
+        if not self.enabled:
+            return
+        key = (telegram_id, name)
+        previous = self._tasks.pop(key, None)
+        if previous is not None:
+            self._discard(previous)
+        task = asyncio.get_running_loop().create_task(func(*args))
+        task.add_done_callback(self._done)
+        self._tasks[key] = task
+        asyncio.get_running_loop().call_later(self.ttl, self._expire, key, task)
+        metrics.incr('prefetch.scheduled', kind=name.split(':', 1)[0])
+
+    def _done(self, task: asyncio.Task) -> None:
+        if not task.cancelled() and task.exception() is not None:
+            logger.debug("Упреждающая задача завершилась ошибкой: %s", task.exception())
+            metrics.incr('prefetch.errors')
+
+    def _discard(self, task: asyncio.Task) -> None:
+        if task.done():
+            metrics.incr('prefetch.wasted')
+        else:
+            task.cancel()
+            metrics.incr('prefetch.cancelled')
+
+    def _expire(self, key: tuple[int, str], task: asyncio.Task) -> None:
+        if self._tasks.get(key) is task:
+            del self._tasks[key]
+            self._discard(task)
+
+    def cancel(self, telegram_id: int, prefix: str = '') -> None:
+        """Снимает задачи пользователя, имя которых начинается с prefix"""
+        for key in [key for key in self._tasks if key[0] == telegram_id and key[1].startswith(prefix)]:
+            self._discard(self._tasks.pop(key))
+
+    async def result(self, telegram_id: int, name: str):
+        """Результат задачи или None, если ее не было, она отменена или упала"""
+        task = self._tasks.pop((telegram_id, name), None)
+        if task is None:
+            metrics.incr('prefetch.misses', kind=name.split(':', 1)[0])
+            return None
+        try:
+            result = await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if not task.cancelled():
+                raise
+            return None
+        except Exception:
+            return None
+        metrics.incr('prefetch.hits', kind=name.split(':', 1)[0])
+        return result
+
+
+prefetcher = Prefetcher()
@@ -0,0 +1,286 @@
+# profiling.py
+
+import asyncio
+import datetime
+import functools
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter, defaultdict
+
+from telegram import Update
+from telegram.ext import ConversationHandler, TypeHandler
+
+from config import (
+    PROFILE_DEFAULT_SECONDS, PROFILE_DIR, PROFILE_INTERVAL, PROFILE_MAX_SECONDS, PROFILE_TOP_ALLOCATIONS,
+)
+from jobs import runner
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Счетчик обновлений стоит в последней группе: обновление засчитывается после всех обработчиков
+_COUNT_GROUP = 1000
+_MAX_STACK_DEPTH = 128
+_EVENT_LOOP = 'event_loop'
+# Строк по обработчикам в уведомлении (полный список — в файле .handlers.txt)
+_NOTIFY_TOP = 15
+
+
+def _handlers(application):
+    """Обработчики приложения, включая вложенные в ConversationHandler"""
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            if isinstance(handler, ConversationHandler):
+                yield from handler.entry_points
+                for state_handlers in handler.states.values():
+                    yield from state_handlers
+                yield from handler.fallbacks
+            else:
+                yield handler
+
+
+class Profiler:
+    """
+    Сэмплирующий профайлер, включаемый на время: на N секунд или N обновлений.
+    - отдельный поток раз в interval снимает стеки всех потоков; стек потока
+      event loop относится к обработчику, чья корутина в нем выполняется
+      (handle_photo, end_day, ...), простой цикла — к event_loop;
+    - обертки на callback обработчиков считают вызовы и полное время с ожиданиями;
+    - tracemalloc показывает места, где за время профилирования выделено больше всего памяти.
+    Результат — файлы в directory: .folded (flamegraph.pl, speedscope), .handlers.txt и .alloc.txt.
+    Пока профилирование выключено, ничего из этого не установлено и накладных расходов нет.
+    """
+
+    def __init__(self, directory: str = PROFILE_DIR, interval: float = PROFILE_INTERVAL,
+                 top_allocations: int = PROFILE_TOP_ALLOCATIONS):
+        self.directory = directory
+        self.interval = interval
+        self.top_allocations = top_allocations
+        self._thread: threading.Thread | None = None
+        self._stop = threading.Event()
+        self._stacks: Counter = Counter()
+        self._wall: dict[str, list[float]] = defaultdict(list)
+        self._handler_codes: dict = {}
+        self._originals: list = []
+        self._counter = TypeHandler(Update, self._count)
+        self._application = None
+        self._notify = None
+        self._timer = None
+        self._loop_thread = None
+        self._owns_tracemalloc = False
+        self._finishing = False
+        self._updates = 0
+        self._max_updates = None
+        self._started_at = 0.0
+
+    @property
+    def active(self) -> bool:
+        return self._thread is not None
+
+    def start(self, application, seconds: float | None = None, updates: int | None = None,
+              notify=None) -> bool:
+        """
+        Включает профилирование; False, если оно уже идет. Без updates длится seconds
+        (по умолчанию PROFILE_DEFAULT_SECONDS), с updates — до N обработанных обновлений,
+        но не дольше PROFILE_MAX_SECONDS. notify(summary, paths) вызывается по окончании.
+        """
+        if self.active:
+            return False
+        self._application = application
+        self._notify = notify
+        self._loop_thread = threading.get_ident()
+        self._stacks = Counter()
+        self._wall = defaultdict(list)
+        self._updates = 0
+        self._max_updates = updates
+        self._instrument(application)
+        if updates:
+            application.add_handler(self._counter, group=_COUNT_GROUP)
+
+        self._owns_tracemalloc = not tracemalloc.is_tracing()
+        if self._owns_tracemalloc:
+            tracemalloc.start()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._sample, name='profiler', daemon=True)
+        self._thread.start()
+        self._started_at = time.monotonic()
+
+        limit = PROFILE_MAX_SECONDS if updates else min(seconds or PROFILE_DEFAULT_SECONDS, PROFILE_MAX_SECONDS)
+        self._timer = asyncio.get_running_loop().call_later(limit, self._request_finish)
+        metrics.set_gauge('profiler.active', 1)
+        logger.warning("Профилирование включено: %s", f"{updates} обновлений" if updates else f"{limit} с")
+        return True
+
+    def _request_finish(self) -> None:
+        runner.submit('profile_finish', self.finish)
+
+    def _instrument(self, application) -> None:
+        seen = set()
+        for handler in _handlers(application):
+            callback = getattr(handler, 'callback', None)
+            if callback is None or id(handler) in seen:
+                continue
+            seen.add(id(handler))
+            name = getattr(callback, '__name__', type(callback).__name__)
+            code = getattr(callback, '__code__', None)
+            if code is not None:
+                self._handler_codes[code] = name
+            self._originals.append((handler, callback))
+            handler.callback = self._timed(callback, name)
+
+    def _timed(self, callback, name: str):
+        @functools.wraps(callback)
+        async def timed(update, context):
+            started = time.perf_counter()
+            try:
+                return await callback(update, context)
+            finally:
+                self._wall[name].append(time.perf_counter() - started)
+        return timed
+
+    def _restore(self) -> None:
+        for handler, callback in self._originals:
+            handler.callback = callback
+        self._originals.clear()
+        self._handler_codes.clear()
+
+    async def _count(self, update: Update, context) -> None:
+        self._updates += 1
+        if self._updates == self._max_updates:
+            self._request_finish()
+
+    def _sample(self) -> None:
+        """Поток сэмплирования: складывает стеки в формате folded (корень;...;лист)"""
+        own = threading.get_ident()
+        names = {}
+        while not self._stop.wait(self.interval):
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                if ident not in names:
+                    names = {thread.ident: thread.name for thread in threading.enumerate()}
+                self._stacks[self._fold(frame, ident, names)] += 1
+
+    def _fold(self, frame, ident: int, names: dict) -> str:
+        labels = []
+        handler = None
+        while frame is not None and len(labels) < _MAX_STACK_DEPTH:
+            code = frame.f_code
+            labels.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+            # Самый внешний обработчик: handle_voice вызывает handle_text, время относится к handle_voice
+            handler = self._handler_codes.get(code, handler)
+            frame = frame.f_back
+        if ident == self._loop_thread:
+            root = handler or _EVENT_LOOP
+        else:
+            root = f"thread:{names.get(ident, ident)}"
+        labels.append(f'[{root}]')
+        return ';'.join(reversed(labels))
+
+    async def finish(self) -> list[str]:
+        """
+        Останавливает профилирование и пишет результаты; возвращает пути к файлам.
+        Повторный вызов, пока идет завершение (таймер и /profile stop одновременно), ничего не делает.
+        """
+        if not self.active or self._finishing:
+            return []
+        self._finishing = True
+        try:
+            self._timer.cancel()
+            self._stop.set()
+            await asyncio.to_thread(self._thread.join)
+            self._restore()
+            if self._max_updates:
+                self._application.remove_handler(self._counter, group=_COUNT_GROUP)
+            duration = time.monotonic() - self._started_at
+            # Снимок tracemalloc и запись файлов занимают заметное время — не в event loop
+            paths = await asyncio.to_thread(self._write, duration)
+            summary = self.summary(duration, _NOTIFY_TOP)
+        finally:
+            self._thread = None
+            self._finishing = False
+        metrics.set_gauge('profiler.active', 0)
+        logger.warning("Профилирование завершено, результаты: %s", ', '.join(paths))
+        if self._notify is not None:
+            try:
+                await self._notify(summary, paths)
+            except Exception as e:
+                logger.error("Не удалось отправить итоги профилирования: %s", e)
+        return paths
+
+    def handler_rows(self, duration: float) -> list[tuple]:
+        """
+        (обработчик, вызовов, среднее время, максимум, время в event loop) по убыванию времени в loop.
+        Время в loop — доля сэмплов потока цикла, умноженная на длительность: поток сэмплирования
+        ждет GIL и снимает стеки реже interval, поэтому число сэмплов на interval не умножается.
+        """
+        loop_samples = Counter()
+        for stack, count in self._stacks.items():
+            loop_samples[stack[1:stack.index(']')]] += count
+        loop_total = sum(count for name, count in loop_samples.items() if not name.startswith('thread:'))
+        rows = []
+        for name in set(self._wall) | {n for n in loop_samples if n != _EVENT_LOOP and not n.startswith('thread:')}:
+            wall = self._wall.get(name, [])
+            rows.append((
+                name, len(wall), sum(wall) / len(wall) if wall else 0.0, max(wall, default=0.0),
+                loop_samples[name] / loop_total * duration if loop_total else 0.0,
+            ))
+        rows.sort(key=lambda row: -row[4])
+        return rows
+
+    def summary(self, duration: float, limit: int | None = None) -> str:
+        samples = sum(self._stacks.values())
+        lines = [f"Профиль за {duration:.0f} с: {self._updates or '—'} обновлений, {samples} сэмплов"]
+        for name, calls, avg, longest, loop_time in self.handler_rows(duration)[:limit]:
+            lines.append(
+                f"{name}: {calls} выз., среднее {avg * 1e3:.0f} мс, макс. {longest * 1e3:.0f} мс, "
+                f"в event loop {loop_time:.2f} с"
+            )
+        return '\n'.join(lines)
+
+    def _write(self, duration: float) -> list[str]:
+        snapshot = tracemalloc.take_snapshot() if tracemalloc.is_tracing() else None
+        if self._owns_tracemalloc:
+            tracemalloc.stop()
+        os.makedirs(self.directory, exist_ok=True)
+        base = os.path.join(self.directory, f"{datetime.datetime.now():%Y%m%d-%H%M%S}-{os.getpid()}")
+
+        paths = [base + '.folded', base + '.handlers.txt']
+        with open(paths[0], 'w', encoding='utf-8') as f:
+            for stack, count in self._stacks.most_common():
+                f.write(f'{stack} {count}\n')
+        with open(paths[1], 'w', encoding='utf-8') as f:
+            f.write(self.summary(duration) + '\n')
+
+        if snapshot is not None:
+            paths.append(base + '.alloc.txt')
+            snapshot = snapshot.filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+            with open(paths[2], 'w', encoding='utf-8') as f:
+                for stat in snapshot.statistics('lineno')[:self.top_allocations]:
+                    f.write(f'{stat}\n')
+        return paths
+
+
+profiler = Profiler()
+
+
+def install_signal_handler(application) -> None:
+    """SIGUSR1 включает профилирование на PROFILE_DEFAULT_SECONDS, повторный сигнал — завершает досрочно"""
+    if not hasattr(signal, 'SIGUSR1'):
+        return
+
+    def toggle():
+        if profiler.active:
+            runner.submit('profile_finish', profiler.finish)
+        else:
+            profiler.start(application, PROFILE_DEFAULT_SECONDS)
+
+    try:
+        asyncio.get_running_loop().add_signal_handler(signal.SIGUSR1, toggle)
+    except (NotImplementedError, RuntimeError):
+        logger.info("Сигналы в этом event loop не поддерживаются, профилирование доступно через /profile")
@@ -0,0 +1,163 @@
+# report_cache.py
+
+import datetime
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+from sqlalchemy import event
+
+from archive import last_log_id
+from config import REPORT_CACHE_MAX_BYTES, REPORT_CACHE_RECHECK_SECONDS
+from database import Session
+from models import DailyLog
+import metrics
+
+# Примерные накладные расходы на ключ и служебные структуры одной записи
+_ENTRY_OVERHEAD = 200
+
+
+class ReportCache:
+    """
+    LRU-кэш отрисованных отчетов за день с ограничением по суммарному объему.
+    Ключ — (telegram_id, date, last_log_id): прошедшие дни не меняются, а любая новая
+    или измененная запись DailyLog за дату сбрасывает отчет через события SQLAlchemy.
+    События не видят записей, добавленных в обход ORM или другим процессом (bulk_io),
+    поэтому отчет, не сверявшийся дольше recheck_seconds, при обращении сверяется
+    с последним id за день в БД (latest); остальные попадания обходятся без запросов к БД.
+    Пустые дни тоже кэшируются (отчет None, last_log_id 0).
+    Сброс, пришедший, пока отчет строится (в том числе заранее в потоке), отменяет
+    его сохранение: у каждой даты с незавершенной отрисовкой есть поколение сбросов.
+    """
+
+    def __init__(self, max_bytes: int = REPORT_CACHE_MAX_BYTES,
+                 recheck_seconds: float = REPORT_CACHE_RECHECK_SECONDS, latest=None):
+        self.max_bytes = max_bytes
+        self.recheck_seconds = recheck_seconds
+        self.latest = latest or _latest_log_id
+        self._lock = threading.Lock()
+        self._entries: OrderedDict[tuple[int, datetime.date, int], str | None] = OrderedDict()
+        self._keys: dict[tuple[int, datetime.date], tuple[int, datetime.date, int]] = {}
+        # (telegram_id, date) -> время последней сверки с БД (time.monotonic)
+        self._checked: dict[tuple[int, datetime.date], float] = {}
+        self._size = 0
+        self._generation = 0
+        # (telegram_id, date) -> [незавершенных отрисовок, поколение последнего сброса]
+        self._rendering: dict[tuple[int, datetime.date], list[int]] = {}
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @staticmethod
+    def _entry_size(report: str | None) -> int:
+        return _ENTRY_OVERHEAD + (sys.getsizeof(report) if report is not None else 0)
+
+    def lookup(self, telegram_id: int, date: datetime.date) -> tuple[bool, str | None]:
+        """(True, отчет), если отчет за дату есть в кэше и не устарел, иначе (False, None)"""
+        with self._lock:
+            key = self._keys.get((telegram_id, date))
+            recheck = key is not None and \
+                time.monotonic() - self._checked[(telegram_id, date)] >= self.recheck_seconds
+        if recheck:
+            # Запрос к БД — вне блокировки: кэш читают и потоки упреждающей отрисовки
+            current = self.latest(telegram_id, date)
+        with self._lock:
+            if recheck and self._keys.get((telegram_id, date)) == key:
+                if key[2] != current:
+                    self._remove(telegram_id, date)
+                    metrics.incr('report_cache.stale')
+                else:
+                    self._checked[(telegram_id, date)] = time.monotonic()
+            key = self._keys.get((telegram_id, date))
+            if key is None:
+                metrics.incr('report_cache.misses')
+                return False, None
+            self._entries.move_to_end(key)
+            metrics.incr('report_cache.hits')
+            return True, self._entries[key]
+
+    def put(self, telegram_id: int, date: datetime.date, last_log_id: int, report: str | None,
+            generation: int | None = None) -> None:
+        """generation — значение begin_render: если с тех пор дата сбрасывалась, отчет устарел и не сохраняется"""
+        with self._lock:
+            rendering = self._rendering.get((telegram_id, date))
+            if generation is not None and rendering is not None and rendering[1] > generation:
+                metrics.incr('report_cache.stale_puts')
+                return
+            self._remove(telegram_id, date)
+            key = (telegram_id, date, last_log_id)
+            self._entries[key] = report
+            self._keys[(telegram_id, date)] = key
+            self._checked[(telegram_id, date)] = time.monotonic()
+            self._size += self._entry_size(report)
+            while self._size > self.max_bytes and len(self._entries) > 1:
+                oldest = next(iter(self._entries))
+                self._remove(oldest[0], oldest[1])
+            metrics.set_gauge('report_cache.entries', len(self._entries))
+            metrics.set_gauge('report_cache.bytes', self._size)
+
+    def get_or_render(self, telegram_id: int, date: datetime.date, render) -> str | None:
+        """
+        Возвращает отчет из кэша или строит его через render(telegram_id, date),
+        который возвращает (last_log_id, отчет или None).
+        """
+        found, report = self.lookup(telegram_id, date)
+        if found:
+            return report
+        generation = self.begin_render(telegram_id, date)
+        try:
+            last_log_id, report = render(telegram_id, date)
+            self.put(telegram_id, date, last_log_id, report, generation)
+        finally:
+            self.end_render(telegram_id, date)
+        return report
+
+    def begin_render(self, telegram_id: int, date: datetime.date) -> int:
+        with self._lock:
+            self._rendering.setdefault((telegram_id, date), [0, 0])[0] += 1
+            return self._generation
+
+    def end_render(self, telegram_id: int, date: datetime.date) -> None:
+        with self._lock:
+            rendering = self._rendering[(telegram_id, date)]
+            rendering[0] -= 1
+            if not rendering[0]:
+                del self._rendering[(telegram_id, date)]
+
+    def invalidate(self, telegram_id: int, date: datetime.date) -> None:
+        with self._lock:
+            self._generation += 1
+            rendering = self._rendering.get((telegram_id, date))
+            if rendering is not None:
+                rendering[1] = self._generation
+            if self._remove(telegram_id, date):
+                metrics.incr('report_cache.invalidations')
+
+    def _remove(self, telegram_id: int, date: datetime.date) -> bool:
+        key = self._keys.pop((telegram_id, date), None)
+        if key is None:
+            return False
+        del self._checked[(telegram_id, date)]
+        self._size -= self._entry_size(self._entries.pop(key))
+        return True
+
+
+def _latest_log_id(telegram_id: int, date: datetime.date) -> int:
+    session = Session()
+    try:
+        return last_log_id(session, telegram_id, date)
+    finally:
+        session.close()
+
+
+day_reports = ReportCache()
+
+
+@event.listens_for(DailyLog, 'after_insert')
+@event.listens_for(DailyLog, 'after_update')
+@event.listens_for(DailyLog, 'after_delete')
+def _invalidate_day_report(mapper, connection, target):
+    """Сбрасывает отчет за дату, в которой появилась, изменилась или удалена запись"""
+    if target.date is not None:
+        day_reports.invalidate(target.telegram_id, target.date)
@@ -0,0 +1,88 @@
+# response_parser.py
+
+import re
+from dataclasses import dataclass, field
+from functools import lru_cache
+
+SECTIONS = ('АНАЛИЗ', 'НУТРИЕНТЫ', 'КАЛОРИИ', 'РЕКОМЕНДАЦИИ')
+
+# Поле ответа -> (секция, в которой оно учитывается, ключ результата)
+_FIELDS = {
+    'Калории': ('НУТРИЕНТЫ', 'calories'),
+    'Белки': ('НУТРИЕНТЫ', 'protein'),
+    'Жиры': ('НУТРИЕНТЫ', 'fat'),
+    'Углеводы': ('НУТРИЕНТЫ', 'carbs'),
+    'Сожжено': ('КАЛОРИИ', 'burned'),
+}
+
+_NUMBER = r'\d+(?:[.,]\d+)?'
+
+# Теги секций: выражение начинается с литерала "[", поэтому поиск идет быстрым сканированием
+_TAG = re.compile(rf'\[(/?)({"|".join(SECTIONS)})\]')
+# "Поле: число" внутри секции. Число допускает "~", "≈", "около", "примерно",
+# дробную часть и диапазон "300-350"; регистр названия поля не важен
+_FIELD = re.compile(
+    rf'(?i:({"|".join(_FIELDS)}))\s*:\s*(?:[~≈]|около|примерно)?\s*'
+    rf'({_NUMBER})(?:\s*[-–—]\s*({_NUMBER}))?'
+)
+# Секции, в которых есть числа
+_NUMERIC_SECTIONS = {section for section, _ in _FIELDS.values()}
+
+
+def _number(value: str) -> float:
+    return float(value.replace(',', '.'))
+
+
+@dataclass(frozen=True)
+class ParsedResponse:
+    """Секции ответа LLM и числа из них; отсутствующие значения равны нулю"""
+    sections: dict[str, str] = field(default_factory=dict)
+    values: dict[str, int] = field(default_factory=dict)
+
+    @property
+    def nutrients(self) -> dict:
+        return {key: self.values.get(key, 0) for key in ('calories', 'protein', 'fat', 'carbs')}
+
+    @property
+    def burned(self) -> int:
+        return self.values.get('burned', 0)
+
+    def section(self, name: str) -> str | None:
+        return self.sections.get(name)
+
+
+@lru_cache(maxsize=512)
+def parse_response(text: str) -> ParsedResponse:
+    """
+    Разбирает ответ LLM за один проход. Секция заканчивается своим закрывающим тегом,
+    а если модель его не дописала — следующим открывающим тегом или концом текста.
+    Результат кэшируется: один и тот же ответ обычно разбирается несколько раз подряд.
+    """
+    sections: dict[str, str] = {}
+    spans: dict[str, tuple[int, int]] = {}
+    current, start = None, 0
+
+    for match in _TAG.finditer(text):
+        closing, tag = match.groups()
+        if current is not None and (closing or tag != current):
+            spans.setdefault(current, (start, match.start()))
+            current = None
+        if not closing:
+            current, start = tag, match.end()
+    if current is not None:
+        spans.setdefault(current, (start, len(text)))
+
+    # Числа ищутся только внутри своих секций, так что каждый символ ответа просматривается один раз
+    values: dict[str, int] = {}
+    for section, (start, end) in spans.items():
+        sections[section] = text[start:end].strip()
+        if section not in _NUMERIC_SECTIONS:
+            continue
+        for name, value, upper in _FIELD.findall(text, start, end):
+            field_section, key = _FIELDS[name.capitalize()]
+            if field_section == section and key not in values:
+                number = _number(value)
+                if upper:
+                    number = (number + _number(upper)) / 2
+                values[key] = round(number)
+    return ParsedResponse(sections, values)
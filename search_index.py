@@ -0,0 +1,241 @@
+# search_index.py
+#
+# Полнотекстовый поиск по истории пользователя: приемы пищи, активность, вопросы.
+# Индекс — виртуальная таблица SQLite FTS5; слова индексируются стеммами (как в
+# справочнике продуктов), поэтому "борщ", "борща" и "борщом" находят друг друга;
+# числа ("300 г", "10 км") индексируются как есть и ищутся точно.
+# Перестроение индекса: python -m search_index
+
+import datetime
+import logging
+import re
+import time
+from dataclasses import dataclass
+
+from sqlalchemy import event, text
+
+from config import SEARCH_PAGE_SIZE
+from database import engine
+from models import DailyLog
+from nutrition_db import normalize_name
+from response_parser import parse_response
+import metrics
+
+logger = logging.getLogger(__name__)
+
+FTS_TABLE = 'daily_logs_fts'
+
+# owner — служебный токен пользователя: поиск пересекает его список документов
+# со списками слов запроса и не просматривает чужие записи
+_CREATE = f"""
+CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5(
+    owner, terms, body UNINDEXED, kind UNINDEXED, date UNINDEXED,
+    tokenize = 'unicode61 remove_diacritics 2', prefix = '3 4'
+)
+"""
+_INSERT = text(
+    f"INSERT INTO {FTS_TABLE} (rowid, owner, terms, body, kind, date) "
+    "VALUES (:id, :owner, :terms, :body, :kind, :date)"
+)
+_DELETE = text(f"DELETE FROM {FTS_TABLE} WHERE rowid = :id")
+_SEARCH = text(
+    f"SELECT rowid, body, kind, date FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH :match "
+    "ORDER BY rank, date DESC LIMIT :limit OFFSET :offset"
+)
+
+# Слова вопроса, которые не сужают поиск ("когда я последний раз ел борщ")
+_STOP_STEMS = set(normalize_name(
+    'когда где что как сколько я мне мой моя последний раз ел ела ели пил пила пили '
+    'был была были в во на с со и за до по у'
+).split())
+
+_NUMBER = re.compile(r'\d+')
+
+EXCERPT_WIDTH = 160
+
+# None — наличие индекса еще не проверялось
+_available: bool | None = None
+
+
+@dataclass(frozen=True)
+class SearchHit:
+    log_id: int
+    date: datetime.date
+    kind: str
+    excerpt: str
+
+
+def document(data: dict) -> tuple[str, str] | None:
+    """Вид записи и индексируемый текст; итоги дня и служебные записи не индексируются"""
+    record_type = data.get('type')
+    if record_type in ('meal', 'activity'):
+        # Берется только описание из секции АНАЛИЗ: в рекомендациях упоминаются продукты,
+        # которых пользователь не ел
+        analysis = data.get('analysis') or ''
+        description = parse_response(analysis).section('АНАЛИЗ') or analysis
+        body = '\n'.join(part for part in (data.get('text'), description) if part)
+        return data.get('meal_type') or ('Активность' if record_type == 'activity' else 'Прием пищи'), body
+    if record_type == 'query':
+        return 'Вопрос', '\n'.join(part for part in (data.get('query'), data.get('response')) if part)
+    return None
+
+
+def terms(body: str) -> list[str]:
+    """Индексируемые слова: стеммы (normalize_name отбрасывает цифры) и числа"""
+    return normalize_name(body).split() + _NUMBER.findall(body)
+
+
+def _owner(telegram_id: int) -> str:
+    return f'u{telegram_id}'
+
+
+def _row(log) -> dict | None:
+    doc = document(log.data or {})
+    if doc is None or not doc[1]:
+        return None
+    kind, body = doc
+    return {
+        'id': log.id, 'owner': _owner(log.telegram_id), 'terms': ' '.join(terms(body)),
+        'body': body, 'kind': kind, 'date': log.date.isoformat(),
+    }
+
+
+def index_available(connection) -> bool:
+    global _available
+    if _available is None:
+        _available = connection.dialect.name == 'sqlite' and connection.execute(
+            text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :name"), {'name': FTS_TABLE}
+        ).first() is not None
+    return _available
+
+
+def _fill(connection, batch_size: int = 5000) -> int:
+    """Индексирует все записи из горячей таблицы и архива"""
+    from archive import unpack
+    from models import DailyLogArchive
+
+    indexed, rows = 0, []
+
+    def flush():
+        nonlocal indexed, rows
+        if rows:
+            connection.execute(_INSERT, rows)
+            indexed += len(rows)
+            rows = []
+
+    sources = (
+        connection.execute(
+            DailyLog.__table__.select().order_by(DailyLog.id), execution_options={'yield_per': batch_size}
+        ),
+        (log for block in connection.execute(
+            DailyLogArchive.__table__.select().order_by(DailyLogArchive.id), execution_options={'yield_per': 100}
+        ) for log in unpack(block)),
+    )
+    for source in sources:
+        for log in source:
+            row = _row(log)
+            if row is not None:
+                rows.append(row)
+            if len(rows) >= batch_size:
+                flush()
+    flush()
+    return indexed
+
+
+def create_index(connection) -> bool:
+    """Создает и заполняет индекс; False, если SQLite собран без FTS5 или база не SQLite"""
+    global _available
+    if connection.dialect.name != 'sqlite':
+        logger.warning("Полнотекстовый поиск доступен только для SQLite, /search отключен")
+        _available = False
+        return False
+    try:
+        connection.exec_driver_sql(_CREATE)
+    except Exception as e:
+        logger.warning("SQLite без FTS5 (%s), /search отключен", e)
+        _available = False
+        return False
+    _available = True
+    logger.info("Проиндексировано записей: %d", _fill(connection))
+    return True
+
+
+def reindex(connection) -> int:
+    """Заново заполняет индекс в транзакции connection; 0, если индекса нет"""
+    if not index_available(connection):
+        return 0
+    connection.exec_driver_sql(f"DELETE FROM {FTS_TABLE}")
+    return _fill(connection)
+
+
+def rebuild_index() -> int:
+    """Полностью перестраивает индекс, например после загрузки данных через bulk_io"""
+    with engine.begin() as connection:
+        return reindex(connection)
+
+
+@event.listens_for(DailyLog, 'after_insert')
+@event.listens_for(DailyLog, 'after_update')
+def _index_log(mapper, connection, target):
+    """Индекс обновляется в той же транзакции, что и запись"""
+    if not index_available(connection):
+        return
+    connection.execute(_DELETE, {'id': target.id})
+    row = _row(target)
+    if row is not None:
+        connection.execute(_INSERT, row)
+
+
+@event.listens_for(DailyLog, 'after_delete')
+def _unindex_log(mapper, connection, target):
+    # Перенос в архив удаляет строки массовым DELETE без событий, поэтому архивные
+    # записи остаются в индексе
+    if index_available(connection):
+        connection.execute(_DELETE, {'id': target.id})
+
+
+def query_stems(query: str) -> list[str]:
+    return [stem for stem in dict.fromkeys(terms(query)) if stem not in _STOP_STEMS]
+
+
+def excerpt(body: str, stems: list[str], width: int = EXCERPT_WIDTH) -> str:
+    """Фрагмент текста вокруг первого найденного слова запроса"""
+    folded = body.lower().replace('ё', 'е')
+    positions = [pos for pos in (folded.find(stem) for stem in stems) if pos >= 0]
+    start = max(min(positions, default=0) - width // 3, 0)
+    fragment = ' '.join(body[start:start + width].split())
+    return ('…' if start else '') + fragment + ('…' if start + width < len(body) else '')
+
+
+def search(telegram_id: int, query: str, page: int = 0,
+           page_size: int = SEARCH_PAGE_SIZE) -> tuple[list[SearchHit], bool]:
+    """
+    Записи пользователя, подходящие под все слова запроса (с учетом окончаний),
+    по релевантности (BM25). Возвращает страницу результатов и признак следующей страницы.
+    """
+    stems = query_stems(query)
+    if not stems:
+        return [], False
+    # Числа без префиксного поиска: "300" не должно находить "3000"
+    match = ' AND '.join(f'"{stem}"' if stem.isdigit() else f'"{stem}"*' for stem in stems)
+    started = time.perf_counter()
+    with engine.connect() as connection:
+        if not index_available(connection):
+            return [], False
+        rows = connection.execute(_SEARCH, {
+            'match': f'owner : "{_owner(telegram_id)}" AND terms : ({match})',
+            'limit': page_size + 1,
+            'offset': page * page_size,
+        }).all()
+    metrics.observe('search.time', time.perf_counter() - started)
+
+    hits = [
+        SearchHit(log_id, datetime.date.fromisoformat(date), kind, excerpt(body, stems))
+        for log_id, body, kind, date in rows[:page_size]
+    ]
+    return hits, len(rows) > page_size
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    print(f"Проиндексировано записей: {rebuild_index()}")
@@ -0,0 +1,212 @@
+# semantic_cache.py
+
+import hashlib
+import math
+import re
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+
+from config import SEMANTIC_CACHE_TTL, SEMANTIC_CACHE_THRESHOLD, SEMANTIC_CACHE_SIZE
+from nutrition_db import normalize_name
+import metrics
+
+# LSH по SimHash: 64-битная сигнатура делится на полосы, кандидаты — вопросы,
+# совпавшие хотя бы в одной полосе; затем проверяется точный косинус
+_SIGNATURE_BITS = 64
+_BANDS = 8
+_BAND_BITS = _SIGNATURE_BITS // _BANDS
+_BAND_MASK = (1 << _BAND_BITS) - 1
+
+# Слова, не меняющие смысл вопроса
+_FILLER_WORDS = {
+    'мне', 'я', 'а', 'ну', 'вот', 'ли', 'в', 'день', 'сегодня',
+    'пожалуйста', 'подскажи', 'подскажите', 'скажи', 'скажите',
+}
+
+
+def normalize_question(text: str) -> str:
+    """Нижний регистр, ё→е, без пунктуации, лишних пробелов и слов-паразитов"""
+    text = text.lower().replace('ё', 'е')
+    return ' '.join(w for w in re.findall(r'[а-яa-z0-9]+', text) if w not in _FILLER_WORDS)
+
+
+# Отрицание переворачивает смысл вопроса, почти не меняя его слов
+_NEGATIONS = {'не', 'нет', 'без', 'нельзя', 'ни'}
+
+
+def markers(text: str) -> tuple[frozenset, frozenset]:
+    """
+    Числа и отрицания вопроса ("после 6" и "после 9", "пить" и "не пить").
+    Косинус по стеммам их почти не замечает, поэтому ответ берется из кэша,
+    только если они совпадают полностью.
+    """
+    words = normalize_question(text).split()
+    numbers = frozenset(re.findall(r'\d+', ' '.join(words)))
+    negated = frozenset(
+        normalize_name(words[i + 1]) if i + 1 < len(words) else ''
+        for i, word in enumerate(words) if word in _NEGATIONS
+    )
+    return numbers, negated
+
+
+def embed(text: str) -> dict[str, float]:
+    """
+    Локальный эмбеддинг вопроса: стеммы слов, символьные триграммы стеммов, числа
+    и отрицания, нормированные по L2. Разреженный вектор в виде словаря признак -> вес.
+    """
+    stems = normalize_name(normalize_question(text)).split()
+    numbers, negated = markers(text)
+    features: dict[str, float] = {'n:' + number: 2.0 for number in numbers}
+    features.update(('neg:' + stem, 2.0) for stem in negated)
+    for stem in stems:
+        features['w:' + stem] = features.get('w:' + stem, 0) + 2.0
+        padded = f' {stem} '
+        for i in range(len(padded) - 2):
+            gram = padded[i:i + 3]
+            features[gram] = features.get(gram, 0) + 1.0
+    norm = math.sqrt(sum(v * v for v in features.values())) or 1.0
+    return {k: v / norm for k, v in features.items()}
+
+
+def cosine(a: dict[str, float], b: dict[str, float]) -> float:
+    if len(a) > len(b):
+        a, b = b, a
+    return sum(v * b.get(k, 0.0) for k, v in a.items())
+
+
+def _feature_hash(feature: str) -> int:
+    return int.from_bytes(hashlib.blake2b(feature.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+def simhash(vector: dict[str, float]) -> int:
+    acc = [0.0] * _SIGNATURE_BITS
+    for feature, weight in vector.items():
+        h = _feature_hash(feature)
+        for bit in range(_SIGNATURE_BITS):
+            acc[bit] += weight if h >> bit & 1 else -weight
+    return sum(1 << bit for bit, v in enumerate(acc) if v > 0)
+
+
+def _bands(signature: int) -> list[tuple[int, int]]:
+    return [(i, signature >> (i * _BAND_BITS) & _BAND_MASK) for i in range(_BANDS)]
+
+
+# Шаг остатка калорий и белка в ключе раздела: ответ, посчитанный при одном остатке,
+# отдается только при остатке, отличающемся меньше чем на шаг
+CALORIE_STEP = 100
+PROTEIN_STEP = 10
+
+
+def remaining_for(user_data: dict) -> tuple[int, int]:
+    """Остаток калорий (с учетом сожженных) и белка до дневной цели"""
+    goals = user_data.get('daily_goals', {})
+    totals = user_data.get('daily_totals', {})
+    remaining_calories = goals.get('calories', 0) - (totals.get('calories', 0) - totals.get('burned', 0))
+    remaining_protein = goals.get('protein', 0) - totals.get('protein', 0)
+    return remaining_calories, remaining_protein
+
+
+def partition_for(telegram_id: int, user_data: dict) -> tuple:
+    """
+    Ключ раздела кэша: пользователь, активный день и состояние дня (остаток калорий
+    с шагом CALORIE_STEP, белка — PROTEIN_STEP). Ответы строятся по профилю и истории дня
+    пользователя, поэтому другим пользователям они не отдаются. Точные остатки
+    передаются в запрос к модели и показываются вместе с ответом из кэша.
+    """
+    remaining_calories, remaining_protein = remaining_for(user_data)
+    return (
+        telegram_id,
+        user_data.get('date'),
+        remaining_calories // CALORIE_STEP,
+        remaining_protein // PROTEIN_STEP,
+    )
+
+
+@dataclass
+class _Entry:
+    question: str
+    partition: tuple
+    vector: dict[str, float]
+    markers: tuple[frozenset, frozenset]
+    bands: list[tuple[int, int]]
+    response: str
+    expires_at: float
+    kind: str = 'query'
+
+
+class SemanticCache:
+    """Кэш ответов LLM с поиском ближайшего по смыслу вопроса в пределах раздела"""
+
+    def __init__(self, ttl: float = SEMANTIC_CACHE_TTL, threshold: float = SEMANTIC_CACHE_THRESHOLD,
+                 max_entries: int = SEMANTIC_CACHE_SIZE):
+        self.ttl = ttl
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries: OrderedDict[int, _Entry] = OrderedDict()
+        self._buckets: dict[tuple, set[int]] = {}
+        self._next_id = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, question: str, partition: tuple, kind: str = 'query') -> str | None:
+        """Возвращает закэшированный ответ на близкий вопрос или None"""
+        vector = embed(question)
+        question_markers = markers(question)
+        now = time.monotonic()
+        best_id, best_score = None, 0.0
+        with self._lock:
+            candidates = set()
+            for band in _bands(simhash(vector)):
+                candidates |= self._buckets.get((partition, *band), set())
+            for entry_id in candidates:
+                entry = self._entries[entry_id]
+                if entry.expires_at < now:
+                    self._remove(entry_id)
+                    continue
+                if entry.markers != question_markers:
+                    continue
+                score = cosine(vector, entry.vector)
+                if score > best_score:
+                    best_id, best_score = entry_id, score
+
+            if best_id is not None and best_score >= self.threshold:
+                self._entries.move_to_end(best_id)
+                metrics.incr('semantic_cache.hits', kind=kind)
+                metrics.observe('semantic_cache.similarity', best_score, kind=kind)
+                return self._entries[best_id].response
+
+        metrics.incr('semantic_cache.misses', kind=kind)
+        return None
+
+    def put(self, question: str, partition: tuple, response: str, kind: str = 'query') -> None:
+        vector = embed(question)
+        bands = _bands(simhash(vector))
+        with self._lock:
+            entry_id = self._next_id
+            self._next_id += 1
+            self._entries[entry_id] = _Entry(
+                normalize_question(question), partition, vector, markers(question), bands, response,
+                time.monotonic() + self.ttl, kind
+            )
+            for band in bands:
+                self._buckets.setdefault((partition, *band), set()).add(entry_id)
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+            metrics.set_gauge('semantic_cache.entries', len(self._entries))
+
+    def _remove(self, entry_id: int) -> None:
+        entry = self._entries.pop(entry_id)
+        for band in entry.bands:
+            key = (entry.partition, *band)
+            bucket = self._buckets.get(key)
+            if bucket is not None:
+                bucket.discard(entry_id)
+                if not bucket:
+                    del self._buckets[key]
+
+
+response_cache = SemanticCache()
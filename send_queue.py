@@ -0,0 +1,180 @@
+# send_queue.py
+
+import asyncio
+import logging
+import time
+from datetime import timedelta
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+from config import (
+    TELEGRAM_GLOBAL_RATE, TELEGRAM_CHAT_RATE, TELEGRAM_CHAT_BURST,
+    TELEGRAM_GROUP_RATE_PER_MINUTE, TELEGRAM_SEND_MAX_RETRIES,
+)
+from llm_scheduler import TokenBucket
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Запросы без ограничений: long polling идет по отдельному соединению
+_UNLIMITED_ENDPOINTS = {'getUpdates'}
+# Правки, из которых достаточно отправить последнюю
+_MERGEABLE_ENDPOINTS = {'editMessageText'}
+
+
+def _retry_seconds(error: RetryAfter) -> float:
+    """retry_after в новых версиях python-telegram-bot — timedelta, в старых — число секунд"""
+    value = error.retry_after
+    return value.total_seconds() if isinstance(value, timedelta) else float(value)
+
+
+class _ChatState:
+    """Очередь одного чата: порядок отправки, бюджет и пауза после RetryAfter"""
+
+    __slots__ = ('lock', 'bucket', 'paused_until', 'users')
+
+    def __init__(self, bucket: TokenBucket):
+        self.lock = asyncio.Lock()
+        self.bucket = bucket
+        self.paused_until = 0.0
+        self.users = 0
+
+
+class SendQueue(BaseRateLimiter):
+    """
+    Очередь исходящих запросов к Telegram, подключается через Application.builder().rate_limiter().
+    - запросы одного чата отправляются по очереди в исходном порядке;
+    - общий бюджет и бюджет чата (для групп — отдельный, поминутный) — ведра токенов;
+    - на RetryAfter чат (или вся очередь для запросов без чата) ставится на паузу,
+      запрос повторяется до TELEGRAM_SEND_MAX_RETRIES раз;
+    - если правка сообщения еще ждет отправки, а пришла более новая правка того же
+      сообщения, отправляется только последняя, а старая получает ее результат.
+    """
+
+    def __init__(self, global_rate: float = TELEGRAM_GLOBAL_RATE, chat_rate: float = TELEGRAM_CHAT_RATE,
+                 chat_burst: int = TELEGRAM_CHAT_BURST,
+                 group_rate_per_minute: float = TELEGRAM_GROUP_RATE_PER_MINUTE,
+                 max_retries: int = TELEGRAM_SEND_MAX_RETRIES):
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate_per_minute / 60
+        self.max_retries = max_retries
+        self._global = TokenBucket(global_rate, global_rate)
+        self._paused_until = 0.0
+        self._chats: dict[int | str, _ChatState] = {}
+        self._latest_edit: dict[tuple, asyncio.Future] = {}
+        self._waiting = 0
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        self._chats.clear()
+        self._latest_edit.clear()
+
+    def _chat(self, chat_id) -> _ChatState:
+        state = self._chats.get(chat_id)
+        if state is None:
+            self._prune()
+            # Отрицательные chat_id и @username — группы и каналы
+            is_group = isinstance(chat_id, str) or chat_id < 0
+            bucket = TokenBucket(self.group_rate, self.chat_burst) if is_group \
+                else TokenBucket(self.chat_rate, self.chat_burst)
+            state = self._chats[chat_id] = _ChatState(bucket)
+        return state
+
+    def _prune(self) -> None:
+        """Удаляет простаивающие чаты с полным ведром и без паузы после RetryAfter"""
+        if len(self._chats) < 10000:
+            return
+        now = time.monotonic()
+        for chat_id in [c for c, st in self._chats.items()
+                        if not st.users and st.bucket.full and st.paused_until <= now]:
+            del self._chats[chat_id]
+
+    async def _take(self, state: _ChatState | None) -> None:
+        """Ждет, пока запрос уложится в общий бюджет, бюджет чата и паузы после RetryAfter"""
+        while True:
+            now = time.monotonic()
+            wait = max(
+                self._paused_until - now,
+                self._global.wait_time(1, now),
+                state.paused_until - now if state else 0.0,
+                state.bucket.wait_time(1, now) if state else 0.0,
+            )
+            if wait <= 0:
+                self._global.consume(1, now)
+                if state:
+                    state.bucket.consume(1, now)
+                return
+            await asyncio.sleep(wait)
+
+    async def _send(self, callback, args, kwargs, endpoint: str, state: _ChatState | None):
+        for attempt in range(self.max_retries + 1):
+            await self._take(state)
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                delay = _retry_seconds(e)
+                metrics.incr('send_queue.retry_after', endpoint=endpoint)
+                if attempt == self.max_retries:
+                    raise
+                logger.warning("Telegram просит подождать %.1f с (%s), попытка %d/%d",
+                               delay, endpoint, attempt + 1, self.max_retries)
+                paused_until = time.monotonic() + delay
+                if state:
+                    state.paused_until = max(state.paused_until, paused_until)
+                else:
+                    self._paused_until = max(self._paused_until, paused_until)
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        if endpoint in _UNLIMITED_ENDPOINTS:
+            return await callback(*args, **kwargs)
+
+        chat_id = data.get('chat_id')
+        if chat_id is None:
+            with metrics.timer('send_queue.duration', endpoint=endpoint):
+                return await self._send(callback, args, kwargs, endpoint, None)
+
+        edit_key, edit_future = None, None
+        if endpoint in _MERGEABLE_ENDPOINTS and data.get('message_id') is not None:
+            edit_key = (chat_id, data['message_id'])
+            edit_future = asyncio.get_running_loop().create_future()
+            self._latest_edit[edit_key] = edit_future
+
+        state = self._chat(chat_id)
+        state.users += 1
+        self._waiting += 1
+        metrics.set_gauge('send_queue.waiting', self._waiting)
+        try:
+            with metrics.timer('send_queue.duration', endpoint=endpoint):
+                async with state.lock:
+                    latest = self._latest_edit.get(edit_key) if edit_key else None
+                    if latest is edit_future:
+                        result = await self._send(callback, args, kwargs, endpoint, state)
+                if latest is not edit_future:
+                    # Более новая правка того же сообщения уже в очереди — ждем ее результата
+                    metrics.incr('send_queue.edits_merged')
+                    result = await asyncio.shield(latest)
+            if edit_future:
+                edit_future.set_result(result)
+            return result
+        except BaseException as e:
+            if edit_future and not edit_future.done():
+                if isinstance(e, asyncio.CancelledError):
+                    edit_future.cancel()
+                    raise
+                edit_future.set_exception(e)
+                # Ошибку получит вызвавший код; у ожидающих правок ее может не оказаться
+                edit_future.add_done_callback(lambda f: f.exception())
+            raise
+        finally:
+            state.users -= 1
+            # Состояние чата нужно, пока его ведро не наполнилось и не истекла пауза
+            if not state.users and state.bucket.full and state.paused_until <= time.monotonic():
+                self._chats.pop(chat_id, None)
+            if edit_key and self._latest_edit.get(edit_key) is edit_future:
+                del self._latest_edit[edit_key]
+            self._waiting -= 1
+            metrics.set_gauge('send_queue.waiting', self._waiting)
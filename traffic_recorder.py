@@ -0,0 +1,170 @@
+# traffic_recorder.py
+
+import datetime
+import glob
+import gzip
+import hashlib
+import hmac
+import json
+import logging
+import os
+import secrets
+import time
+import zlib
+
+from telegram import Update
+from telegram.ext import TypeHandler
+
+from config import TRAFFIC_FLUSH_INTERVAL, TRAFFIC_KEEP_TEXT, TRAFFIC_RECORD_PATH, TRAFFIC_SALT
+from jobs import runner
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Объекты, поле id которых — идентификатор пользователя или чата
+_ID_OWNERS = {'from', 'chat', 'user', 'sender_chat', 'forward_from', 'forward_from_chat', 'via_bot'}
+# Поля, которые не нужны для воспроизведения и только раскрывают пользователя
+_DROP = {
+    'last_name', 'username', 'title', 'bio', 'phone_number', 'contact', 'location', 'venue',
+    'forward_sender_name', 'author_signature', 'is_premium',
+}
+_TEXT = {'text', 'caption', 'query', 'first_name'}
+_FILE = {'file_id', 'file_unique_id'}
+
+
+def _split_path(path: str) -> tuple[str, str]:
+    """"data/traffic.jsonl.gz" -> ("data/traffic", ".jsonl.gz")"""
+    directory, name = os.path.split(path)
+    stem = name.split('.', 1)[0]
+    return os.path.join(directory, stem), name[len(stem):]
+
+
+def run_path(path: str) -> str:
+    """Файл записи одного запуска бота: data/traffic-20251019-120000-1234.jsonl.gz"""
+    root, ext = _split_path(path)
+    return f"{root}-{datetime.datetime.now():%Y%m%d-%H%M%S}-{os.getpid()}{ext}"
+
+
+def recorded_files(path: str) -> list[str]:
+    """Файлы записи по порядку запусков; путь к конкретному файлу возвращается как есть"""
+    if os.path.isfile(path):
+        return [path]
+    root, ext = _split_path(path)
+    return sorted(glob.glob(f"{glob.escape(root)}-*{ext}"))
+
+
+def mask_text(text: str) -> str:
+    """
+    Буквы заменяются на "х"/"x", цифры на "0": длина, пробелы, пунктуация и эмодзи
+    остаются, поэтому сохраняются смещения entities и размер запросов к модели.
+    Команда в начале сообщения не маскируется — по ней выбирается обработчик.
+    """
+    command = ''
+    if text.startswith('/'):
+        command, _, text = text.partition(' ')
+        command += ' ' if text else ''
+    return command + ''.join(
+        ('х' if 'а' <= c.lower() <= 'я' or c in 'ёЁ' else 'x') if c.isalpha() else '0' if c.isdigit() else c
+        for c in text
+    )
+
+
+class TrafficRecorder:
+    """
+    Запись входящих обновлений в сжатый файл только на дозапись (gzip, по строке JSON
+    на обновление: {"t": время получения, "u": обновление}).
+    Идентификаторы пользователей и чатов заменяются псевдонимами (HMAC с солью),
+    file_id — хэшами с типом файла, имена и контакты удаляются, текст маскируется
+    (кроме команд и callback data, которые задает сам бот).
+    Каждый запуск пишет свой файл (run_path): после аварийной остановки оборван
+    только хвост этого файла, а записи следующих запусков остаются читаемыми.
+    """
+
+    def __init__(self, path: str = TRAFFIC_RECORD_PATH, salt: str = TRAFFIC_SALT,
+                 keep_text: bool = TRAFFIC_KEEP_TEXT):
+        self.path = path
+        self.keep_text = keep_text
+        self._salt = salt.encode() if salt else secrets.token_bytes(16)
+        self._file = None
+
+    def _digest(self, value) -> bytes:
+        return hmac.new(self._salt, str(value).encode(), hashlib.sha256).digest()
+
+    def pseudonym(self, value: int) -> int:
+        """Стабильный в пределах соли псевдоним id; знак сохраняется (у групп id отрицательные)"""
+        number = int.from_bytes(self._digest(abs(value))[:6], 'big') % 10 ** 12 + 1
+        return -number if value < 0 else number
+
+    def anonymize(self, value, owner: str | None = None):
+        if isinstance(value, list):
+            return [self.anonymize(item, owner) for item in value]
+        if not isinstance(value, dict):
+            return value
+        result = {}
+        for key, item in value.items():
+            if key in _DROP:
+                continue
+            if key == 'id' and owner in _ID_OWNERS and isinstance(item, int):
+                result[key] = self.pseudonym(item)
+            elif key in _FILE:
+                # Тип файла в id нужен заглушке Telegram при воспроизведении, чтобы отдать фото или звук
+                result[key] = f'{owner}:{self._digest(item)[:12].hex()}'
+            elif key in _TEXT and isinstance(item, str) and not self.keep_text:
+                result[key] = mask_text(item)
+            else:
+                result[key] = self.anonymize(item, key)
+        return result
+
+    def write(self, update: Update) -> None:
+        if self._file is None:
+            path = run_path(self.path)
+            self._file = gzip.open(path, 'wt', encoding='utf-8')
+            logger.info("Запись входящего трафика в %s", path)
+        record = {'t': round(time.time(), 3), 'u': self.anonymize(update.to_dict())}
+        self._file.write(json.dumps(record, ensure_ascii=False, separators=(',', ':')) + '\n')
+
+    async def record(self, update: Update, context) -> None:
+        try:
+            self.write(update)
+            metrics.incr('traffic.recorded')
+        except Exception as e:
+            # Запись трафика не должна мешать обработке обновления
+            metrics.incr('traffic.errors')
+            logger.error("Не удалось записать обновление: %s", e)
+
+    async def flush(self) -> None:
+        """Периодическая задача: сбрасывает сжатый буфер на диск (Z_SYNC_FLUSH)"""
+        if self._file is not None:
+            self._file.flush()
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+recorder = TrafficRecorder()
+
+
+def read_records(path: str):
+    """
+    Читает записи (время, обновление-словарь) всех запусков по порядку (см. recorded_files).
+    Хвост файла, оборванный при аварийной остановке бота, пропускается.
+    """
+    for file_path in recorded_files(path):
+        with gzip.open(file_path, 'rt', encoding='utf-8') as f:
+            try:
+                for line in f:
+                    if not line.endswith('\n'):
+                        break
+                    record = json.loads(line)
+                    yield record['t'], record['u']
+            except (EOFError, zlib.error, gzip.BadGzipFile, json.JSONDecodeError):
+                logger.warning("Файл %s не закрыт или оборван, прочитан до последней сброшенной записи",
+                               file_path)
+
+
+def register_recorder(application) -> None:
+    # Группа -2 обрабатывается раньше учета активности (-1) и всех обработчиков
+    application.add_handler(TypeHandler(Update, recorder.record), group=-2)
+    runner.every('traffic_flush', TRAFFIC_FLUSH_INTERVAL, recorder.flush)
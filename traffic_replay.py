@@ -0,0 +1,355 @@
+# traffic_replay.py
+#
+# Воспроизводит записанный трафик (см. traffic_recorder.py) на локальном экземпляре
+# бота с заглушками вместо Telegram Bot API и OpenAI и печатает распределение
+# задержек и ошибки по обработчикам.
+# Запуск: python -m traffic_replay data/traffic.jsonl.gz [--speed 10] [--llm-latency 2]
+#
+# Бот работает на временной базе (DATABASE_URL) и временном каталоге фото,
+# рабочие данные не затрагиваются.
+
+import argparse
+import asyncio
+import datetime
+import functools
+import io
+import json
+import logging
+import math
+import os
+import random
+import tempfile
+import time
+from collections import Counter, defaultdict
+
+import httpx
+from telegram import Update
+from telegram.ext import ApplicationHandlerStop, ConversationHandler, TypeHandler
+from telegram.request import BaseRequest
+
+BOT_TOKEN = '100000:replay'
+BOT_USER = {'id': 100000, 'is_bot': True, 'first_name': 'Replay', 'username': 'replay_bot'}
+
+# Ответ модели со всеми секциями, которые разбирают обработчики (см. response_parser)
+LLM_ANSWER = (
+    "[АНАЛИЗ]\nОтвет заглушки OpenAI для воспроизведения трафика.\n[/АНАЛИЗ]\n"
+    "[НУТРИЕНТЫ]\nКалории: 450\nБелки: 25\nЖиры: 15\nУглеводы: 50\n[/НУТРИЕНТЫ]\n"
+    "[КАЛОРИИ]\nСожжено: 200\n[/КАЛОРИИ]\n"
+    "[РЕКОМЕНДАЦИИ]\nПродолжайте в том же духе.\n[/РЕКОМЕНДАЦИИ]"
+)
+
+# Профиль для пользователей из записи: без него обработчики дня отвечают "пройдите опрос"
+DEFAULT_PROFILE = {
+    'height': 175, 'weight': 75, 'age': 30, 'gender': 'Мужской', 'goal': 'Поддерживать вес',
+    'activity_level': 'Средняя активность (3-4 тренировки в неделю)', 'training_experience': 'Средний',
+}
+
+
+def percentile(values: list[float], q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(int(math.ceil(q * len(ordered))) - 1, len(ordered) - 1)] if ordered else 0.0
+
+
+def _sample_jpeg() -> bytes:
+    try:
+        from PIL import Image
+    except ImportError:
+        return b''
+    buffer = io.BytesIO()
+    Image.new('RGB', (640, 480), (200, 160, 120)).save(buffer, 'JPEG')
+    return buffer.getvalue()
+
+
+class StubTelegramRequest(BaseRequest):
+    """
+    Bot API без сети: отвечает правдоподобными объектами с задержкой latency,
+    считает вызовы по методам. Скачивание фото отдает сгенерированный JPEG.
+    """
+
+    def __init__(self, latency: float = 0.05):
+        self.latency = latency
+        self.calls: Counter = Counter()
+        self._message_id = 0
+        self._jpeg = None
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    def _message(self, params: dict) -> dict:
+        self._message_id += 1
+        return {
+            'message_id': params.get('message_id', self._message_id),
+            'date': int(time.time()),
+            'chat': {'id': params.get('chat_id', 0), 'type': 'private'},
+            'from': BOT_USER,
+            'text': params.get('text') or params.get('caption') or '',
+        }
+
+    def _result(self, method: str, params: dict):
+        if method == 'getMe':
+            return BOT_USER
+        if method == 'getFile':
+            # file_id из записи имеет вид "<тип>:<хэш>" (см. TrafficRecorder.anonymize)
+            kind, _, digest = str(params['file_id']).partition(':')
+            return {'file_id': params['file_id'], 'file_unique_id': digest,
+                    'file_path': f'{kind}/{digest}'}
+        if method.startswith(('send', 'edit')) and method != 'sendChatAction':
+            return self._message(params)
+        return True
+
+    async def do_request(self, url: str, method: str, request_data=None, read_timeout=None,
+                         write_timeout=None, connect_timeout=None, pool_timeout=None) -> tuple[int, bytes]:
+        await asyncio.sleep(self.latency)
+        if '/file/bot' in url:
+            self.calls['download'] += 1
+            if '/photo/' in url:
+                if self._jpeg is None:
+                    self._jpeg = _sample_jpeg()
+                return 200, self._jpeg
+            return 200, b''
+        api_method = url.rsplit('/', 1)[-1]
+        self.calls[api_method] += 1
+        params = request_data.parameters if request_data is not None else {}
+        body = {'ok': True, 'result': self._result(api_method, params)}
+        return 200, json.dumps(body, ensure_ascii=False).encode('utf-8')
+
+
+class StubOpenAI:
+    """
+    Транспорт httpx для AsyncOpenAI: chat.completions отвечает LLM_ANSWER через
+    логнормальную задержку с медианой latency, доля error_rate запросов — ошибка 500.
+    """
+
+    def __init__(self, latency: float, error_rate: float):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.calls: Counter = Counter()
+
+    async def handle(self, request: httpx.Request) -> httpx.Response:
+        body = json.loads(request.content)
+        model = body.get('model', '')
+        self.calls[model] += 1
+        await asyncio.sleep(random.lognormvariate(math.log(self.latency), 0.5) if self.latency > 0 else 0)
+        if random.random() < self.error_rate:
+            self.calls['errors'] += 1
+            return httpx.Response(500, json={'error': {'message': 'replay stub error', 'type': 'server_error'}})
+        prompt_tokens = len(request.content) // 4
+        completion_tokens = len(LLM_ANSWER) // 3
+        return httpx.Response(200, json={
+            'id': 'chatcmpl-replay',
+            'object': 'chat.completion',
+            'created': int(time.time()),
+            'model': model,
+            'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': LLM_ANSWER},
+                         'finish_reason': 'stop'}],
+            'usage': {'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens,
+                      'total_tokens': prompt_tokens + completion_tokens},
+        })
+
+
+class HandlerStats:
+    """Задержки и ошибки по обработчикам; обертки ставятся на callback уже собранного приложения"""
+
+    def __init__(self):
+        self.latency: dict[str, list[float]] = defaultdict(list)
+        self.errors: dict[str, Counter] = defaultdict(Counter)
+        self.queue_wait: list[float] = []
+        self.enqueued: dict[int, float] = {}
+
+    def _wrap(self, handler, wrapped: set) -> None:
+        if isinstance(handler, ConversationHandler):
+            for inner in handler.entry_points + handler.fallbacks:
+                self._wrap(inner, wrapped)
+            for handlers in handler.states.values():
+                for inner in handlers:
+                    self._wrap(inner, wrapped)
+            return
+        if id(handler) in wrapped or getattr(handler, 'callback', None) is None:
+            return
+        wrapped.add(id(handler))
+        callback = handler.callback
+        name = f"{getattr(callback, '__module__', '')}.{getattr(callback, '__qualname__', repr(callback))}"
+
+        @functools.wraps(callback)
+        async def timed(update, context):
+            started = time.perf_counter()
+            try:
+                return await callback(update, context)
+            except ApplicationHandlerStop:
+                raise
+            except Exception as e:
+                self.errors[name][type(e).__name__] += 1
+                raise
+            finally:
+                self.latency[name].append(time.perf_counter() - started)
+
+        handler.callback = timed
+
+    def instrument(self, application) -> None:
+        wrapped = set()
+        for handlers in application.handlers.values():
+            for handler in handlers:
+                self._wrap(handler, wrapped)
+        # Первая группа: сколько обновление ждало в очереди приложения
+        application.add_handler(TypeHandler(Update, self._dequeued), group=-100)
+
+    async def _dequeued(self, update: Update, context) -> None:
+        enqueued = self.enqueued.pop(id(update), None)
+        if enqueued is not None:
+            self.queue_wait.append(time.perf_counter() - enqueued)
+
+    def report(self) -> list[str]:
+        lines = [f"{'обработчик':<52} {'вызовов':>8} {'ошибок':>7} {'p50':>8} {'p90':>8} {'p99':>8} {'макс':>8}"]
+        rows = sorted(self.latency.items(), key=lambda item: -sum(item[1]))
+        for name, values in rows:
+            lines.append(
+                f"{name:<52} {len(values):>8} {sum(self.errors[name].values()):>7} "
+                + ' '.join(f"{percentile(values, q) * 1e3:>6.0f}мс" for q in (0.5, 0.9, 0.99))
+                + f" {max(values) * 1e3:>6.0f}мс"
+            )
+        errors = [(name, kind, count) for name, kinds in self.errors.items() for kind, count in kinds.items()]
+        if errors:
+            lines.append("\nОшибки:")
+            lines.extend(f"• {name}: {kind} x{count}" for name, kind, count in sorted(errors, key=lambda e: -e[2]))
+        if self.queue_wait:
+            lines.append(
+                f"\nОжидание в очереди: p50 {percentile(self.queue_wait, 0.5) * 1e3:.0f} мс, "
+                f"p99 {percentile(self.queue_wait, 0.99) * 1e3:.0f} мс, макс. {max(self.queue_wait) * 1e3:.0f} мс"
+            )
+        return lines
+
+
+def prepare_environment(workdir: str) -> None:
+    """Временная база и каталог фото, запись трафика выключена; до импорта config"""
+    os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(workdir, 'replay.db')}"
+    os.environ['PHOTO_STORE_DIR'] = os.path.join(workdir, 'photos')
+    os.environ['TRAFFIC_RECORD_PATH'] = ''
+    os.environ['TELEGRAM_TOKEN'] = BOT_TOKEN
+    os.environ['OPENAI_API_KEY'] = 'replay'
+
+
+def seed_profiles(telegram_ids: set[int]) -> None:
+    from database import Session
+    from handlers.common import ACTIVITY_MULTIPLIERS, build_system_prompt, calculate_daily_goals
+    from models import User
+
+    p = DEFAULT_PROFILE
+    calories, protein, fat, carbs = calculate_daily_goals(
+        p['height'], p['weight'], p['age'], p['gender'], p['goal'], ACTIVITY_MULTIPLIERS[p['activity_level']]
+    )
+    user_info = dict(
+        p,
+        daily_goals={'calories': calories, 'protein': protein, 'fat': fat, 'carbs': carbs},
+        system_prompt=build_system_prompt(p['height'], p['weight'], p['age'], p['gender'], p['goal'],
+                                          calories, protein, fat, carbs, p['activity_level'],
+                                          p['training_experience']),
+    )
+    session = Session()
+    session.add_all(User(telegram_id=telegram_id, user_info=dict(user_info)) for telegram_id in telegram_ids)
+    session.commit()
+    session.close()
+
+
+async def replay(path: str, speed: float, max_gap: float, telegram: StubTelegramRequest,
+                 stats: HandlerStats) -> tuple[int, float, float]:
+    """Подает обновления в приложение с исходными интервалами, ускоренными в speed раз"""
+    import openai_utils
+    from bot import create_app
+    from jobs import runner
+    from traffic_recorder import read_records
+
+    app = create_app(requests=(telegram, StubTelegramRequest(0)))
+    stats.instrument(app)
+
+    await app.initialize()
+    await app.post_init(app)
+    await app.start()
+
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    offset, previous, count, lag = 0.0, None, 0, 0.0
+    for recorded_at, data in read_records(path):
+        if previous is not None:
+            offset += min(recorded_at - previous, max_gap) / speed
+        previous = recorded_at
+        delay = started + offset - loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        else:
+            lag = max(lag, -delay)
+        update = Update.de_json(data, app.bot)
+        stats.enqueued[id(update)] = time.perf_counter()
+        await app.update_queue.put(update)
+        count += 1
+
+    await app.update_queue.join()
+    await runner.drain()
+    elapsed = loop.time() - started
+
+    await app.stop()
+    await app.post_shutdown(app)
+    await app.shutdown()
+    await openai_utils.get_client().close()
+    return count, elapsed, lag
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Воспроизведение записанного трафика бота")
+    parser.add_argument('path', help="TRAFFIC_RECORD_PATH (все запуски по порядку) или файл одного запуска")
+    parser.add_argument('--speed', type=float, default=1.0, help="ускорение относительно записи, 1..100")
+    parser.add_argument('--max-gap', type=float, default=60.0,
+                        help="паузы длиннее этого (в секундах записи) сокращаются до него")
+    parser.add_argument('--llm-latency', type=float, default=2.0, help="медианная задержка заглушки OpenAI, с")
+    parser.add_argument('--llm-error-rate', type=float, default=0.0, help="доля ответов OpenAI с ошибкой 500")
+    parser.add_argument('--telegram-latency', type=float, default=0.05, help="задержка заглушки Bot API, с")
+    parser.add_argument('--no-profiles', action='store_true',
+                        help="не создавать профили пользователям из записи")
+    args = parser.parse_args()
+    if not 1 <= args.speed <= 100:
+        parser.error("--speed должен быть от 1 до 100")
+
+    prepare_environment(tempfile.mkdtemp(prefix='replay-'))
+    # Ошибки обработчиков попадают в отчет; лог бота (DEBUG) только мешал бы его читать
+    logging.disable(logging.WARNING)
+
+    from openai import AsyncOpenAI
+    from migrations import migrate
+    from traffic_recorder import read_records
+    import openai_utils
+    import usage_ledger
+
+    openai_stub = StubOpenAI(args.llm_latency, args.llm_error_rate)
+    openai_utils._client = AsyncOpenAI(
+        api_key='replay', http_client=httpx.AsyncClient(transport=httpx.MockTransport(openai_stub.handle))
+    )
+    if not args.no_profiles:
+        migrate()
+        users = {data['message']['from']['id'] for _, data in read_records(args.path)
+                 if 'from' in data.get('message', {})}
+        users |= {data['callback_query']['from']['id'] for _, data in read_records(args.path)
+                  if 'callback_query' in data}
+        seed_profiles(users)
+
+    telegram = StubTelegramRequest(args.telegram_latency)
+    stats = HandlerStats()
+    count, elapsed, lag = asyncio.run(replay(args.path, args.speed, args.max_gap, telegram, stats))
+
+    print(f"Обновлений: {count} за {elapsed:.1f} с (x{args.speed:g}), "
+          f"максимальное отставание подачи {lag * 1e3:.0f} мс\n")
+    print('\n'.join(stats.report()))
+    print("\nBot API: " + ', '.join(f"{method} {n}" for method, n in telegram.calls.most_common()))
+    print("OpenAI: " + (', '.join(f"{model} {n}" for model, n in openai_stub.calls.most_common()) or "нет вызовов"))
+    today = datetime.date.today()
+    for flow, calls, cost, avg_latency, max_latency in usage_ledger.by_flow(today - datetime.timedelta(days=1), today):
+        print(f"• {flow}: {calls} выз., задержка {avg_latency / 1000:.1f} с (макс. {max_latency / 1000:.1f} с)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,149 @@
+# transcription.py
+
+import asyncio
+import importlib.util
+import io
+import logging
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from config import (
+    VOICE_BATCH_SIZE, VOICE_BATCH_WINDOW, VOICE_CPU_THREADS, VOICE_LANGUAGE, VOICE_MODEL, VOICE_WORKERS,
+)
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Распознавание идет локально через faster-whisper (CTranslate2, int8 на CPU);
+# без пакета голосовые сообщения не принимаются
+WHISPER_AVAILABLE = importlib.util.find_spec('faster_whisper') is not None
+
+# Модель загружается один раз в каждом процессе пула
+_model = None
+
+
+def _init_worker(model_name: str, cpu_threads: int) -> None:
+    global _model
+    from faster_whisper import WhisperModel
+    _model = WhisperModel(model_name, device='cpu', compute_type='int8', cpu_threads=cpu_threads)
+
+
+def _warm_up() -> bool:
+    return _model is not None
+
+
+def _transcribe_batch(clips: list[bytes], language: str) -> list[tuple[str | None, float, float]]:
+    """Выполняется в процессе пула: (текст или None при ошибке, секунды расчета, длительность аудио)"""
+    results = []
+    for audio in clips:
+        started = time.perf_counter()
+        try:
+            # OGG/Opus из Telegram декодируется самим faster-whisper, без ffmpeg
+            segments, info = _model.transcribe(io.BytesIO(audio), language=language, beam_size=1, vad_filter=True)
+            text = ' '.join(segment.text.strip() for segment in segments).strip()
+            results.append((text, time.perf_counter() - started, info.duration))
+        except Exception:
+            logger.exception("Ошибка распознавания голосового сообщения")
+            results.append((None, time.perf_counter() - started, 0.0))
+    return results
+
+
+class Transcriber:
+    """
+    Локальное распознавание речи в пуле процессов.
+    - модель загружается в каждом процессе пула один раз, цикл событий бота не блокируется;
+    - сообщения, пришедшие почти одновременно (в пределах batch_window), собираются
+      до batch_size штук и делятся поровну между процессами пула: каждый процесс
+      получает одну задачу (меньше пересылок), но ни один не простаивает, пока
+      другой распознает сообщения по очереди;
+    - время ожидания и расчета каждого сообщения публикуется в метриках.
+    """
+
+    def __init__(self, workers: int = VOICE_WORKERS, batch_size: int = VOICE_BATCH_SIZE,
+                 batch_window: float = VOICE_BATCH_WINDOW):
+        self.workers = workers
+        self.batch_size = batch_size
+        self.batch_window = batch_window
+        self._pool: ProcessPoolExecutor | None = None
+        self._pending: list[tuple[bytes, asyncio.Future, float]] = []
+        self._flush_handle: asyncio.TimerHandle | None = None
+
+    @property
+    def available(self) -> bool:
+        return WHISPER_AVAILABLE
+
+    def _get_pool(self) -> ProcessPoolExecutor:
+        if self._pool is None:
+            # spawn, а не fork: процесс бота многопоточный, форк с чужими блокировками небезопасен
+            self._pool = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=_init_worker,
+                initargs=(VOICE_MODEL, VOICE_CPU_THREADS),
+            )
+        return self._pool
+
+    async def start(self) -> None:
+        """Поднимает пул и загружает модель заранее, чтобы первое сообщение не ждало загрузки"""
+        if not self.available:
+            return
+        loop = asyncio.get_running_loop()
+        pool = self._get_pool()
+        await asyncio.gather(*(loop.run_in_executor(pool, _warm_up) for _ in range(self.workers)))
+        logger.info("Модель распознавания речи %s загружена в %d процесс(ов)", VOICE_MODEL, self.workers)
+
+    def close(self) -> None:
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+    async def transcribe(self, audio: bytes) -> str | None:
+        """Текст голосового сообщения; None, если распознать не удалось"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((audio, future, time.perf_counter()))
+        if len(self._pending) >= self.batch_size:
+            self._flush()
+        elif self._flush_handle is None:
+            self._flush_handle = loop.call_later(self.batch_window, self._flush)
+        return await future
+
+    def _flush(self) -> None:
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        batch, self._pending = self._pending, []
+        for i in range(min(self.workers, len(batch))):
+            asyncio.get_running_loop().create_task(self._run_batch(batch[i::self.workers]))
+
+    async def _run_batch(self, batch: list[tuple[bytes, asyncio.Future, float]]) -> None:
+        metrics.observe('voice.batch_size', len(batch))
+        try:
+            results = await asyncio.get_running_loop().run_in_executor(
+                self._get_pool(), _transcribe_batch, [audio for audio, _, _ in batch], VOICE_LANGUAGE
+            )
+        except Exception as e:
+            # Пул мог упасть (например, процесс убит по памяти): следующий вызов создаст новый
+            logger.error("Пул распознавания речи недоступен: %s", e, exc_info=True)
+            self.close()
+            results = [(None, 0.0, 0.0)] * len(batch)
+
+        finished = time.perf_counter()
+        for (_, future, enqueued), (text, compute_time, duration) in zip(batch, results):
+            latency = finished - enqueued
+            metrics.observe('voice.latency', latency)
+            metrics.observe('voice.transcribe_time', compute_time)
+            metrics.incr('voice.transcribed' if text else 'voice.failed')
+            if duration:
+                # Меньше 1 — распознавание быстрее реального времени
+                metrics.observe('voice.real_time_factor', compute_time / duration)
+            logger.info(
+                "Голосовое сообщение %.1f с распознано за %.2f с (в очереди и пуле %.2f с)",
+                duration, compute_time, latency
+            )
+            if not future.done():
+                future.set_result(text or None)
+
+
+transcriber = Transcriber()
@@ -0,0 +1,198 @@
+# usage_ledger.py
+
+import asyncio
+import datetime
+import logging
+from dataclasses import dataclass
+
+from sqlalchemy import case, delete, distinct, func, select
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from config import LEDGER_BATCH_SIZE, LEDGER_MAX_BUFFER, LEDGER_RAW_RETENTION_DAYS
+from database import engine
+from llm_scheduler import SYSTEM_USER
+from models import LlmUsage, LlmUsageDaily
+import metrics
+
+logger = logging.getLogger(__name__)
+
+_raw = LlmUsage.__table__
+_daily = LlmUsageDaily.__table__
+_DAILY_KEY = ('date', 'telegram_id', 'flow', 'model')
+_DAILY_SUMS = ('calls', 'prompt_tokens', 'completion_tokens', 'cached_tokens', 'latency_ms_sum', 'cost_usd')
+
+
+@dataclass(slots=True)
+class UsageRecord:
+    time: datetime.datetime
+    telegram_id: int
+    flow: str
+    model: str
+    prompt_tokens: int
+    completion_tokens: int
+    cached_tokens: int
+    latency_ms: int
+    cost_usd: float
+
+
+def _aggregate(batch: list[UsageRecord]) -> list[dict]:
+    """Сворачивает пачку записей в строки дневных итогов"""
+    rows: dict[tuple, dict] = {}
+    for record in batch:
+        key = (record.time.date(), record.telegram_id, record.flow, record.model)
+        row = rows.get(key)
+        if row is None:
+            row = rows[key] = dict(zip(_DAILY_KEY, key), latency_ms_max=0, **dict.fromkeys(_DAILY_SUMS, 0))
+        row['calls'] += 1
+        row['prompt_tokens'] += record.prompt_tokens
+        row['completion_tokens'] += record.completion_tokens
+        row['cached_tokens'] += record.cached_tokens
+        row['latency_ms_sum'] += record.latency_ms
+        row['latency_ms_max'] = max(row['latency_ms_max'], record.latency_ms)
+        row['cost_usd'] += record.cost_usd
+    return list(rows.values())
+
+
+def _upsert_daily():
+    statement = sqlite_insert(_daily)
+    updates = {name: _daily.c[name] + statement.excluded[name] for name in _DAILY_SUMS}
+    updates['latency_ms_max'] = func.max(_daily.c.latency_ms_max, statement.excluded.latency_ms_max)
+    return statement.on_conflict_do_update(index_elements=list(_DAILY_KEY), set_=updates)
+
+
+def write_batch(batch: list[UsageRecord]) -> None:
+    """Записывает пачку и обновляет дневные итоги в одной транзакции"""
+    with engine.begin() as connection:
+        connection.execute(_raw.insert(), [
+            {name: getattr(record, name) for name in UsageRecord.__slots__} for record in batch
+        ])
+        connection.execute(_upsert_daily(), _aggregate(batch))
+
+
+class UsageLedger:
+    """
+    Журнал расхода LLM. record() только добавляет запись в буфер: вызов к модели
+    не ждет базу. Буфер пишется пачками — по заполнении до batch_size и периодически,
+    каждая пачка одной транзакцией вместе с дневными итогами (llm_usage_daily).
+    """
+
+    def __init__(self, batch_size: int = LEDGER_BATCH_SIZE, max_buffer: int = LEDGER_MAX_BUFFER):
+        self.batch_size = batch_size
+        self.max_buffer = max_buffer
+        self._buffer: list[UsageRecord] = []
+        self._lock: asyncio.Lock | None = None
+
+    def __len__(self) -> int:
+        return len(self._buffer)
+
+    def record(self, telegram_id: int | None, flow: str, model: str, usage, latency: float, cost: float) -> None:
+        details = getattr(usage, 'prompt_tokens_details', None)
+        self._buffer.append(UsageRecord(
+            datetime.datetime.now(),
+            SYSTEM_USER if telegram_id is None else telegram_id,
+            flow,
+            model,
+            usage.prompt_tokens,
+            usage.completion_tokens,
+            getattr(details, 'cached_tokens', None) or 0,
+            round(latency * 1000),
+            cost,
+        ))
+        if len(self._buffer) >= self.batch_size:
+            from jobs import runner
+            runner.submit('usage_flush', self.flush)
+
+    async def flush(self) -> int:
+        """Записывает накопленные записи; возвращает их число"""
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            batch, self._buffer = self._buffer, []
+            if not batch:
+                return 0
+            try:
+                await asyncio.to_thread(write_batch, batch)
+            except Exception:
+                # Записи возвращаются в буфер до следующей попытки; при долгом сбое старые отбрасываются
+                pending = batch + self._buffer
+                metrics.incr('usage_ledger.dropped', max(len(pending) - self.max_buffer, 0))
+                self._buffer = pending[-self.max_buffer:]
+                raise
+        metrics.incr('usage_ledger.written', len(batch))
+        return len(batch)
+
+    async def prune(self, retention_days: int = LEDGER_RAW_RETENTION_DAYS) -> None:
+        """Периодическая задача: удаляет старые записи по вызовам, дневные итоги остаются"""
+        cutoff = datetime.datetime.now() - datetime.timedelta(days=retention_days)
+
+        def _delete() -> int:
+            with engine.begin() as connection:
+                return connection.execute(delete(_raw).where(_raw.c.time < cutoff)).rowcount
+
+        removed = await asyncio.to_thread(_delete)
+        if removed:
+            logger.info("Удалено записей журнала расхода старше %d дней: %d", retention_days, removed)
+
+
+ledger = UsageLedger()
+
+
+def _in_range(start: datetime.date, end: datetime.date):
+    return _daily.c.date.between(start, end)
+
+
+def totals(start: datetime.date, end: datetime.date) -> dict:
+    """
+    Итоги за период и стоимость на активного пользователя (с хотя бы одним вызовом).
+    Вызовы без пользователя (SYSTEM_USER) входят в общую стоимость, но не в стоимость
+    на пользователя: и числитель, и знаменатель считаются без них.
+    """
+    with engine.connect() as connection:
+        row = connection.execute(select(
+            func.coalesce(func.sum(_daily.c.calls), 0),
+            func.coalesce(func.sum(_daily.c.prompt_tokens), 0),
+            func.coalesce(func.sum(_daily.c.completion_tokens), 0),
+            func.coalesce(func.sum(_daily.c.cached_tokens), 0),
+            func.coalesce(func.sum(_daily.c.cost_usd), 0.0),
+            func.coalesce(func.sum(case((_daily.c.telegram_id != SYSTEM_USER, _daily.c.cost_usd), else_=0.0)), 0.0),
+        ).where(_in_range(start, end))).one()
+        users = connection.execute(
+            select(func.count(distinct(_daily.c.telegram_id))).where(
+                _in_range(start, end), _daily.c.telegram_id != SYSTEM_USER
+            )
+        ).scalar()
+    calls, prompt_tokens, completion_tokens, cached_tokens, cost, user_cost = row
+    return {
+        'calls': calls,
+        'prompt_tokens': prompt_tokens,
+        'completion_tokens': completion_tokens,
+        'cached_tokens': cached_tokens,
+        'cost_usd': cost,
+        'active_users': users,
+        'cost_per_user': user_cost / users if users else 0.0,
+    }
+
+
+def by_flow(start: datetime.date, end: datetime.date) -> list[tuple]:
+    """(сценарий, вызовов, стоимость, средняя задержка в мс, максимальная задержка) по убыванию стоимости"""
+    with engine.connect() as connection:
+        return connection.execute(select(
+            _daily.c.flow,
+            func.sum(_daily.c.calls),
+            func.sum(_daily.c.cost_usd),
+            func.sum(_daily.c.latency_ms_sum) / func.sum(_daily.c.calls),
+            func.max(_daily.c.latency_ms_max),
+        ).where(_in_range(start, end)).group_by(_daily.c.flow).order_by(func.sum(_daily.c.cost_usd).desc())).all()
+
+
+def top_users(start: datetime.date, end: datetime.date, limit: int = 10) -> list[tuple]:
+    """(telegram_id, вызовов, токенов, стоимость) для самых затратных пользователей"""
+    with engine.connect() as connection:
+        return connection.execute(select(
+            _daily.c.telegram_id,
+            func.sum(_daily.c.calls),
+            func.sum(_daily.c.prompt_tokens + _daily.c.completion_tokens),
+            func.sum(_daily.c.cost_usd),
+        ).where(
+            _in_range(start, end), _daily.c.telegram_id != SYSTEM_USER
+        ).group_by(_daily.c.telegram_id).order_by(func.sum(_daily.c.cost_usd).desc()).limit(limit)).all()
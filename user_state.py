@@ -0,0 +1,169 @@
+# user_state.py
+
+import datetime
+import logging
+import os
+import resource
+import time
+
+from telegram import Update
+from telegram.ext import ConversationHandler, TypeHandler
+
+from config import USER_STATE_TTL, IDLE_SWEEP_INTERVAL
+from database import Session
+from models import User
+from jobs import runner
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Время последнего обновления от пользователя (time.monotonic); пользователей,
+# выгруженных из памяти или не писавших с момента запуска, здесь нет
+_last_seen: dict[int, float] = {}
+
+# Ключ в User.user_info с датой активного (незавершенного) дня
+ACTIVE_DAY_KEY = 'active_day'
+
+# Предупреждение о недоступном списке диалогов выводится один раз
+_conversations_warned = False
+
+
+def resident_memory() -> int:
+    """Текущий RSS процесса в байтах (на Linux — из /proc, иначе пиковый из getrusage)"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+async def touch(update: Update, context) -> None:
+    """Отмечает активность пользователя и возвращает в память выгруженный активный день"""
+    user = update.effective_user
+    if user is None:
+        return
+    if user.id not in _last_seen and 'date' not in context.user_data:
+        # Первое обновление после выгрузки или перезапуска: день мог остаться незавершенным
+        restore_user(user.id, context.user_data)
+    _last_seen[user.id] = time.monotonic()
+
+
+def _set_active_day(telegram_id: int, date: datetime.date | None) -> None:
+    session = Session()
+    user = session.query(User).filter_by(telegram_id=telegram_id).first()
+    if user is not None:
+        # JSON-колонка отслеживает только присваивание, поэтому словарь пересоздается
+        info = {key: value for key, value in (user.user_info or {}).items() if key != ACTIVE_DAY_KEY}
+        if date is not None:
+            info[ACTIVE_DAY_KEY] = date.isoformat()
+        if info != user.user_info:
+            user.user_info = info
+            session.commit()
+    session.close()
+
+
+def remember_active_day(telegram_id: int, date: datetime.date) -> None:
+    """
+    Запоминает дату начатого дня сразу, а не только при выгрузке: после аварийной
+    остановки бота день восстановится из DailyLog при первом обновлении пользователя
+    """
+    _set_active_day(telegram_id, date)
+
+
+def forget_active_day(telegram_id: int) -> None:
+    _set_active_day(telegram_id, None)
+
+
+def spill_user(telegram_id: int, user_data: dict) -> None:
+    """Сохраняет дату активного дня: остальное состояние дня восстанавливается из DailyLog"""
+    if 'date' in user_data:
+        _set_active_day(telegram_id, user_data['date'])
+
+
+def restore_user(telegram_id: int, user_data: dict) -> bool:
+    from handlers.tracking import restore_day_state
+
+    session = Session()
+    user = session.query(User).filter_by(telegram_id=telegram_id).first()
+    active_day = (user.user_info or {}).get(ACTIVE_DAY_KEY) if user else None
+    session.close()
+
+    if not active_day:
+        return False
+    restored = restore_day_state(telegram_id, user_data, datetime.date.fromisoformat(active_day))
+    if not restored:
+        # День закрыт (в том числе автоматически) — дата больше не нужна
+        forget_active_day(telegram_id)
+    metrics.incr('user_state.restored' if restored else 'user_state.restore_skipped')
+    return restored
+
+
+def _expire_conversations(application, user_ids: set[int]) -> int:
+    """
+    Завершает зависшие диалоги пользователей. Нужен, только если у приложения нет JobQueue:
+    без нее python-telegram-bot игнорирует conversation_timeout, а публичного способа
+    завершить чужой диалог нет. Используется внутренний словарь _conversations; если
+    в новой версии библиотеки его нет, выводится предупреждение и диалоги не трогаются.
+    Ключи диалогов — кортежи из id чата/пользователя/сообщения, поэтому достаточно
+    проверить вхождение id.
+    """
+    global _conversations_warned
+    expired = 0
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            if not isinstance(handler, ConversationHandler):
+                continue
+            conversations = getattr(handler, '_conversations', None)
+            if not isinstance(conversations, dict):
+                if not _conversations_warned:
+                    logger.warning(
+                        "ConversationHandler без _conversations: зависшие диалоги не завершаются, "
+                        "установите python-telegram-bot[job-queue] для conversation_timeout"
+                    )
+                    _conversations_warned = True
+                continue
+            for key in [key for key in conversations if any(part in user_ids for part in key)]:
+                del conversations[key]
+                expired += 1
+    return expired
+
+
+async def sweep_idle_users(application, ttl: float = USER_STATE_TTL) -> None:
+    """Периодическая задача: выгружает из памяти состояние пользователей, неактивных дольше ttl"""
+    rss_before = resident_memory()
+    now = time.monotonic()
+    idle = {user_id for user_id, seen in _last_seen.items() if now - seen > ttl}
+    # После перезапуска время активности неизвестно: такие записи считаются неактивными
+    idle |= {user_id for user_id in application.user_data if user_id not in _last_seen}
+
+    for user_id in idle:
+        user_data = application.user_data.get(user_id)
+        if user_data:
+            spill_user(user_id, user_data)
+        application.drop_user_data(user_id)
+        _last_seen.pop(user_id, None)
+
+    expired = _expire_conversations(application, idle) if idle and application.job_queue is None else 0
+    rss_after = resident_memory()
+
+    metrics.incr('user_state.evicted', len(idle))
+    metrics.incr('user_state.conversations_expired', expired)
+    metrics.set_gauge('user_state.users_in_memory', len(application.user_data))
+    metrics.set_gauge('user_state.rss_before_sweep', rss_before)
+    metrics.set_gauge('user_state.rss_after_sweep', rss_after)
+    if idle:
+        logger.info(
+            "Выгружено состояние %d неактивных пользователей, завершено диалогов: %d, RSS %.1f -> %.1f МБ",
+            len(idle), expired, rss_before / 2**20, rss_after / 2**20
+        )
+
+
+def register_user_state(application) -> None:
+    if application.job_queue is None:
+        logger.warning(
+            "JobQueue недоступна (python-telegram-bot без [job-queue]): conversation_timeout не работает, "
+            "зависшие диалоги завершаются при выгрузке неактивных пользователей"
+        )
+    # Группа -1 обрабатывается раньше всех остальных и не мешает им
+    application.add_handler(TypeHandler(Update, touch), group=-1)
+    runner.every('idle_sweep', IDLE_SWEEP_INTERVAL, sweep_idle_users, application)